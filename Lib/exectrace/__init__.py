@@ -3,7 +3,16 @@
 # Licensed under GPL version 3 or later
 
 
+import heapq
+import mmap
+import os
+import re
 import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from operator import attrgetter
 
 def hex8(v):
     return "0x%02X" % v
@@ -11,6 +20,8 @@ def hex8(v):
 def hex16(v):
     return "0x%04X" % v
 
+_HEX8 = [hex8(v) for v in range(256)]
+
 class CodeBlock():
     ''' A code block represents an address range in
         program memory. The range is specified by
@@ -25,26 +36,594 @@ class CodeBlock():
         instruction.
     '''
 
-    def __init__(self, start, end, next_block=[], needs_label=False):
+    def __init__(self, start, end, next_block=None, needs_label=False):
         self.start = start
         self.end = end
         self.subroutines = {}
-        self.next_block = next_block
+        self.next_block = next_block if next_block is not None else []
         self.needs_label = needs_label
 
     def add_subroutine_call(self, instr_address, routine_address):
         self.subroutines[instr_address] = routine_address
 
 
+# Per-address flags kept in the BlockStore address map:
+CODE = 0x01    # the byte belongs to a visited code block
+OPCODE = 0x02  # the byte is the first one of a decoded instruction
+DATA = 0x04    # the byte was declared as data
+
+_SET_CODE = bytes(b | CODE for b in range(256))
+
+
+class BlockStore():
+    ''' Owns the code blocks of a trace, keeping them
+        sorted by start address so that iteration always
+        happens in address order.
+
+        Blocks never overlap: whenever an address in the
+        middle of an existing block is reached again, the
+        block is split in place at that address.
+
+        For the first <size> addresses of the logical address
+        space the store also keeps a compact map with the
+        CODE/OPCODE/DATA flags of every byte and the start
+        address of the block owning it, so that containment
+        checks cost a single index lookup. Addresses beyond
+        the map fall back to a bisect over the block starts.
+
+        A crawl adds blocks in no particular address order, so they
+        are only appended to the list, which gets sorted the next time
+        address order is needed. Inserting each block in place would
+        move about half of the list every time.
+    '''
+
+    def __init__(self, size=0):
+        self._starts = []
+        self._blocks = []
+        self._sorted = True
+        self._by_start = {}
+        self.splits = 0
+        self.size = size
+        self.state = bytearray(size)
+        self.owner = array('i', [-1]) * size
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __iter__(self):
+        self._sort()
+        return iter(self._blocks)
+
+    def _sort(self):
+        if not self._sorted:
+            # Stable, so blocks sharing a start keep the order they were added in:
+            self._blocks.sort(key=attrgetter("start"))
+            self._starts = [codeblock.start for codeblock in self._blocks]
+            self._sorted = True
+
+    def add(self, block):
+        if self._sorted and (not self._starts or block.start >= self._starts[-1]):
+            self._starts.append(block.start)
+        else:
+            self._sorted = False
+        self._blocks.append(block)
+        self._by_start[block.start] = block
+
+        start = max(block.start, 0)
+        end = min(block.end + 1, self.size)
+        if start < end:
+            self.state[start:end] = self.state[start:end].translate(_SET_CODE)
+            self.owner[start:end] = array('i', [block.start]) * (end - start)
+
+    def mark(self, address, flag):
+        if 0 <= address < self.size:
+            self.state[address] |= flag
+
+    def find(self, address):
+        ''' Returns the block containing <address>, or None. '''
+        if 0 <= address < self.size:
+            if self.state[address] & CODE:
+                return self._by_start[self.owner[address]]
+            return None
+
+        self._sort()
+        index = bisect_right(self._starts, address) - 1
+        if index >= 0:
+            codeblock = self._blocks[index]
+            if address <= codeblock.end:
+                return codeblock
+        return None
+
+    def blocks_in(self, start, end):
+        ''' Yields, in address order, the blocks lying
+            entirely within the [start, end) address range.
+        '''
+        self._sort()
+        index = bisect_left(self._starts, start)
+        while index < len(self._blocks):
+            codeblock = self._blocks[index]
+            if codeblock.start >= end:
+                break
+            if codeblock.end < end:
+                yield codeblock
+            index += 1
+
+    def split(self, codeblock, address):
+        ''' Splits <codeblock> in two at <address>.
+            The original object keeps the tail starting at
+            <address> and a new head block is added before it.
+            Subroutine calls issued from the head move along with it.
+        '''
+        head = CodeBlock(start=codeblock.start,
+                         end=address-1,
+                         next_block=[address],
+                         needs_label=codeblock.needs_label)
+        head.subroutines = {instr_addr: call_addr
+                            for instr_addr, call_addr in codeblock.subroutines.items()
+                            if instr_addr < address}
+        codeblock.subroutines = {instr_addr: call_addr
+                                 for instr_addr, call_addr in codeblock.subroutines.items()
+                                 if instr_addr >= address}
+        codeblock.start = address
+        codeblock.needs_label = True
+        self.splits += 1
+
+        self._blocks.append(head)
+        self._sorted = False
+        self._by_start[head.start] = head
+        self._by_start[address] = codeblock
+
+        start = max(address, 0)
+        end = min(codeblock.end + 1, self.size)
+        if start < end:
+            self.owner[start:end] = array('i', [address]) * (end - start)
+        return head
+
+    def runs(self, start, end, mask):
+        ''' Yields (first, last) address pairs for the runs of
+            consecutive bytes within [start, end) having any of
+            the flags in <mask> set.
+        '''
+        table = bytes(1 if b & mask else 0 for b in range(256))
+        start = max(start, 0)
+        end = min(end, self.size)
+        flags = self.state[start:end].translate(table)
+        pos = flags.find(1)
+        while pos != -1:
+            stop = flags.find(0, pos)
+            if stop == -1:
+                stop = len(flags)
+            yield start + pos, start + stop - 1
+            pos = flags.find(1, stop)
+
+
+# Orders in which pending entry points can be explored:
+DFS = "dfs"                       # most recently scheduled first
+BFS = "bfs"                       # least recently scheduled first
+LOWEST_FIRST = "lowest-address"   # lowest address first
+HIGHEST_FIRST = "highest-address" # highest address first
+
+
+class EntryPointQueue():
+    ''' The worklist of entry points still waiting to be
+        explored, together with whether each of them needs a
+        label in the disassembly listing.
+
+        Membership is kept in a dict, so de-duplication costs
+        O(1) regardless of the selected exploration order.
+    '''
+
+    def __init__(self, order=DFS):
+        if order not in [DFS, BFS, LOWEST_FIRST, HIGHEST_FIRST]:
+            raise ValueError("Unknown entry point scheduling order: {}".format(order))
+        self.order = order
+        self._queue = deque()
+        self._heap = []
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, address):
+        return address in self._pending
+
+    def __iter__(self):
+        return iter(self._pending.items())
+
+    def push(self, address, needs_label):
+        ''' Returns False if <address> was already pending. '''
+        if address in self._pending:
+            if needs_label:
+                self._pending[address] = True
+            return False
+
+        self._pending[address] = needs_label
+        if self.order == LOWEST_FIRST:
+            heapq.heappush(self._heap, address)
+        elif self.order == HIGHEST_FIRST:
+            heapq.heappush(self._heap, -address)
+        else:
+            self._queue.append(address)
+        return True
+
+    def pop(self):
+        if self.order == DFS:
+            address = self._queue.pop()
+        elif self.order == BFS:
+            address = self._queue.popleft()
+        elif self.order == LOWEST_FIRST:
+            address = heapq.heappop(self._heap)
+        else:
+            address = -heapq.heappop(self._heap)
+        return address, self._pending.pop(address)
+
+
+# Types of entries in the SymbolTable:
+LABEL = "label"
+SUBROUTINE = "subroutine"
+VARIABLE = "variable"
+EXTERNAL = "external"   # entry point of an ExternalRegion
+
+
+class Symbol():
+    ''' A named address. Variables also carry their
+        kind ("label", "str", "n-1_str", "jump_table",
+        "pointers", "gfx", ...) and, when it applies,
+        their length as declared by the user.
+    '''
+    __slots__ = ("address", "name", "type", "kind", "length", "comment")
+
+    def __init__(self, address, name, type, kind=None, length=None, comment=None):
+        self.address = address
+        self.name = name
+        self.type = type
+        self.kind = kind
+        self.length = length
+        self.comment = comment
+
+
+class ExternalRegion():
+    ''' A range of addresses, such as the BIOS of a machine, whose code
+        is not part of the image but gets called or jumped into.
+        <symbols> maps the addresses of its entry points to their name,
+        or to a (name, comment) pair as for subroutines.
+
+        Wherever the image does not map them, calls and jumps into
+        [start, end] are never fetched: they only get the names of the
+        entry points, defined by "equ" lines in the listing.
+    '''
+    __slots__ = ("name", "start", "end", "symbols")
+
+    def __init__(self, name, start, end, symbols=None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.symbols = symbols or {}
+
+    def cache_key(self):
+        ''' What a TraceCache tells this region apart by: its name,
+            bounds and the addresses of its entry points.
+        '''
+        return (self.name, self.start, self.end, sorted(self.symbols))
+
+
+class SymbolTable():
+    ''' Resolves addresses to names and names to addresses
+        in O(1) for every kind of symbol known to a trace:
+        plain labels, subroutines and variables.
+
+        Addresses without a symbol get a LABEL_xxxx name
+        that is generated once and then reused.
+
+        The table also keeps the set of addresses that need
+        a label definition in the disassembly listing.
+    '''
+
+    def __init__(self, variables=None, subroutines=None, labels=None):
+        self._symbols = {}
+        self._addresses = {}
+        self._generated = {}
+        self.labeled = set()
+
+        for addr, name in (labels or {}).items():
+            self.define(addr, name, LABEL)
+
+        for addr, var in (variables or {}).items():
+            self.define(addr, var[0], VARIABLE,
+                        kind=var[1],
+                        length=var[2] if len(var) > 2 else None)
+
+        for addr, sub in (subroutines or {}).items():
+            if isinstance(sub, tuple):
+                name, comment = sub
+            else: # is string:
+                name, comment = sub, None
+            self.define(addr, name, SUBROUTINE, comment=comment)
+
+    def __contains__(self, address):
+        return address in self._symbols
+
+    def __iter__(self):
+        return iter(self._symbols.values())
+
+    def define(self, address, name, type, kind=None, length=None, comment=None):
+        ''' Declares a symbol. Redefining an address replaces
+            its name but keeps the kind and length of a
+            previously declared variable.
+        '''
+        symbol = self._symbols.get(address)
+        if symbol is None:
+            self._symbols[address] = Symbol(address, name, type, kind, length, comment)
+        else:
+            if self._addresses.get(symbol.name) == address:
+                del self._addresses[symbol.name]
+            symbol.name = name
+            symbol.type = type
+            if kind is not None:
+                symbol.kind = kind
+                symbol.length = length
+            if comment is not None:
+                symbol.comment = comment
+        self._addresses[name] = address
+
+    def get(self, address):
+        return self._symbols.get(address)
+
+    def address_of(self, name):
+        return self._addresses.get(name)
+
+    def label(self, address, prefix="LABEL_"):
+        symbol = self._symbols.get(address)
+        if symbol is not None:
+            return symbol.name
+        if prefix != "LABEL_":
+            return "%s%04X" % (prefix, address)
+        name = self._generated.get(address)
+        if name is None:
+            name = self._generated[address] = "LABEL_%04X" % address
+        return name
+
+    def value(self, address):
+        symbol = self._symbols.get(address)
+        if symbol is not None:
+            return symbol.name
+        return hex16(address)
+
+    def comment(self, address):
+        symbol = self._symbols.get(address)
+        if symbol is not None:
+            return symbol.comment
+        return None
+
+    def of_type(self, type):
+        ''' Returns the symbols of the given type in declaration order. '''
+        return [symbol for symbol in self._symbols.values()
+                if symbol.type == type]
+
+    def variables(self):
+        ''' Returns, in declaration order, all symbols declaring a data kind. '''
+        return [symbol for symbol in self._symbols.values()
+                if symbol.kind is not None]
+
+
+# Operand kinds, telling how an operand value is rendered:
+NUMBER = 0      # formatted by the instruction template itself
+BYTE = 1        # 8-bit value, rendered by hex8()
+SYMBOL = 2      # 16-bit value, rendered as the name of the symbol declared at it
+TARGET = 3      # code address, rendered as its label
+CALL_TARGET = 4 # subroutine address, rendered as its label and comment
+
+# Control flow of an instruction, as declared by its decoder:
+JUMP = "jump"
+BRANCH = "branch"
+CALL = "call"
+RETURN = "return"
+ILLEGAL = "illegal"
+
+
+def _render_number(trace, value):
+    return value
+
+def _render_byte(trace, value):
+    return hex8(value)
+
+def _render_symbol(trace, value):
+    return trace.getVariableName(value)
+
+def _render_target(trace, value):
+    return trace.getLabelName(value)
+
+def _render_call_target(trace, value):
+    comment = trace.symbols.comment(value)
+    if comment:
+        return "%s\t; %s" % (trace.getLabelName(value), comment)
+    return trace.getLabelName(value)
+
+_RENDERERS = [_render_number,
+              _render_byte,
+              _render_symbol,
+              _render_target,
+              _render_call_target]
+
+
+def render(trace, entry):
+    ''' Returns the text of a disassembled instruction,
+        given the entry its decoder returned: either the text itself
+        or a (template, kinds, value, ...) tuple whose %-style template
+        is filled with the operand values, each one rendered according
+        to the matching entry of <kinds>.
+    '''
+    if entry.__class__ is str:
+        return entry
+    kinds = entry[1]
+    if len(kinds) == 1:
+        return entry[0] % _RENDERERS[kinds[0]](trace, entry[2])
+    return entry[0] % tuple([_RENDERERS[kind](trace, value)
+                             for kind, value in zip(kinds, entry[2:])])
+
+
+class Instruction():
+    ''' A decoded instruction, as yielded by ExecTrace.iter_instructions().
+        The trace itself only stores what the decoder returned,
+        so these records and their text are only built on request.
+    '''
+    __slots__ = ("address", "length", "template", "kinds", "values", "flow", "target")
+
+    def __init__(self, address, length, entry, flow=None, target=None):
+        self.address = address
+        self.length = length
+        if entry.__class__ is str:
+            self.template, self.kinds, self.values = entry, (), ()
+        else:
+            self.template, self.kinds, self.values = entry[0], entry[1], entry[2:]
+        self.flow = flow
+        self.target = target
+
+    def render(self, trace):
+        if not self.values:
+            return self.template
+        return render(trace, (self.template, self.kinds) + self.values)
+
+
+class _Rendered():
+    ''' Renders a decoded instruction only if a log message needs it. '''
+    __slots__ = ("trace", "entry")
+
+    def __init__(self, trace, entry):
+        self.trace = trace
+        self.entry = entry
+
+    def __str__(self):
+        return render(self.trace, self.entry)
+
+
+class CrawlMetrics():
+    ''' Counters and timers of a trace, kept once enabled by
+        ExecTrace.enable_metrics(). The counts the trace keeps anyway
+        (instructions, blocks, splits, pending entry points) are only
+        read from it by snapshot(), and the timers wrap the methods they
+        measure only when attached, so a trace without metrics pays
+        nothing for them.
+
+        The decoding time includes that of the visited checks done by
+        fetch(). With <opcode_timing> it is also broken down by opcode,
+        as named by the opcode_family() method of the trace.
+
+        Given a <progress> callback, it is called with a snapshot()
+        about every <interval> seconds while the crawl goes on.
+    '''
+
+    def __init__(self, opcode_timing=False, progress=None, interval=1.0):
+        self.decode_s = 0.0
+        self.visited_s = 0.0
+        self.listing_s = 0.0
+        self.crawl_s = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.max_pending = 0
+        self.opcodes = {} if opcode_timing else None
+        self.progress = progress
+        self.interval = interval
+        self._crawl_started = None
+        self._next_progress = None
+
+    def attach(self, trace):
+        ''' Replaces the methods of <trace> that get timed
+            by wrappers of them, as instance attributes.
+        '''
+        metrics = self
+        perf_counter = time.perf_counter
+
+        decode = trace.disasm_instruction
+        opcodes = self.opcodes
+        if opcodes is None:
+            def disasm_instruction(opcode):
+                start = perf_counter()
+                entry = decode(opcode)
+                metrics.decode_s += perf_counter() - start
+                return entry
+        else:
+            def disasm_instruction(opcode):
+                address = trace.PC - 1
+                start = perf_counter()
+                entry = decode(opcode)
+                elapsed = perf_counter() - start
+                metrics.decode_s += elapsed
+                family = trace.opcode_family(address, opcode)
+                timing = opcodes.get(family)
+                if timing is None:
+                    opcodes[family] = [1, elapsed]
+                else:
+                    timing[0] += 1
+                    timing[1] += elapsed
+                return entry
+        trace.disasm_instruction = disasm_instruction
+
+        visited = trace.already_visited
+        def already_visited(address):
+            start = perf_counter()
+            result = visited(address)
+            metrics.visited_s += perf_counter() - start
+            return result
+        trace.already_visited = already_visited
+
+        save = trace.save_disassembly_listing
+        def save_disassembly_listing(filename="output.asm"):
+            start = perf_counter()
+            save(filename)
+            metrics.listing_s += perf_counter() - start
+        trace.save_disassembly_listing = save_disassembly_listing
+
+    def crawl_started(self, trace):
+        self._crawl_started = time.perf_counter()
+        self._next_progress = self._crawl_started + self.interval
+
+    def block_explored(self, trace):
+        pending = len(trace.pending_entry_points)
+        if pending > self.max_pending:
+            self.max_pending = pending
+        if self.progress is not None:
+            now = time.perf_counter()
+            if now >= self._next_progress:
+                self._next_progress = now + self.interval
+                self.progress(self.snapshot(trace))
+
+    def crawl_finished(self, trace):
+        self.crawl_s += time.perf_counter() - self._crawl_started
+        self._crawl_started = None
+
+    def snapshot(self, trace):
+        ''' Returns the current values of all counters and timers. '''
+        crawl_s = self.crawl_s
+        if self._crawl_started is not None:
+            crawl_s += time.perf_counter() - self._crawl_started
+        return {"instructions": len(trace.disasm),
+                "blocks": len(trace.visited_ranges),
+                "splits": trace.visited_ranges.splits,
+                "pending": len(trace.pending_entry_points),
+                "max_pending": self.max_pending,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "crawl_s": crawl_s,
+                "decode_s": self.decode_s,
+                "visited_s": self.visited_s,
+                "listing_s": self.listing_s}
+
+    def opcode_report(self, limit=None):
+        ''' Returns (opcode family, count, total seconds) triples,
+            the ones that took the longest to decode first.
+        '''
+        report = sorted(((family, count, seconds)
+                         for family, (count, seconds) in (self.opcodes or {}).items()),
+                        key=lambda timing: timing[2], reverse=True)
+        return report[:limit] if limit is not None else report
+
+
 ERROR = 0   # only critical messages
 VERBOSE = 1 # informative non-error msgs to the user
 DEBUG = 2   # debugging messages to the developer
 
 
-class AddressAlreadyVisited(Exception):
-    pass
-
-
 class ExecTrace():
     """ ExecTrace is a generic class that implements an
         algorithm for mapping all reachable code-paths
@@ -59,11 +638,18 @@ class ExecTrace():
         providing a disasm_instruction method which
         (a) uses self.fetch() to read consecutive bytes from
         code memory
-        (b) returns a string representing the disassembly of
-        the current instruction
+        (b) returns the disassembly of the current instruction,
+        either as a string or as a (template, kinds, value, ...)
+        tuple to be rendered only when needed (see render())
         (c) invokes the class methods listed below to declare
         the behaviour of the branching instructions.
 
+        A byte that self.fetch() cannot read, either because it
+        belongs to code already visited or because it is not mapped,
+        is returned as zero and the instruction is then discarded.
+        Besides the methods below, a decoder must not act on such
+        bytes: self.fetch_failed_at then holds the failing address.
+
         Instruction description methods:
           * subroutine(address)
              Declares that the current instruction
@@ -75,6 +661,11 @@ class ExecTrace():
              and jumps back to the code that originally
              invoked the subroutine.
 
+          * conditional_return()
+             Declares that the current instruction
+             may return from a subroutine, or else
+             go on with the one that follows it
+
           * conditional_branch(address)
              Declares that the current instruction
              is a conditional branch that may
@@ -88,152 +679,472 @@ class ExecTrace():
              Declares that the current instruction
              with operation code <opcode> could not
              be parsed as a valid known instruction.
+
+        A child-class whose disasm_instruction depends on nothing
+        but the bytes it fetches and self.PC can list in
+        PARALLEL_CALLBACKS every method of the trace it calls.
+        Its instructions can then be decoded by worker processes
+        ahead of the crawl (see exectrace.parallel).
     """
+    PARALLEL_CALLBACKS = None
+
     def __init__(self,
                  romfile,
                  loglevel=ERROR,
                  relocation_blocks=None,
-                 variables={},
-                 subroutines={},
-                 labels={}):
+                 variables=None,
+                 subroutines=None,
+                 labels=None,
+                 scheduling=DFS,
+                 recent_events=0,
+                 external_regions=None):
         self.loglevel = loglevel
+        # Ring buffer of the last <recent_events> log messages, at any level:
+        self.recent_events = deque(maxlen=recent_events) if recent_events else None
         self.relocation_blocks = relocation_blocks
-        self.variables = variables
-        self.subroutines = subroutines
-        self.labels = labels
-        self.visited_ranges = []
-        self.pending_entry_points = []
+        self.symbols = SymbolTable(variables, subroutines, labels)
+        self.pending_entry_points = EntryPointQueue(scheduling)
         self.current_entry_point = None
         self.PC = None
         self.disasm = {}
-        self.labeled_addresses = []
+        self.flows = {}
+        self.flow = None
+        self.flow_target = None
+        self.illegal_opcode = None
+        self.fetch_failed_at = None
+        self.fetched = 0
+        self.traced_labels = set()
+        self.predecoded = {}
+        self.metrics = None
+        self.jump_resolver = None
 
         self.read_rom(romfile)
+        self.build_page_table()
+        address_space = max(reloc_to + length
+                            for _, reloc_to, length in self.relocation_blocks)
+        self.visited_ranges = BlockStore(address_space)
+        self.lengths = bytearray(address_space)
+        self.address_map = self.visited_ranges.state
+        self.mark_declared_data()
+
+        self.external_regions = sorted(external_regions or (), key=attrgetter("start"))
+        self._external_starts = [region.start for region in self.external_regions]
+        self.external_targets = set()
+        for region in self.external_regions:
+            for address, stub in region.symbols.items():
+                if address not in self.symbols:
+                    name, comment = stub if isinstance(stub, tuple) else (stub, None)
+                    self.symbols.define(address, name, EXTERNAL, comment=comment)
 
         to_register = []
-        for var_addr, var in self.variables.items():
-            self.register_label(var[0])
-            if var[1] in ["jump_table", "pointers"]:
-                for i in range(var[2]):
-                    ptr = self.read_word(var_addr + 2*i)
+        for var in self.symbols.variables():
+            self.symbols.labeled.add(var.address)
+            if var.kind in ["jump_table", "pointers"]:
+                for i in range(var.length):
+                    ptr = self.read_word(var.address + 2*i)
+                    if ptr is None:
+                        continue
                     to_register.append(ptr)
-                    if var[1] == "jump_table":
+                    if var.kind == "jump_table":
                         self.schedule_entry_point(ptr, needs_label=True)
 
         for ptr in to_register:
             print("Register pointer %04X" % ptr)
-            if ptr not in self.variables.keys():
-                self.variables[ptr] = ("LABEL_%04X" % ptr, "label")
-            self.register_label(ptr)
+            self.register_pointer(ptr)
 
-        for s in subroutines:
+        for s in subroutines or {}:
             self.schedule_entry_point(s, needs_label=True)
 
 
+    def register_pointer(self, ptr):
+        ''' Labels <ptr>, an entry of a table of pointers,
+            so that the table is listed with its name.
+        '''
+        symbol = self.symbols.get(ptr)
+        if symbol is None:
+            self.symbols.define(ptr, "LABEL_%04X" % ptr, VARIABLE, kind="label")
+        elif symbol.kind is None:
+            symbol.kind = "label"
+        self.symbols.labeled.add(ptr)
+
+
+    def mark_declared_data(self):
+        for var in self.symbols.variables():
+            if var.kind == "str":
+                length = var.length
+            elif var.kind == "n-1_str":
+                length = self.read_byte(var.address)
+            elif var.kind in ["jump_table", "pointers"]:
+                length = 2 * var.length
+            else:
+                continue
+            for addr in range(var.address, var.address + length):
+                self.visited_ranges.mark(addr, DATA)
+
+
     def read_word(self, addr):
-        value = self.read_byte(addr)
-        value = value | (self.read_byte(addr+1) << 8)
-        return value
+        low = self.read_byte(addr)
+        high = self.read_byte(addr+1)
+        if low is None or high is None:
+            return None
+        return low | (high << 8)
 
 
     def read_byte(self, addr):
-        reloc_index, physical_address = self.rom_address(addr)
+        location = self.rom_address(addr)
+        if location is None:
+            return None
+        reloc_index, physical_address = location
         return self.rom[reloc_index][physical_address]
 
 
     def register_label(self, address):
-        if address not in self.labeled_addresses:
-            self.labeled_addresses.append(address)
-
-
-    def read_rom(self, filename):
-        rom_file = open(filename, "rb")
-        if self.relocation_blocks:
-            self.rom = []
-            for reloc_from, reloc_to, length in self.relocation_blocks:
-                rom_file.seek(reloc_from)
-                binary_data = rom_file.read(length)
-                self.rom.append(binary_data)
+        self.symbols.labeled.add(address)
+        self.traced_labels.add(address)
+
+
+    def read_rom(self, romfile):
+        ''' Loads the binary image without copying it.
+            <romfile> may be a filename, in which case the file is
+            memory-mapped, or any object supporting the buffer protocol
+            (bytes, bytearray, memoryview, mmap...) already holding the image.
+            Each relocation block is then exposed as a memoryview slice.
+        '''
+        if isinstance(romfile, (bytes, bytearray, memoryview, mmap.mmap)):
+            image = memoryview(romfile)
         else:
-            self.rom = [rom_file.read()]
-            self.relocation_blocks = (0x0000, 0x0000, len(self.rom[0]))
-        rom_file.close()
+            with open(romfile, "rb") as rom_file:
+                try:
+                    image = memoryview(mmap.mmap(rom_file.fileno(), 0,
+                                                 access=mmap.ACCESS_READ))
+                except ValueError: # empty files cannot be mapped
+                    image = memoryview(rom_file.read())
+        if image.format != "B":
+            image = image.cast("B")
+        self.image = image
+
+        if not self.relocation_blocks:
+            self.relocation_blocks = ((0x0000, 0x0000, len(image)),)
+        self.rom = [image[reloc_from:reloc_from + length]
+                    for reloc_from, reloc_to, length in self.relocation_blocks]
 
 
 ### Public method to start the binary code interpretation ###
-    def run(self, entry_points=[0x0000]):
-        for p in entry_points:
-            self.schedule_entry_point(p, needs_label=True)
+    def run(self, entry_points=[0x0000], cache_dir=None, processes=None,
+            resolve_jumps=False):
+        ''' Maps all code reachable from <entry_points>.
+            Given a <cache_dir>, the results are saved there and later
+            runs on the same image reuse them (see exectrace.cache).
+            Given a number of <processes>, see crawl().
+            With <resolve_jumps>, the code reached through the computed
+            jumps that resolve_computed_jumps() works out is mapped too.
+        '''
+        if cache_dir is not None:
+            from exectrace.cache import TraceCache
+            TraceCache(cache_dir).run(self, entry_points, processes)
+        else:
+            for p in entry_points:
+                self.schedule_entry_point(p, needs_label=True)
+            self.crawl(processes)
+
+        if resolve_jumps:
+            self.resolve_computed_jumps(processes=processes)
+
+
+    def resolve_computed_jumps(self, max_rounds=8, processes=None):
+        ''' Works out where the computed jumps of the code found so far go
+            (see exectrace.resolve), declares the tables of pointers they
+            go through and crawls their targets. As the new code may hold
+            more of them, this is repeated up to <max_rounds> times, until
+            no new target turns up. Returns a dict mapping the address of
+            each resolved jump to the list of its targets.
+        '''
+        from exectrace.resolve import JumpResolver
+        if self.jump_resolver is None:
+            self.jump_resolver = JumpResolver(self)
+        for _ in range(max_rounds):
+            if not self.jump_resolver.resolve():
+                break
+            self.crawl(processes)
+        return self.jump_resolver.resolved
+
+
+    def find_pointer_tables(self, min_length=4, min_score=None, schedule=False):
+        ''' Looks for tables of pointers among the bytes not known as code
+            or data yet (see exectrace.tables), and returns them as a list
+            of TableCandidate objects, whose variable() tells how to declare
+            them among the <variables> of a trace. <min_score> defaults to
+            exectrace.tables.BLOCK_START. With <schedule>, they get declared
+            right away, and the targets of the jump tables get scheduled
+            as entry points for crawl() to explore.
+        '''
+        from exectrace.tables import BLOCK_START, find_tables, declare_table
+        if min_score is None:
+            min_score = BLOCK_START
+        candidates = find_tables(self, min_length, min_score)
+        if schedule:
+            for candidate in candidates:
+                declare_table(self, candidate)
+        return candidates
+
+
+    def crawl(self, processes=None):
+        ''' Explores the pending entry points until none is left.
+            Given a number of <processes>, the code reachable from the
+            pending entry points is first decoded by that many workers.
+            The crawl then replays their work instead of decoding, so
+            its results are exactly those of a serial crawl.
+        '''
+        if processes is not None and processes > 1:
+            from exectrace.parallel import predecode
+            self.predecoded = predecode(self, processes)
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.crawl_started(self)
 
         self.restart_from_another_entry_point()
-        self.register_label(self.current_entry_point)
+        if self.PC is not None:
+            self.register_label(self.current_entry_point)
 
         while self.PC is not None:
+            if self.explore_block():
+                self.restart_from_another_entry_point()
+            else:
+                self.PC = None  # This will finish the crawling
+            if metrics is not None:
+                metrics.block_explored(self)
+
+        self.predecoded = {}
+        if metrics is not None:
+            metrics.crawl_finished(self)
+
+
+    def enable_metrics(self, opcode_timing=False, progress=None, interval=1.0):
+        ''' Starts keeping the CrawlMetrics of the trace, which are
+            returned and also kept as self.metrics. <progress>, if given,
+            gets called with a snapshot of them every <interval> seconds
+            during the crawl. With <opcode_timing>, the time spent
+            decoding each opcode family is measured as well.
+        '''
+        self.metrics = CrawlMetrics(opcode_timing, progress, interval)
+        self.metrics.attach(self)
+        return self.metrics
+
+
+    def propagate(self, state, address, entry):
+        ''' Updates <state>, mapping names of registers to the values
+            defined in exectrace.resolve, with what the instruction at
+            <address>, decoded as <entry>, does to them. Decoders that
+            do not tell forget everything they knew.
+        '''
+        state.clear()
+
+
+    def branch_state(self, state, address, entry, taken):
+        ''' Returns the state after the conditional branch or return at
+            <address> when it is <taken> or not, from <state> right after
+            it, which it may update, or None if that cannot happen.
+            Decoders may narrow the values the condition compared.
+        '''
+        return state
+
+
+    def jump_value(self, state, address, entry):
+        ''' Returns the value, as defined in exectrace.resolve, of where
+            the computed jump at <address> goes to given <state>, or None
+            if it is no computed jump (such as a "ret").
+        '''
+        return None
+
+
+    def opcode_family(self, address, opcode):
+        ''' Names the group of instructions that the one at <address>,
+            starting with <opcode>, is timed in by CrawlMetrics. Decoders
+            with prefixes or opcode extensions override it.
+        '''
+        return "%02X" % opcode
+
+
+    def explore_block(self):
+        ''' Decodes the code block starting at the current entry point
+            up to its last instruction. Then closes the block and
+            schedules the entry points it leads to. Returns False if
+            the whole crawl must stop there.
+        '''
+        predecoded = self.predecoded
+        while True:
             address = self.PC
-            try:
+            self.flow = None
+            self.fetch_failed_at = None
+            fetched = self.fetched
+            entry = None
+            if predecoded and address in predecoded:
+                entry = self.replay_instruction(address, predecoded[address])
+            if entry is None:
                 opcode = self.fetch()
-                self.disasm[address] = self.disasm_instruction(opcode)
-                self.log(DEBUG, hex(address) + ": " + self.disasm[address])
-            except AddressAlreadyVisited:
-                self.log(VERBOSE, "ALREADY BEEN AT {}!".format(hex(self.PC)))
-                self.log(DEBUG, "pending_entry_points: {}".format(self.pending_entry_points))
-                if self.PC > self.current_entry_point:
-                    self.add_range(start=self.current_entry_point,
-                                   end=self.PC-1,
-                                   needs_label=self.current_entry_point_needs_label,
-                                   exit=[self.PC])
-                self.restart_from_another_entry_point()
+                if self.fetch_failed_at is None:
+                    entry = self.disasm_instruction(opcode)
+            if self.fetch_failed_at is not None:
+                self.interrupt_block(self.fetch_failed_at, address)
+                self.fetch_failed_at = None
+                return True
+
+            self.disasm[address] = entry
+            if address < len(self.lengths):
+                self.lengths[address] = self.fetched - fetched
+            self.visited_ranges.mark(address, OPCODE)
+            if self.loglevel >= DEBUG or self.recent_events is not None:
+                self.log(DEBUG, "{:#x}: {}", address, _Rendered(self, entry))
+            if self.flow is not None:
+                self.flows[address] = (self.flow, self.flow_target)
+                return self.end_block()
+
+
+    def replay_instruction(self, address, record):
+        ''' Redoes the decoding of the instruction at <address>
+            from the (entry, length, calls) <record> of a worker,
+            without fetching it. Returns None if the instruction
+            overlaps visited code, so that fetch() deals with it.
+        '''
+        entry, length, calls = record
+        state = self.visited_ranges.state
+        for byte_address in range(address, address + length):
+            if state[byte_address] & CODE:
+                return None
+        self.PC = address + length
+        self.fetched += length
+        for name, args, kwargs in calls:
+            getattr(self, name)(*args, **kwargs)
+        return entry
+
+
+    def get_state(self):
+        ''' Returns the results of the crawl as plain Python objects,
+            so that they can be saved and handed back to set_state().
+            Subclasses keeping results of their own extend it.
+        '''
+        return {
+            "blocks": [(codeblock.start,
+                        codeblock.end,
+                        codeblock.next_block,
+                        codeblock.needs_label,
+                        codeblock.subroutines) for codeblock in self.visited_ranges],
+            "splits": self.visited_ranges.splits,
+            "disasm": self.disasm,
+            "lengths": bytes(self.lengths),
+            "flows": self.flows,
+            "labels": self.traced_labels,
+            "external_targets": self.external_targets,
+            "pending": list(self.pending_entry_points),
+        }
+
+
+    def set_state(self, state):
+        ''' Replaces the results of the crawl by a previously saved state.
+            Everything derived from the declared symbols is kept as is.
+        '''
+        self.visited_ranges = BlockStore(self.visited_ranges.size)
+        for start, end, next_block, needs_label, subroutines in state["blocks"]:
+            codeblock = CodeBlock(start, end, next_block, needs_label)
+            codeblock.subroutines = subroutines
+            self.visited_ranges.add(codeblock)
+        self.visited_ranges.splits = state["splits"]
+        self.address_map = self.visited_ranges.state
+        self.mark_declared_data()
+
+        self.disasm = state["disasm"]
+        for address in self.disasm:
+            self.visited_ranges.mark(address, OPCODE)
+        self.lengths = bytearray(state["lengths"])
+        self.flows = state["flows"]
+
+        self.traced_labels = set(state["labels"])
+        self.symbols.labeled |= self.traced_labels
+        self.external_targets = set(state["external_targets"])
+
+        self.pending_entry_points = EntryPointQueue(self.pending_entry_points.order)
+        for address, needs_label in state["pending"]:
+            self.pending_entry_points.push(address, needs_label)
 
 
     def getVariableName(self, addr):
-        if addr in self.variables.keys():
-            return self.variables[addr][0]
-        else:
-            return hex16(addr)
+        return self.symbols.value(addr)
 
 
     def getLabelName(self, addr, prefix="LABEL_"):
-        if addr in self.variables.keys():
-            return self.variables[addr][0]
-        elif addr in self.labels.keys():
-            return self.labels[addr]
-        else:
-            return "%s%04X" % (prefix, addr)
+        return self.symbols.label(addr, prefix)
 
 
 ### Methods for declaring the behaviour of branching instructions ###
+# They only take note of it. The code block gets closed by end_block()
+# once the whole instruction is decoded.
     def subroutine(self, address):
-        self.add_range(start=self.current_entry_point,
-                       end=self.PC-1,
-                       exit=[self.PC, address],
-                       needs_label=self.current_entry_point_needs_label)
-        self.schedule_entry_point(self.PC, needs_label=False)
-        self.schedule_entry_point(address, needs_label=True)
-
-        self.log(VERBOSE, "CALL SUBROUTINE ({})".format(hex(address)))
-        self.log_status()
-        self.restart_from_another_entry_point()
+        self.flow, self.flow_target = CALL, address
 
     def return_from_subroutine(self):
-        self.add_range(start=self.current_entry_point,
-                       end=self.PC-1,
-                       exit=[],
-                       needs_label=self.current_entry_point_needs_label)
-        self.log(VERBOSE, "RETURN FROM SUBROUTINE")
-        self.log_status()
-        self.restart_from_another_entry_point()
+        self.flow, self.flow_target = RETURN, None
+
+    def conditional_return(self):
+        # The target of a conditional return is where it falls through to:
+        self.flow, self.flow_target = RETURN, self.PC
 
     def conditional_branch(self, address):
-        self.log(VERBOSE, "CONDITIONAL BRANCH to {}".format(hex(address)))
-        self.branch(address, conditional=True)
+        self.flow, self.flow_target = BRANCH, address
 
     def unconditional_jump(self, address):
-        self.log(VERBOSE, "UNCONDITIONAL JUMP to {}".format(hex(address)))
-        self.branch(address, conditional=False)
+        self.flow, self.flow_target = JUMP, address
+
+    def illegal_instruction(self, opcode):
+        self.flow, self.flow_target = ILLEGAL, None
+        self.illegal_opcode = opcode
+
+### Private methods for computing the code-execution graph structure ###
+    def end_block(self):
+        ''' Closes the current code block after the instruction that
+            ends it and schedules its successors. Returns False if it
+            was an illegal instruction, which finishes the crawling.
+        '''
+        address = self.flow_target
+        if self.flow == CALL:
+            self.add_range(start=self.current_entry_point,
+                           end=self.PC-1,
+                           exit=[self.PC, address],
+                           needs_label=self.current_entry_point_needs_label)
+            self.schedule_entry_point(self.PC, needs_label=False)
+            self.schedule_entry_point(address, needs_label=True)
+            self.log(VERBOSE, "CALL SUBROUTINE ({:#x})", address)
+            self.log_status()
+        elif self.flow == RETURN:
+            self.add_range(start=self.current_entry_point,
+                           end=self.PC-1,
+                           exit=[] if address is None else [address],
+                           needs_label=self.current_entry_point_needs_label)
+            if address is not None:
+                self.schedule_entry_point(address, needs_label=False)
+            self.log(VERBOSE, "RETURN FROM SUBROUTINE")
+            self.log_status()
+        elif self.flow == BRANCH:
+            self.log(VERBOSE, "CONDITIONAL BRANCH to {:#x}", address)
+            self.branch(address, conditional=True)
+        elif self.flow == JUMP:
+            self.log(VERBOSE, "UNCONDITIONAL JUMP to {:#x}", address)
+            self.branch(address, conditional=False)
+        else: # ILLEGAL
+            self.add_range(start=self.current_entry_point,
+                           end=self.PC-1,
+                           exit=["Illegal Opcode: {}".format(hex(self.illegal_opcode))],
+                           needs_label=self.current_entry_point_needs_label)
+            self.log(ERROR, "[{:#x}] ILLEGAL: {:#x}", self.PC-1, self.illegal_opcode)
+            self.dump_recent_events()
+            return False
+        return True
 
     def branch(self, address, conditional):
         if self.current_entry_point_needs_label:
             self.register_label(address)
+        # Only a conditional branch may go on with the next instruction:
+        exits = [self.PC, address] if conditional else [address]
         if address > self.current_entry_point and address < self.PC:
             self.add_range(start=self.current_entry_point,
                            end=address-1,
@@ -241,59 +1152,83 @@ class ExecTrace():
                            needs_label=self.current_entry_point_needs_label)
             self.add_range(start=address,
                            end=self.PC-1,
-                           exit=[self.PC, address],
+                           exit=exits,
                            needs_label=True)
             if conditional:
                 self.schedule_entry_point(self.PC, needs_label=False)
         else:
             self.add_range(start=self.current_entry_point,
                            end=self.PC-1,
-                           exit=[self.PC, address],
+                           exit=exits,
                            needs_label=self.current_entry_point_needs_label)
             if conditional:
                 self.schedule_entry_point(self.PC, needs_label=False)
             self.schedule_entry_point(address, needs_label=True)
 
-        self.log_ranges()
-        self.restart_from_another_entry_point()
-
-    def illegal_instruction(self, opcode):
-        self.add_range(start=self.current_entry_point,
-                       end=self.PC-1,
-                       exit=["Illegal Opcode: {}".format(hex(opcode))],
-                       needs_label=self.current_entry_point_needs_label)
-        self.log(ERROR, "[{}] ILLEGAL: {}".format(hex(self.PC-1), hex(opcode)))
-        self.PC = None  # This will finish the crawling
-        # sys.exit(-1)
+    def interrupt_block(self, address, instruction):
+        ''' Closes the current code block right before the instruction
+            at <instruction>, whose byte at <address> could not be
+            fetched. The bytes already fetched of that instruction are
+            left out of the block, so that the listing keeps them as
+            data instead of losing them. '''
+        if self.rom_address(address) is None:
+            self.log(VERBOSE, "{:#x} IS NOT MAPPED!", address)
+            # Entry points out of the image (such as calls to a BIOS)
+            # are expected, but code running into them is suspicious:
+            if address != self.current_entry_point:
+                self.dump_recent_events()
+        else:
+            self.log(VERBOSE, "ALREADY BEEN AT {:#x}!", address)
+            if self.loglevel >= DEBUG:
+                self.log(DEBUG, "pending_entry_points: {}", list(self.pending_entry_points))
+        if instruction > self.current_entry_point:
+            self.add_range(start=self.current_entry_point,
+                           end=instruction-1,
+                           needs_label=self.current_entry_point_needs_label,
+                           exit=[address])
+
+    def external_region(self, address):
+        ''' Returns the ExternalRegion that <address> belongs to, or None
+            if it belongs to none or the image maps it.
+        '''
+        index = bisect_right(self._external_starts, address) - 1
+        if index >= 0:
+            region = self.external_regions[index]
+            if address <= region.end and self.rom_address(address) is None:
+                return region
+        return None
+
+    def external_stubs(self):
+        ''' Returns the "equ" lines defining the addresses of external
+            regions that the code reaches, for output_disasm_headers().
+            Declared subroutines are left to it.
+        '''
+        lines = []
+        for address in sorted(self.external_targets):
+            symbol = self.symbols.get(address)
+            if symbol is not None and symbol.type == SUBROUTINE:
+                continue
+            line = "%s:\tequ %s" % (self.getLabelName(address), hex16(address))
+            if symbol is not None and symbol.comment:
+                line += "\t; %s" % symbol.comment
+            lines.append(line + "\n")
+        return "".join(lines)
 
-### Private methods for computing the code-execution graph structure ###
     def already_visited(self, address):
         if self.PC is not None:
             if address >= self.current_entry_point and address < self.PC:
-                self.log(DEBUG, "RECENTLY: (PC={} address={})".format(hex(self.PC), hex(address)))
+                self.log(DEBUG, "RECENTLY: (PC={:#x} address={:#x})", self.PC, address)
                 return True
 
-        for codeblock in self.visited_ranges:
-            if address >= codeblock.start and address <= codeblock.end:
-                self.log(DEBUG, "ALREADY VISITED: {}".format(hex(address)))
-                if address > codeblock.start:
-                    # split the block into two:
-                    new_block = CodeBlock(start=codeblock.start,
-                                          end=address-1,
-                                          next_block=[address],
-                                          needs_label=codeblock.needs_label)
-                    codeblock.start = address
-                    codeblock.needs_label = True
-                    # and also split ownership of subroutine calls:
-                    for instr_addr, call_addr in codeblock.subroutines.items():
-                        if instr_addr < address:
-                            new_block.add_subroutine_call(instr_addr, call_addr)
-                            del codeblock.subroutines[instr_addr]
-                    self.visited_ranges.append(new_block)
-                return True
+        codeblock = self.visited_ranges.find(address)
+        if codeblock is None:
+            return False
 
-        # otherwise:
-        return False
+        self.log(DEBUG, "ALREADY VISITED: {:#x}", address)
+        if address > codeblock.start:
+            # split the block into two:
+            self.visited_ranges.split(codeblock, address)
+        return True
 
     def restart_from_another_entry_point(self):
         if len(self.pending_entry_points) == 0:
@@ -302,57 +1237,83 @@ class ExecTrace():
             address, self.current_entry_point_needs_label = self.pending_entry_points.pop()
             self.current_entry_point = address
             self.PC = address
-            self.log(VERBOSE, "Restarting from: {}".format(hex(address)))
+            self.log(VERBOSE, "Restarting from: {:#x}", address)
 
     def add_range(self, start, end, needs_label, exit=None):
         if end < start:
-            self.add_range(end, start, exit, needs_label)
-            return
+            start, end = end, start
 
-        self.log(DEBUG, f"=== New Range: start: {hex(start)}  end: {hex(end)} needs_label: {needs_label}===")
+        self.log(DEBUG, "=== New Range: start: {:#x}  end: {:#x} needs_label: {}===", start, end, needs_label)
         block = CodeBlock(start, end, exit, needs_label)
-        self.visited_ranges.append(block)
+        self.visited_ranges.add(block)
 
     def schedule_entry_point(self, address, needs_label):
+        if self.fetch_failed_at is not None:
+            return  # asked by a decoder working on bytes it could not fetch
+
+        if self._external_starts and self.external_region(address) is not None:
+            self.external_targets.add(address)
+            return
+
         if self.already_visited(address):
-            #FIXME: I think the same address can be referenced needing a label
+            # The same address can be referenced needing a label
             # even after it was already visited once not originally needing a label.
+            if needs_label:
+                self.register_label(address)
             return
 
-        for ep, _ in self.pending_entry_points:
-            if ep == address:
-                return
+        if not self.pending_entry_points.push(address, needs_label):
+            return
 
-        self.pending_entry_points.append((address, needs_label))
-        self.log(VERBOSE, "SCHEDULING: {}".format(hex(address)))
+        self.log(VERBOSE, "SCHEDULING: {:#x}", address)
         self.log_status()
 
 
     def fetch(self):
-        if self.already_visited(self.PC):
-            raise AddressAlreadyVisited
-        else:
-            try:
-                index, offset = self.rom_address(self.PC)
-                value = self.rom[index][offset]
-            except:
-                #print("ROM index = %d / offset = %04X" % (index, offset))
-                #sys.exit("Cannot fetch at PC=%s" % hex16(self.PC))
-                self.restart_from_another_entry_point()
-                value = self.fetch()
-                # TODO: fix MSX BIOS calls reaching this condition.
-
-        self.log(DEBUG, "Fetch at {}: {}".format(hex(self.PC), hex(value)))
+        if self.fetch_failed_at is not None:
+            return 0
+
+        location = None
+        if not self.already_visited(self.PC):
+            location = self.rom_address(self.PC)
+        if location is None:
+            self.fetch_failed_at = self.PC
+            return 0
+
+        index, offset = location
+        value = self.rom[index][offset]
+        if self.loglevel >= DEBUG or self.recent_events is not None:
+            self.log(DEBUG, "Fetch at {:#x}: {:#x}", self.PC, value)
         self.PC += 1
+        self.fetched += 1
         return value
 
 
 
 ####### LOGGING #######
 
-    def log(self, loglevel, msg):
+    def log(self, loglevel, msg, *args):
+        ''' Prints <msg> if <loglevel> is enabled. The <args> are only
+            formatted into it (with str.format) when it gets printed.
+        '''
+        if self.recent_events is not None:
+            self.recent_events.append((loglevel, msg, args))
         if self.loglevel >= loglevel:
-            print(msg)
+            print(msg.format(*args) if args else msg)
+
+    def dump_recent_events(self):
+        ''' Prints the messages kept by the ring buffer of recent events,
+            whatever their level, and empties it. This is done when the
+            trace goes wrong, so that there is no need to run it again
+            with DEBUG messages enabled to find out how it got there.
+        '''
+        if not self.recent_events:
+            return
+
+        print("Last {} trace events:".format(len(self.recent_events)))
+        for loglevel, msg, args in self.recent_events:
+            print("  " + (msg.format(*args) if args else msg))
+        self.recent_events.clear()
 
     def log_status(self):
         if self.loglevel < VERBOSE:
@@ -367,7 +1328,7 @@ class ExecTrace():
             return
 
         results = []
-        for codeblock in sorted(self.visited_ranges, key=lambda cb: cb.start):
+        for codeblock in self.visited_ranges:
             results.append(f"[start: {hex(codeblock.start)},"
                            f" end: {hex(codeblock.end)}]")
         results = "\n  ".join(results)
@@ -385,189 +1346,363 @@ class ExecTrace():
 
     def get_grouped_ranges(self):
         grouped = []
-        current = None
-        for codeblock in sorted(self.visited_ranges, key=lambda cb: cb.start):
-            if current == None:
-                current = [codeblock.start, codeblock.end]
-                continue
-
-            # FIX-ME: There's something bad going on here!!!
-            if codeblock.start == current[1] or \
-               codeblock.start == (current[1] + 1):
-                current[1] = codeblock.end
-                continue
-#      print (">>> codeblock.start: {} current[1]: {}\n".format(hex(codeblock.start),
-#                                                               hex(current[1])))
-            grouped.append(current)
-            current = [codeblock.start, codeblock.end]
-            return grouped
+        for _, reloc_to, length in self.relocation_blocks:
+            for start, end in self.visited_ranges.runs(reloc_to, reloc_to + length, CODE):
+                grouped.append([start, end])
+        return grouped
+
+
+    def instruction_length(self, address):
+        if address < len(self.lengths):
+            return self.lengths[address]
+        return 1
+
+    def iter_instructions(self, start=0, end=None):
+        ''' Lazily yields, in address order, Instruction records
+            for the instructions decoded within the code blocks
+            lying entirely within the [start, end] address range.
+        '''
+        if end is None:
+            end = max(reloc_to + length
+                      for _, reloc_to, length in self.relocation_blocks) - 1
+        for codeblock in self.visited_ranges.blocks_in(start, end + 1):
+            address = codeblock.start
+            while address <= codeblock.end:
+                entry = self.disasm.get(address)
+                if entry is None:
+                    address += 1
+                    continue
+                length = self.instruction_length(address)
+                flow, target = self.flows.get(address, (None, None))
+                yield Instruction(address, length, entry, flow, target)
+                address += length
+
+
+    def address_state(self, address):
+        ''' Classifies a single byte as "opcode", "operand",
+            "data" or "unknown".
+        '''
+        if 0 <= address < self.visited_ranges.size:
+            flags = self.address_map[address]
+            if flags & CODE:
+                return "opcode" if flags & OPCODE else "operand"
+            if flags & DATA:
+                return "data"
+        return "unknown"
+
+
+    def coverage(self):
+        ''' Returns the code/data coverage of every relocation
+            block as a list of (start, end, kind) runs, where
+            kind is one of "code", "data" or "unknown".
+        '''
+        kinds = {b"c": "code", b"d": "data", b"u": "unknown"}
+        table = bytes(ord("c") if b & CODE else
+                      ord("d") if b & DATA else
+                      ord("u") for b in range(256))
+        results = []
+        for _, reloc_to, length in self.relocation_blocks:
+            start = max(reloc_to, 0)
+            end = min(reloc_to + length, self.visited_ranges.size)
+            states = self.address_map[start:end].translate(table)
+            for run in re.finditer(rb"c+|d+|u+", states):
+                results.append((start + run.start(),
+                                start + run.end() - 1,
+                                kinds[run.group()[:1]]))
+        return results
+
+
+    def build_page_table(self):
+        ''' Precomputes the logical-to-physical address translation
+            as a table of pages, so that rom_address() costs O(1).
+
+            Pages are 256 bytes long unless some relocation block does
+            not start at a multiple of that, in which case they get as
+            small as needed. A block may end anywhere, even short of the
+            end of its last page: each page keeps how many of its bytes
+            are mapped.
+
+            A relocation block whose physical range was already mapped
+            by a previous block is a mirror: its pages point to the same
+            physical bytes and it is not emitted again in the listing.
+        '''
+        self.page_shift = 8
+        for _, reloc_to, length in self.relocation_blocks:
+            if reloc_to:
+                alignment = (reloc_to & -reloc_to).bit_length() - 1
+                self.page_shift = min(self.page_shift, alignment)
+        page_size = 1 << self.page_shift
+        self.page_mask = page_size - 1
+
+        top = max(reloc_to + length for _, reloc_to, length in self.relocation_blocks)
+        self.page_table = [None] * ((top >> self.page_shift) + 1)
+        self.mirrors = set()
+
+        for index, (reloc_from, reloc_to, length) in enumerate(self.relocation_blocks):
+            source_index, source_from = index, reloc_from
+            for prev_index, (prev_from, _, prev_length) in enumerate(self.relocation_blocks[:index]):
+                if (prev_index not in self.mirrors and
+                    reloc_from >= prev_from and
+                    reloc_from + length <= prev_from + prev_length):
+                    self.mirrors.add(index)
+                    source_index, source_from = prev_index, prev_from
+                    break
+
+            length = min(length, len(self.rom[index]))
+            for offset in range(0, length, page_size):
+                page = (reloc_to + offset) >> self.page_shift
+                self.page_table[page] = (source_index,
+                                         reloc_from - source_from + offset,
+                                         min(page_size, length - offset))
 
 
     def rom_address(self, logical_address):
-        for index, reloc in enumerate(self.relocation_blocks):
-            reloc_from, reloc_to, length = reloc
-            if (logical_address >= reloc_to and
-                logical_address < reloc_to + length):
-                offset = logical_address - reloc_to
-                return index, offset
-        sys.exit("The logical address %04X was not found on any relocation block." % logical_address)
+        ''' Returns a (reloc_index, offset) pair locating a logical
+            address in self.rom, or None if it is not mapped.
+        '''
+        if logical_address < 0:
+            return None
+        page = logical_address >> self.page_shift
+        if page >= len(self.page_table):
+            return None
+        entry = self.page_table[page]
+        if entry is None:
+            return None
+        reloc_index, page_offset, mapped = entry
+        offset = logical_address & self.page_mask
+        if offset >= mapped:
+            return None
+        return reloc_index, page_offset + offset
+
+
+    def read_bytes(self, address, length):
+        ''' Returns the <length> bytes starting at logical <address>,
+            read as whole slices of each page. The result is cut
+            short at the first address that is not mapped.
+        '''
+        chunks = []
+        end = address + length
+        while address < end:
+            location = self.rom_address(address)
+            if location is None:
+                break
+            reloc_index, offset = location
+            mapped = self.page_table[address >> self.page_shift][2]
+            count = min(end - address, mapped - (address & self.page_mask))
+            chunks.append(self.rom[reloc_index][offset:offset + count])
+            address += count
+        return b"".join(chunks)
 
 
     def save_disassembly_listing(self, filename="output.asm"):
+        ''' Writes the disassembly listing to <filename>,
+            which may also be an already open file-like object.
+        '''
+        if hasattr(filename, "write"):
+            filename.writelines(self.iter_disassembly_listing())
+        else:
+            with open(filename, "w") as asm:
+                asm.writelines(self.iter_disassembly_listing())
+
+
+    def export_jsonl(self, filename="output.jsonl"):
+        ''' Streams the blocks, edges, instructions and labels of the
+            trace to <filename> (or an open text file) as JSON Lines.
+            See exectrace.export for the records written.
+        '''
+        from exectrace.export import write_jsonl
+        if hasattr(filename, "write"):
+            write_jsonl(self, filename)
+        else:
+            with open(filename, "w") as output:
+                write_jsonl(self, output)
+
+
+    def export_binary(self, filename="output.extb"):
+        ''' Writes the same records as export_jsonl() to <filename>
+            (or an open binary file) as packed binary records, to be
+            queried with exectrace.export.BinaryExport.
+        '''
+        from exectrace.export import write_binary
+        if hasattr(filename, "write"):
+            write_binary(self, filename)
+        else:
+            with open(filename, "wb") as output:
+                write_binary(self, output)
+
+
+    def export_cfg(self, filename="output.gv", format=None,
+                   cluster_subroutines=False, max_nodes=None):
+        ''' Writes the control flow graph of the code blocks to
+            <filename> (or an open text file) as Graphviz DOT ("dot"),
+            GraphML ("graphml") or an adjacency list ("adjacency").
+            Unless given, <format> is guessed from the extension of
+            <filename>, defaulting to DOT.
+
+            With <cluster_subroutines>, the blocks of each subroutine
+            are grouped together. Graphs with more than <max_nodes>
+            nodes get their straight-line chains of blocks collapsed
+            into single nodes, so that they stay renderable.
+            See exectrace.cfg for the details.
+        '''
+        from exectrace import cfg
+        if format is None:
+            extension = ""
+            if not hasattr(filename, "write"):
+                extension = os.path.splitext(filename)[1].lower()
+            format = cfg.EXTENSIONS.get(extension, "dot")
+        write = cfg.WRITERS[format]
+        nodes = cfg.build_cfg(self, cluster_subroutines, max_nodes)
+        if hasattr(filename, "write"):
+            write(self, nodes, filename)
+        else:
+            with open(filename, "w") as output:
+                write(self, nodes, output)
+
+
+    def verify_listing(self):
+        ''' Checks that assembling the disassembly listing gives back
+            the bytes of the image, without writing it or running an
+            assembler: each decoded instruction is re-encoded with
+            encode_instruction() and each data directive of the listing
+            from its text. Returns the list of mismatches found, empty
+            if the listing is correct (see exectrace.verify).
+        '''
+        from exectrace.verify import verify_listing
+        return verify_listing(self)
+
+
+    def encode_instruction(self, address, entry):
+        ''' Returns the bytes an assembler would encode the decoded
+            instruction <entry> at <address> to, or None if it cannot
+            be encoded. Decoders supporting verify_listing() override it.
+        '''
+        return None
+
+
+    def iter_disassembly_listing(self):
+        ''' Generates the text of the disassembly listing in a single
+            pass over each relocation block, merging its code blocks
+            with the sorted addresses of the declared variables.
+        '''
+        variables = {var.address: var for var in self.symbols.variables()}
+        var_addrs = sorted(variables.keys())
+
+        yield self.output_disasm_headers()
+
+        for reloc_to, reloc_end, sections in self.iter_listing_sections():
+            yield "\n\n\torg %s\n" % hex16(reloc_to)
+            for start, end, codeblock in sections:
+                if codeblock is None:
+                    yield from self._iter_data_listing(start, end, variables, var_addrs)
+                else:
+                    yield self._code_listing(codeblock)
+
+
+    def iter_listing_sections(self):
+        ''' Yields a (reloc_to, reloc_end, sections) triple for every
+            relocation block in the listing, where <sections> lazily
+            yields, in address order, the (start, end, codeblock) sections
+            it is made of: a code block, or a run of data when <codeblock>
+            is None.
+        '''
+        for index, (reloc_from, reloc_to, reloc_length) in enumerate(self.relocation_blocks):
+            if index not in self.mirrors:
+                reloc_end = reloc_to + reloc_length
+                yield reloc_to, reloc_end, self._iter_sections(reloc_to, reloc_end)
+
+
+    def _iter_sections(self, reloc_to, reloc_end):
+        next_addr = reloc_to
+        for codeblock in self.visited_ranges.blocks_in(reloc_to, reloc_end):
+            if codeblock.start < next_addr: # Skip repeated blocks!
+                continue
 
-        var_addrs = sorted(self.variables.keys())
-
-        self.next_var = -1
-        def select_next_var_address(addr):
-            for var in var_addrs:
-                if var >= addr:
-                    self.next_var = var
-                    return
+            if codeblock.start > next_addr: # there's a block of data here
+                yield next_addr, codeblock.start, None
 
-        asm = open(filename, "w")
-        asm.write(self.output_disasm_headers())
+            # TODO: Maybe we need to ensure codeblocks do not cross relocation block boundaries
+            #       If so, we may need to split them at the boundaries.
+            yield codeblock.start, codeblock.end + 1, codeblock
+            next_addr = codeblock.end + 1
 
-        for reloc_from, reloc_to, reloc_length in self.relocation_blocks:
-            ranges = [r for r in sorted(self.visited_ranges, key=lambda cb: cb.start)
-                      if r.start >= reloc_to and r.end < reloc_to + reloc_length]
+        # The final block of data in the end of a ROM image:
+        if reloc_end > next_addr:
+            yield next_addr, reloc_end, None
 
-            asm.write("\n\n\torg %s\n" % hex16(reloc_to))
-            next_addr = reloc_to
 
-            # This is a hack to make the disasm output the final
-            # block of data in the end of a ROM image:
-            ranges.append(CodeBlock(start=reloc_to + reloc_length,
-                                    end=-1,
-                                    next_block=[]))
+    def _code_listing(self, codeblock):
+        if codeblock.start in self.symbols.labeled:
+            indent = "\n" + self.getLabelName(codeblock.start) + ":\n\t"
+        else:
+            indent = "\t"
+
+        lines = []
+        address = codeblock.start
+        while address <= codeblock.end:
+            entry = self.disasm.get(address)
+            if entry is None:
+                address += 1
+                continue
+            if entry.__class__ is not str:
+                entry = render(self, entry)
+            lines.append("%s%s\n" % (indent, entry))
+            indent = "\t"
+            address += self.instruction_length(address)
+        return "".join(lines)
+
+
+    def _iter_data_listing(self, start, end, variables, var_addrs):
+        indent = self.getLabelName(start) + ":\n\t"
+        addr = start
+        i = 0
+        while addr < end:
+            i = bisect_left(var_addrs, addr, i)
+            if i < len(var_addrs) and var_addrs[i] == addr:
+                var = variables[addr]
+                indent = "%s:\n\t" % var.name
+                if var.kind == "str":
+                    the_string = self.read_bytes(addr, var.length).decode("latin-1")
+                    yield '{}db "{}"\n'.format(indent, the_string)
+                    addr += var.length
+                    indent = self.getLabelName(addr) + ":\n\t"
+                    continue
 
-            for codeblock in ranges:
-                if codeblock.start < next_addr: # Skip repeated blocks!
+                elif var.kind == "n-1_str":
+                    n = self.read_byte(addr)
+                    the_string = self.read_bytes(addr + 1, n - 1).decode("latin-1")
+                    yield '{}db {}, "{}"\n'.format(indent, n, the_string)
+                    addr += 1 + max(n - 1, 0)
+                    indent = self.getLabelName(addr) + ":\n\t"
                     continue
 
-                if codeblock.start > next_addr: # there's a block of data here
-                    indent = self.getLabelName(next_addr) + ":\n\t"
-                    data = []
-                    addr = next_addr
-                    while addr < codeblock.start:
-                        select_next_var_address(addr)
-                        if addr == self.next_var:
-                            if len(data) > 0:
-                                asm.write("{}db {}\n".format(indent, ", ".join(data)))
-                                data = []
-                            var = self.variables[self.next_var]
-                            indent = "%s:\n\t" % var[0]
-#============================================================================
-                            if var[1] == "str":
-                                n = var[2]
-                                the_string = ""
-                                for i in range(n):
-                                    reloc_index, physical_address = self.rom_address(addr)
-                                    the_string += chr(self.rom[reloc_index][physical_address])
-                                    addr += 1
-                                asm.write('{}db "{}"\n'.format(indent, the_string))
-                                indent = self.getLabelName(addr) + ":\n\t"
-                                data = []
-                                continue
-#============================================================================
-                            elif var[1] == "n-1_str":
-                                reloc_index, physical_address = self.rom_address(addr)
-                                n = self.rom[reloc_index][physical_address]
-                                the_string = ""
-                                addr += 1
-                                for i in range(n-1):
-                                    reloc_index, physical_address = self.rom_address(addr)
-                                    the_string += chr(self.rom[reloc_index][physical_address])
-                                    addr += 1
-                                asm.write('{}db {}, "{}"\n'.format(indent, n, the_string))
-                                indent = self.getLabelName(addr) + ":\n\t"
-                                data = []
-                                continue
-#============================================================================
-                            if var[1] in ["jump_table", "pointers"]:
-                                n = var[2]
-                                asm.write("\n")
-                                for i in range(n):
-                                    reloc_index, physical_address = self.rom_address(addr)
-                                    jump_addr = self.rom[reloc_index][physical_address]
-                                    addr += 1
-                                    reloc_index, physical_address = self.rom_address(addr)
-                                    jump_addr = jump_addr | (self.rom[reloc_index][physical_address] << 8)
-                                    addr += 1
-                                    asm.write('{}dw {}\n'.format(indent, self.getLabelName(jump_addr)))
-                                    indent = "\t"
-                                indent = self.getLabelName(addr) + ":\n\t"
-                                data = []
-                                continue
-#============================================================================
-                        try:
-                            reloc_index, physical_address = self.rom_address(addr)
-                        except:
-                            if len(data) > 0:
-                                asm.write("{}db {}\n".format(indent, ", ".join(data)))
-                                data = []
-                                addr += 1
-                            continue
-
-                        try:
-                            data.append(hex8(self.rom[reloc_index][physical_address]))
-                        except:
-                            sys.exit("reloc_index={} physical_address={} rom_data_len={}".format(reloc_index,
-                                                                                                 physical_address,
-                                                                                                 len(self.rom[reloc_index])))
-                        if len(data) == 8:
-                            asm.write("{}db {}\n".format(indent, ", ".join(data)))
-                            indent = "\t"
-                            data = []
-                        addr += 1
-
-                    if len(data) > 0:
-                        asm.write("{}db {}\n".format(indent, ", ".join(data)))
-
-                # TODO: Maybe we need to ensure codeblocks do not cross relocation block boundaries
-                #       If so, we may need to split them at the boundaries.
-                address = codeblock.start
-                if address in self.labeled_addresses:
-                    indent = "\n" + self.getLabelName(address) + ":\n\t"
-                else:
-                    indent = "\t"
-                for address in range(codeblock.start, codeblock.end+1):
-                    if address in self.disasm:
-                        asm.write("%s%s\n" % (indent, self.disasm[address]))
+                elif var.kind in ["jump_table", "pointers"]:
+                    table = self.read_bytes(addr, 2 * var.length)
+                    lines = ["\n"]
+                    for offset in range(0, len(table) - 1, 2):
+                        jump_addr = table[offset] | (table[offset + 1] << 8)
+                        lines.append('{}dw {}\n'.format(indent, self.getLabelName(jump_addr)))
                         indent = "\t"
-                next_addr = codeblock.end + 1
-
-        asm.close()
-
-
-def generate_graph():
-    def block_name(block):
-        return "{}-{}".format(hex(block.start), hex(block.end))
-
-    import pydotplus
-    graph = pydotplus.graphviz.Graph(graph_name='Code Execution Graph',
-                             graph_type='digraph',
-                             strict=False,
-                             suppress_disconnected=False)
-    graph_dict = {}
-    for block in self.visited_ranges:
-        node = pydotplus.graphviz.Node(block_name(block))
-        graph.add_node(node)
-        graph_dict[block.start] = node
-
-    for block in self.visited_ranges:
-        for nb in block.next_block:
-            if nb is str:
-                print (nb)  # this must be an illegal instruction
-            else:
-                if nb in graph_dict.keys():
-                    edge = pydotplus.graphviz.Edge(graph_dict[block.start], graph_dict[nb])
-                    graph.add_edge(edge)
-                else:
-                    print (f"Missing codeblock: {hex(nb)}")
-
-    open("output.gv", "w").write(graph.to_string())
+                    yield "".join(lines)
+                    addr += 2 * var.length
+                    indent = self.getLabelName(addr) + ":\n\t"
+                    continue
 
-    #from graphviz import Digraph
-    #dot = Digraph(comment='Code Execution Graph')
-    #dot.render('test-output/round-table.gv', view=True)
+                i += 1
 
+            # plain bytes up to the next variable:
+            if i < len(var_addrs) and var_addrs[i] < end:
+                stop = var_addrs[i]
+            else:
+                stop = end
+            data = self.read_bytes(addr, stop - addr)
+            lines = []
+            for offset in range(0, len(data), 8):
+                chunk = data[offset:offset + 8]
+                lines.append("{}db {}\n".format(indent, ", ".join([_HEX8[b] for b in chunk])))
+                if len(chunk) == 8:
+                    indent = "\t"
+            yield "".join(lines)
+            addr += len(data)
+            if addr < stop: # skip an address that is not mapped
+                addr += 1
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Traces a whole corpus of images in a pool of worker processes.
+#
+# usage: python -m exectrace.batch <manifest.json> [-j JOBS] [-o OUTPUT_DIR]
+#
+# The manifest is a JSON object like this one:
+#
+#   {
+#     "output_dir": "listings",
+#     "jobs": [
+#       {"image": "galaga.rom",
+#        "platform": "msx",
+#        "relocation_blocks": [[0, "0x4000", "0x2000"]],
+#        "entry_points": ["0x4010"],
+#        "variables": {"0xE000": ["SCORE", "label"]},
+#        "subroutines": {"0x4123": ["INIT", "sets up the VDP"]},
+#        "stack_whitelist": ["0x5A12"]},
+#       {"image": "prog.exe",
+#        "platform": "msdos"}
+#     ]
+#   }
+#
+# Addresses may be given either as numbers or as strings like "0x4010".
+# A job may also set "loglevel", "scheduling" and "recent_events" (the
+# size of the ring buffer dumped into its log when the trace goes wrong).
+# Image paths are relative to the manifest. A DOS job without entry
+# points or relocation blocks takes them from the MZ header of its image.
+#
+# Each job writes <name>.asm and <name>.log (whatever the trace printed)
+# into the output directory, where <name> defaults to the image file name
+# without its extension. Names must be unique within a manifest, so images
+# of the same file name need a "name" of their own. The summary of all jobs
+# goes into summary.json, along with any job whose worker process died.
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from exectrace import ERROR, DFS, ILLEGAL
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+PLATFORMS = {
+    "msx": ("exectrace.msx", "MSX_Trace"),
+    "msdos": ("exectrace.msdos", "MSDOS_Trace"),
+}
+
+SUMMARY_COLUMNS = [("name", "%-24s"),
+                   ("status", "%-6s"),
+                   ("blocks", "%7s"),
+                   ("instructions", "%12s"),
+                   ("illegal_opcodes", "%7s"),
+                   ("jump_HLs", "%8s"),
+                   ("runtime", "%8s"),
+                   ("peak_rss_kb", "%11s")]
+
+
+def parse_address(value):
+    if isinstance(value, str):
+        return int(value, 0)
+    return value
+
+
+def parse_job(job, base_dir):
+    ''' Turns a manifest entry into the arguments of a trace. '''
+    image = os.path.join(base_dir, job["image"])
+    return {
+        "name": job.get("name", os.path.splitext(os.path.basename(image))[0]),
+        "image": image,
+        "platform": job.get("platform", "msx"),
+        "loglevel": job.get("loglevel", ERROR),
+        "recent_events": job.get("recent_events", 0),
+        "scheduling": job.get("scheduling", DFS),
+        "relocation_blocks": [tuple(parse_address(v) for v in block)
+                              for block in job.get("relocation_blocks", [])] or None,
+        "entry_points": [parse_address(p) for p in job.get("entry_points", [])],
+        "variables": {parse_address(addr): tuple(var)
+                      for addr, var in job.get("variables", {}).items()},
+        "subroutines": {parse_address(addr): tuple(sub) if isinstance(sub, list) else sub
+                        for addr, sub in job.get("subroutines", {}).items()},
+        "stack_whitelist": [parse_address(addr) for addr in job.get("stack_whitelist", [])],
+    }
+
+
+def load_manifest(filename):
+    with open(filename) as manifest_file:
+        manifest = json.load(manifest_file)
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    jobs = [parse_job(job, base_dir) for job in manifest["jobs"]]
+    images = {}
+    for job in jobs:
+        if job["name"] in images:
+            raise ValueError("Jobs for %s and %s are both named %r; give them a \"name\""
+                             % (images[job["name"]], job["image"], job["name"]))
+        images[job["name"]] = job["image"]
+    output_dir = os.path.join(base_dir, manifest.get("output_dir", "."))
+    return jobs, output_dir
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024  # reported in bytes rather than kilobytes
+    return peak
+
+
+def make_trace(job):
+    module_name, class_name = PLATFORMS[job["platform"]]
+    module = __import__(module_name, fromlist=[class_name])
+    trace_class = getattr(module, class_name)
+
+    entry_points = job["entry_points"]
+    relocation_blocks = job["relocation_blocks"]
+    if job["platform"] == "msdos" and not (entry_points and relocation_blocks):
+        mz = module.read_mz_header(job["image"])
+        entry_points = entry_points or [mz["entry_point"]]
+        relocation_blocks = relocation_blocks or mz["relocation_blocks"]
+
+    trace = trace_class(job["image"],
+                        loglevel=job["loglevel"],
+                        relocation_blocks=relocation_blocks,
+                        variables=job["variables"],
+                        subroutines=job["subroutines"],
+                        stack_whitelist=job["stack_whitelist"],
+                        scheduling=job["scheduling"],
+                        recent_events=job["recent_events"])
+    return trace, entry_points or [0x0000]
+
+
+def trace_job(job, output_dir):
+    ''' Traces a single image and returns its line of the summary.
+        This runs in a worker process, so errors are reported in
+        the summary instead of being raised.
+    '''
+    result = {"name": job["name"],
+              "image": job["image"],
+              "platform": job["platform"]}
+    start = time.perf_counter()
+    with open(os.path.join(output_dir, job["name"] + ".log"), "w") as log, \
+         contextlib.redirect_stdout(log):
+        try:
+            trace, entry_points = make_trace(job)
+            trace.run(entry_points=entry_points)
+            trace.save_disassembly_listing(os.path.join(output_dir, job["name"] + ".asm"))
+        except Exception:
+            traceback.print_exc(file=log)
+            result["status"] = "error"
+            result["error"] = traceback.format_exc(limit=1).strip().splitlines()[-1]
+        else:
+            result["status"] = "ok"
+            result["blocks"] = len(trace.visited_ranges)
+            result["instructions"] = len(trace.disasm)
+            result["illegal_opcodes"] = sum(1 for flow, target in trace.flows.values()
+                                            if flow == ILLEGAL)
+            result["jump_HLs"] = len(getattr(trace, "jump_HLs", []))
+    result["runtime"] = round(time.perf_counter() - start, 3)
+    result["peak_rss_kb"] = peak_rss_kb()
+    return result
+
+
+def make_pool(max_workers):
+    # A fresh worker per job, so that peak RSS is measured per image.
+    # Python < 3.11 cannot do that and reports the peak of the worker.
+    try:
+        return ProcessPoolExecutor(max_workers, max_tasks_per_child=1)
+    except TypeError:
+        return ProcessPoolExecutor(max_workers)
+
+
+def run_batch(jobs, output_dir, max_workers=None):
+    ''' Traces every job in a pool of worker processes.
+        Returns the summary of each job, in the order of <jobs>.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    with make_pool(max_workers) as pool:
+        futures = [pool.submit(trace_job, job, output_dir) for job in jobs]
+        results = []
+        for job, future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except BrokenProcessPool as error:
+                # A worker died (killed, out of memory...) without a summary:
+                results.append({"name": job["name"],
+                                "image": job["image"],
+                                "platform": job["platform"],
+                                "status": "error",
+                                "error": "BrokenProcessPool: %s" % error})
+        return results
+
+
+def format_summary(results):
+    lines = [" ".join(fmt % column for column, fmt in SUMMARY_COLUMNS)]
+    for result in results:
+        lines.append(" ".join(fmt % ("-" if result.get(column) is None else result[column])
+                              for column, fmt in SUMMARY_COLUMNS))
+        if "error" in result:
+            lines.append("    " + result["error"])
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m exectrace.batch",
+                                     description="Traces all images listed in a JSON manifest.")
+    parser.add_argument("manifest")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument("-o", "--output-dir", default=None,
+                        help="overrides the output_dir of the manifest")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs, output_dir = load_manifest(args.manifest)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.output_dir is not None:
+        output_dir = args.output_dir
+    results = run_batch(jobs, output_dir, args.jobs)
+
+    with open(os.path.join(output_dir, "summary.json"), "w") as summary_file:
+        json.dump(results, summary_file, indent=2)
+    sys.stdout.write(format_summary(results))
+    return 1 if any(result["status"] != "ok" for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
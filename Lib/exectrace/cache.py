@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Persistent cache of trace results, so that re-running a disassembly
+# script after editing its configuration does not crawl the whole
+# image again.
+
+import gzip
+import hashlib
+import inspect
+import os
+import pickle
+
+from exectrace import VERBOSE
+
+CACHE_VERSION = 1
+
+
+class TraceCache():
+    ''' Keeps the state of finished traces in <directory>, one file
+        per image and crawl configuration: the decoder class (and its
+        source code), the relocation blocks, the external regions and
+        the scheduling order.
+
+        Symbol names, variables, labels and stack whitelists are not
+        part of the key, since they do not change what the crawl finds.
+        The roots of a trace (its entry points, declared subroutines and
+        jump table targets) are not part of the key either. Instead,
+        a cached trace is reused by a run whose roots include all of
+        its own: only the new roots get explored, and if there are none
+        the crawl is skipped altogether.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def config_hash(self, trace):
+        h = hashlib.sha1()
+        h.update(repr((CACHE_VERSION,
+                       type(trace).__module__,
+                       type(trace).__qualname__,
+                       [tuple(block) for block in trace.relocation_blocks],
+                       [region.cache_key() for region in trace.external_regions],
+                       trace.pending_entry_points.order)).encode())
+        for cls in type(trace).__mro__:
+            if cls is object:
+                continue
+            try:
+                with open(inspect.getsourcefile(cls), "rb") as source:
+                    h.update(source.read())
+            except (TypeError, OSError):
+                pass
+        return h.hexdigest()
+
+    def path(self, trace):
+        image_hash = hashlib.sha1(trace.image).hexdigest()
+        return os.path.join(self.directory, "%s-%s.trace.gz" % (image_hash[:20],
+                                                                self.config_hash(trace)[:20]))
+
+    def load(self, path):
+        try:
+            with gzip.open(path, "rb") as cache_file:
+                cached = pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if cached.get("version") != CACHE_VERSION:
+            return None
+        return cached
+
+    def save(self, path, roots, state):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = path + ".tmp"
+        with gzip.open(temp_path, "wb") as cache_file:
+            pickle.dump({"version": CACHE_VERSION,
+                         "roots": roots,
+                         "state": state}, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    def run(self, trace, entry_points, processes=None):
+        ''' Does the job of trace.run(entry_points, processes=processes),
+            reusing and then updating the cached results for the same
+            image and config.
+        '''
+        # Declared subroutines and jump tables are already scheduled by now:
+        roots = [address for address, needs_label in trace.pending_entry_points]
+        roots += [address for address in entry_points if address not in roots]
+
+        path = self.path(trace)
+        cached = self.load(path)
+        if cached is None or not cached["roots"].issubset(roots):
+            trace.log(VERBOSE, "Trace cache miss: {}", path)
+            if trace.metrics is not None:
+                trace.metrics.cache_misses += 1
+            for p in entry_points:
+                trace.schedule_entry_point(p, needs_label=True)
+            trace.crawl(processes)
+            self.save(path, set(roots), trace.get_state())
+            return
+
+        new_roots = [address for address in roots if address not in cached["roots"]]
+        trace.set_state(cached["state"])
+        if trace.metrics is not None:
+            trace.metrics.cache_hits += 1
+        if not new_roots:
+            trace.log(VERBOSE, "Trace cache hit: {}", path)
+            return
+
+        trace.log(VERBOSE, "Trace cache hit, exploring {} new entry points: {}", len(new_roots), path)
+        for address in new_roots:
+            trace.schedule_entry_point(address, needs_label=True)
+        trace.crawl(processes)
+        self.save(path, set(roots), trace.get_state())
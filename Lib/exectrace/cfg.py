@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Control flow graph of a trace, written by ExecTrace.export_cfg() as
+# Graphviz DOT, GraphML or a compact adjacency list.
+#
+# Nodes are the code blocks, named after their start address, and edges
+# are their exits, of the kinds given by exectrace.export.edge_kind().
+# An exit into the middle of a block leads to that block, and one to an
+# address out of every block (such as a call into the BIOS) leads to an
+# "external" node named after its label.
+#
+# The adjacency list has a line per node, with hexadecimal addresses:
+#
+#   <start> <end> [x<blocks>] <successor>:<kind> ...
+#
+# where "x<blocks>" tells how many blocks a collapsed chain is made of,
+# and an exit to an illegal instruction is written as "illegal". An
+# external node is written as "<address> external".
+
+from bisect import bisect_right
+from xml.sax.saxutils import escape, quoteattr
+
+from exectrace import BRANCH, CALL, ILLEGAL, SUBROUTINE
+from exectrace.export import edge_kind
+
+
+class Node():
+    ''' A node of the graph: a code block, a chain of them collapsed
+        into one, or an address out of every block.
+    '''
+    __slots__ = ("start", "end", "blocks", "successors", "subroutine", "external")
+
+    def __init__(self, start, end, external=False):
+        self.start = start
+        self.end = end
+        self.blocks = 1
+        self.successors = []  # (address of a node, kind of the edge)
+        self.subroutine = None
+        self.external = external
+
+
+def build_cfg(trace, cluster_subroutines=False, max_nodes=None):
+    ''' Returns the nodes of the control flow graph of <trace> as a dict
+        mapping their start addresses to Node objects, in address order.
+
+        With <cluster_subroutines>, the blocks reached from the entry of
+        each subroutine, without following calls, get that entry as their
+        subroutine. If the graph has more than <max_nodes> nodes, its
+        straight-line chains of blocks get collapsed into single nodes.
+    '''
+    flow_addresses = sorted(trace.flows)
+    nodes = {}
+    external = {}
+    find = trace.visited_ranges.find
+
+    def node_at(address):
+        codeblock = find(address)
+        if codeblock is not None:
+            return codeblock.start
+        if address not in external:
+            external[address] = Node(address, address, external=True)
+        return address
+
+    for codeblock in trace.visited_ranges:
+        start = codeblock.start
+        if start in nodes: # a repeated block
+            continue
+        node = nodes[start] = Node(start, codeblock.end)
+
+        # The instruction with a flow, if any, is the last one of its block:
+        flow = target = None
+        index = bisect_right(flow_addresses, codeblock.end) - 1
+        if index >= 0 and flow_addresses[index] >= start:
+            flow, target = trace.flows[flow_addresses[index]]
+
+        for next_block in codeblock.next_block:
+            if isinstance(next_block, str):
+                successor = (None, ILLEGAL)
+            else:
+                kind = edge_kind(next_block, flow, target)
+                if kind is None:
+                    continue
+                successor = (node_at(next_block), kind)
+            if successor not in node.successors:
+                node.successors.append(successor)
+
+    nodes.update(external)
+    if external:
+        nodes = dict(sorted(nodes.items()))
+
+    entries = set()
+    if cluster_subroutines:
+        entries = {target for flow, target in trace.flows.values() if flow == CALL}
+        entries.update(symbol.address for symbol in trace.symbols.of_type(SUBROUTINE))
+        entries = sorted(node_at(address) for address in entries
+                         if find(address) is not None)
+        assign_subroutines(nodes, entries)
+
+    if max_nodes is not None and len(nodes) > max_nodes:
+        nodes = collapse_chains(nodes, set(entries))
+    return nodes
+
+
+def assign_subroutines(nodes, entries):
+    ''' Gives each node reached from one of the <entries> without
+        following calls, and not reached from an earlier one,
+        that entry as its subroutine.
+    '''
+    entry_set = set(entries)
+    for entry in entries:
+        if nodes[entry].subroutine is not None:
+            continue
+        nodes[entry].subroutine = entry
+        pending = [entry]
+        while pending:
+            for address, kind in nodes[pending.pop()].successors:
+                if kind == CALL or address is None or address in entry_set:
+                    continue
+                node = nodes[address]
+                if node.subroutine is None and not node.external:
+                    node.subroutine = entry
+                    pending.append(address)
+
+
+def collapse_chains(nodes, entries):
+    ''' Merges every node having a single predecessor, which leads
+        nowhere else and does not call it, into that predecessor.
+        Returns the remaining nodes.
+    '''
+    predecessors = {}
+    for address, node in nodes.items():
+        for successor, kind in node.successors:
+            if successor is not None:
+                predecessors.setdefault(successor, set()).add(address)
+
+    def only_successor(node):
+        ''' The address <node> always goes on to, or None. '''
+        addresses = set(address for address, kind in node.successors)
+        if len(addresses) != 1 or any(kind == CALL for address, kind in node.successors):
+            return None
+        return addresses.pop()
+
+    def absorbable(address):
+        preds = predecessors.get(address, ())
+        if len(preds) != 1 or address in entries or nodes[address].external:
+            return False
+        pred = next(iter(preds))
+        return pred != address and only_successor(nodes[pred]) == address and \
+               nodes[pred].subroutine == nodes[address].subroutine
+
+    absorbed = set()
+    def collapse(head):
+        node = nodes[head]
+        while True:
+            address = only_successor(node)
+            if address is None or address == head or address in absorbed or \
+               not absorbable(address):
+                return
+            absorbed.add(address)
+            tail = nodes[address]
+            node.end = tail.end
+            node.blocks += tail.blocks
+            node.successors = tail.successors
+
+    for address in nodes:
+        if not absorbable(address):
+            collapse(address)
+    # What is left are cycles of nodes that all could be absorbed:
+    for address in nodes:
+        if address not in absorbed:
+            collapse(address)
+    return {address: node for address, node in nodes.items() if address not in absorbed}
+
+
+def _node_id(address):
+    return "n%04X" % address
+
+
+def _node_label(trace, node):
+    if node.external:
+        return trace.getLabelName(node.start)
+    label = "%04X-%04X" % (node.start, node.end)
+    if node.blocks > 1:
+        label += " (%d blocks)" % node.blocks
+    if node.start in trace.symbols.labeled or node.start in trace.symbols:
+        label = "%s\\n%s" % (trace.getLabelName(node.start), label)
+    return label
+
+
+_DOT_EDGE_STYLES = {
+    CALL: " [style=dashed]",
+    BRANCH: " [color=blue]",
+}
+
+
+def write_dot(trace, nodes, output):
+    output.write('digraph cfg {\n\tnode [shape=box, fontname="monospace"];\n')
+
+    clusters = {}
+    for node in nodes.values():
+        clusters.setdefault(node.subroutine, []).append(node)
+    for subroutine, members in clusters.items():
+        indent = "\t"
+        if subroutine is not None:
+            output.write('\tsubgraph cluster_%04X {\n\t\tlabel="%s";\n' % (
+                         subroutine, trace.getLabelName(subroutine)))
+            indent = "\t\t"
+        for node in members:
+            attributes = 'label="%s"' % _node_label(trace, node).replace('"', '\\"')
+            if node.external:
+                attributes += ", shape=ellipse"
+            elif (None, ILLEGAL) in node.successors:
+                attributes += ", color=red"
+            output.write("%s%s [%s];\n" % (indent, _node_id(node.start), attributes))
+        if subroutine is not None:
+            output.write("\t}\n")
+
+    for node in nodes.values():
+        source = _node_id(node.start)
+        for address, kind in node.successors:
+            if address is not None:
+                output.write("\t%s -> %s%s;\n" % (source, _node_id(address),
+                                                  _DOT_EDGE_STYLES.get(kind, "")))
+    output.write("}\n")
+
+
+_GRAPHML_KEYS = (("label", "node", "string"),
+                 ("start", "node", "int"),
+                 ("end", "node", "int"),
+                 ("blocks", "node", "int"),
+                 ("subroutine", "node", "string"),
+                 ("external", "node", "boolean"),
+                 ("illegal", "node", "boolean"),
+                 ("kind", "edge", "string"))
+
+
+def write_graphml(trace, nodes, output):
+    output.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+    for key, domain, type in _GRAPHML_KEYS:
+        output.write('  <key id="%s" for="%s" attr.name="%s" attr.type="%s"/>\n' % (
+                     key, domain, key, type))
+    output.write('  <graph id="cfg" edgedefault="directed">\n')
+
+    for node in nodes.values():
+        data = [("label", escape(_node_label(trace, node).replace("\\n", " "))),
+                ("start", node.start),
+                ("end", node.end),
+                ("blocks", node.blocks)]
+        if node.subroutine is not None:
+            data.append(("subroutine", escape(trace.getLabelName(node.subroutine))))
+        if node.external:
+            data.append(("external", "true"))
+        if (None, ILLEGAL) in node.successors:
+            data.append(("illegal", "true"))
+        output.write('    <node id="%s">%s</node>\n' % (
+                     _node_id(node.start),
+                     "".join('<data key="%s">%s</data>' % item for item in data)))
+
+    for node in nodes.values():
+        source = quoteattr(_node_id(node.start))
+        for address, kind in node.successors:
+            if address is not None:
+                output.write('    <edge source=%s target="%s"><data key="kind">%s</data></edge>\n' % (
+                             source, _node_id(address), kind))
+    output.write("  </graph>\n</graphml>\n")
+
+
+def write_adjacency(trace, nodes, output):
+    for node in nodes.values():
+        if node.external:
+            output.write("%04X external\n" % node.start)
+            continue
+        fields = ["%04X" % node.start, "%04X" % node.end]
+        if node.blocks > 1:
+            fields.append("x%d" % node.blocks)
+        for address, kind in node.successors:
+            fields.append(ILLEGAL if address is None else "%04X:%s" % (address, kind))
+        output.write(" ".join(fields) + "\n")
+
+
+WRITERS = {
+    "dot": write_dot,
+    "graphml": write_graphml,
+    "adjacency": write_adjacency,
+}
+
+EXTENSIONS = {
+    ".gv": "dot",
+    ".dot": "dot",
+    ".graphml": "graphml",
+    ".adj": "adjacency",
+    ".txt": "adjacency",
+}
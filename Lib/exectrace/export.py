@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Export of the results of a trace, for tools that would otherwise have
+# to parse them back from the disassembly listing. Used by
+# ExecTrace.export_jsonl() and ExecTrace.export_binary().
+#
+# Both formats are written in a single pass over the code blocks, in
+# address order. For each block come a "label" record if the listing
+# defines one there, the "block" record itself, its "instruction"
+# records and the "edge" records to the blocks it leads to. After all
+# blocks come a "label" record for each declared symbol not seen yet,
+# then the "jump_hl" and "stack_trick" records of decoders keeping
+# jump_HLs and stack_tricks lists (such as MSX_Trace).
+#
+# JSON Lines: one JSON object per line, with a "type" key telling which
+# of the records above it is, after a first "trace" record describing
+# the image. Addresses are plain numbers.
+#
+# Binary: little-endian, made to be memory-mapped and queried with
+# BinaryExport without reading the whole file. A header
+#
+#   magic "EXTB", version (uint16), number of sections (uint16)
+#
+# is followed by a directory of (tag, offset, count) entries, struct
+# "<4sQQ", one per section. Each section is an array of fixed-size
+# records sorted by address, as given by SECTION_FORMATS, except for
+# "STRS", the UTF-8 text that the other records point into with an
+# (offset, length) pair. Identical texts are only stored once.
+
+import json
+import mmap
+import struct
+
+from exectrace import CALL, BRANCH, JUMP, RETURN, ILLEGAL, render
+
+MAGIC = b"EXTB"
+VERSION = 1
+NONE = 0xFFFFFFFF   # an address that is not there
+
+_HEADER = struct.Struct("<4sHH")
+_DIRECTORY_ENTRY = struct.Struct("<4sQQ")
+
+BLOCKS = b"BLKS"
+INSTRUCTIONS = b"INST"
+EDGES = b"EDGE"
+LABELS = b"LBLS"
+JUMP_HLS = b"JPHL"
+STACK_TRICKS = b"STCK"
+STRINGS = b"STRS"
+
+SECTION_FORMATS = {
+    # start, end, first instruction, instruction count,
+    # first edge, edge count, needs_label
+    BLOCKS: struct.Struct("<IIIIIIB"),
+    # address, length, flow, target, text offset, text length
+    INSTRUCTIONS: struct.Struct("<IBBIIH"),
+    # from (block start), to, kind, note offset, note length
+    EDGES: struct.Struct("<IIBIH"),
+    # address, name offset, name length, symbol type
+    LABELS: struct.Struct("<IIHB"),
+    JUMP_HLS: struct.Struct("<I"),
+    STACK_TRICKS: struct.Struct("<I"),
+}
+SECTIONS = (BLOCKS, INSTRUCTIONS, EDGES, LABELS, JUMP_HLS, STACK_TRICKS, STRINGS)
+
+# The codes stored for flows, edge kinds and symbol types, by position:
+FLOWS = (None, CALL, BRANCH, JUMP, RETURN, ILLEGAL)
+EDGE_KINDS = ("next", CALL, BRANCH, JUMP, ILLEGAL)
+SYMBOL_TYPES = ("label", "subroutine", "variable", "external")
+
+
+def iter_records(trace):
+    ''' Yields the records of the results of <trace> as dicts,
+        in the order described at the top of this module.
+    '''
+    yield {"type": "trace",
+           "decoder": type(trace).__name__,
+           "relocation_blocks": [list(block) for block in trace.relocation_blocks]}
+
+    labeled = trace.symbols.labeled
+    seen_labels = set()
+    next_instruction = 0
+    for codeblock in trace.visited_ranges:
+        start = codeblock.start
+        if start in labeled and start not in seen_labels:
+            seen_labels.add(start)
+            yield _label_record(trace, start)
+
+        yield {"type": "block",
+               "start": start,
+               "end": codeblock.end,
+               "needs_label": codeblock.needs_label}
+
+        # Like the listing, instructions of repeated blocks only come once:
+        flow = target = None
+        address = max(start, next_instruction)
+        while address <= codeblock.end:
+            entry = trace.disasm.get(address)
+            if entry is None:
+                address += 1
+                continue
+            length = trace.instruction_length(address)
+            flow, target = trace.flows.get(address, (None, None))
+            yield {"type": "instruction",
+                   "address": address,
+                   "length": length,
+                   "text": render(trace, entry),
+                   "flow": flow,
+                   "target": target}
+            address += length
+        next_instruction = max(next_instruction, address)
+
+        for next_block in codeblock.next_block:
+            edge = {"type": "edge", "from": start}
+            if isinstance(next_block, str):
+                edge.update(to=None, kind=ILLEGAL, note=next_block)
+            else:
+                kind = edge_kind(next_block, flow, target)
+                if kind is None:
+                    continue
+                edge.update(to=next_block, kind=kind)
+            yield edge
+
+    for symbol in trace.symbols:
+        if symbol.address not in seen_labels:
+            yield _label_record(trace, symbol.address)
+
+    for address in getattr(trace, "jump_HLs", ()):
+        yield {"type": "jump_hl", "address": address}
+    for address in getattr(trace, "stack_tricks", ()):
+        yield {"type": "stack_trick", "address": address}
+
+
+def edge_kind(next_block, flow, target):
+    ''' Tells how a block whose last instruction has the given <flow>
+        and <target> leads to <next_block>: "call", "branch" or "jump"
+        to the target of the instruction, and "next" to the instruction
+        that follows it, which is where a conditional return goes on.
+        Returns None if the instruction never leads to <next_block>,
+        as is the case for anything but the target of a jump.
+    '''
+    if next_block == target:
+        return "next" if flow == RETURN else flow
+    if flow in (JUMP, RETURN):
+        return None
+    return "next"
+
+
+def _label_record(trace, address):
+    symbol = trace.symbols.get(address)
+    return {"type": "label",
+            "address": address,
+            "name": trace.getLabelName(address),
+            "symbol": symbol.type if symbol is not None else "label"}
+
+
+def write_jsonl(trace, output):
+    ''' Writes the records of <trace> to the text file <output>,
+        one JSON object per line.
+    '''
+    encoder = json.JSONEncoder(separators=(",", ":"))
+    for record in iter_records(trace):
+        output.write(encoder.encode(record))
+        output.write("\n")
+
+
+def write_binary(trace, output):
+    ''' Writes the records of <trace> to the binary file <output>,
+        in the format described at the top of this module.
+    '''
+    sections = {tag: bytearray() for tag in SECTIONS}
+    counts = dict.fromkeys(SECTIONS, 0)
+    strings = sections[STRINGS]
+    offsets = {}
+
+    def text(value):
+        offset = offsets.get(value)
+        if offset is None:
+            encoded = value.encode("utf-8")[:0xFFFF]
+            offset = offsets[value] = (len(strings), len(encoded))
+            strings.extend(encoded)
+        return offset
+
+    def add(tag, *fields):
+        sections[tag] += SECTION_FORMATS[tag].pack(*fields)
+        counts[tag] += 1
+
+    labels = []
+    addresses = {JUMP_HLS: [], STACK_TRICKS: []}
+    block = None
+    for record in iter_records(trace):
+        kind = record["type"]
+        if kind == "instruction":
+            target = record["target"]
+            add(INSTRUCTIONS, record["address"], record["length"],
+                FLOWS.index(record["flow"]), NONE if target is None else target,
+                *text(record["text"]))
+        elif kind == "edge":
+            to = record["to"]
+            add(EDGES, record["from"], NONE if to is None else to,
+                EDGE_KINDS.index(record["kind"]), *text(record.get("note", "")))
+        elif kind == "block":
+            if block is not None:
+                add(BLOCKS, *_block_fields(block, counts))
+            block = (record, counts[INSTRUCTIONS], counts[EDGES])
+        elif kind == "label":
+            labels.append((record["address"], text(record["name"]),
+                           SYMBOL_TYPES.index(record["symbol"])))
+        elif kind == "jump_hl":
+            addresses[JUMP_HLS].append(record["address"])
+        elif kind == "stack_trick":
+            addresses[STACK_TRICKS].append(record["address"])
+    if block is not None:
+        add(BLOCKS, *_block_fields(block, counts))
+
+    # Declared symbols come after the blocks, so these need sorting:
+    for address, (offset, length), symbol_type in sorted(labels):
+        add(LABELS, address, offset, length, symbol_type)
+    for tag in (JUMP_HLS, STACK_TRICKS):
+        for address in sorted(addresses[tag]):
+            add(tag, address)
+    counts[STRINGS] = len(strings)
+
+    offset = _HEADER.size + _DIRECTORY_ENTRY.size * len(SECTIONS)
+    output.write(_HEADER.pack(MAGIC, VERSION, len(SECTIONS)))
+    for tag in SECTIONS:
+        output.write(_DIRECTORY_ENTRY.pack(tag, offset, counts[tag]))
+        offset += len(sections[tag])
+    for tag in SECTIONS:
+        output.write(sections[tag])
+
+
+def _block_fields(block, counts):
+    record, first_instruction, first_edge = block
+    return (record["start"], record["end"],
+            first_instruction, counts[INSTRUCTIONS] - first_instruction,
+            first_edge, counts[EDGES] - first_edge,
+            record["needs_label"])
+
+
+class BinaryExport():
+    ''' Read-only view of a binary export, memory-mapped so that
+        looking up a block, an instruction or a label only reads the
+        few records involved. Records are returned as the same dicts
+        iter_records() yields.
+    '''
+
+    def __init__(self, filename):
+        self._file = open(filename, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # an empty file cannot be mapped
+            self._file.close()
+            raise ValueError("%s is not a binary trace export" % filename)
+        magic, version, count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("%s is not a binary trace export (version %d)" % (filename, version))
+        self._sections = {}
+        for i in range(count):
+            tag, offset, records = _DIRECTORY_ENTRY.unpack_from(
+                self._map, _HEADER.size + i * _DIRECTORY_ENTRY.size)
+            self._sections[tag] = (offset, records)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def count(self, tag):
+        return self._sections[tag][1]
+
+    def _unpack(self, tag, index):
+        fmt = SECTION_FORMATS[tag]
+        return fmt.unpack_from(self._map, self._sections[tag][0] + index * fmt.size)
+
+    def _address(self, tag, index):
+        # Every record starts with the address it is sorted by:
+        fmt = SECTION_FORMATS[tag]
+        return struct.unpack_from("<I", self._map, self._sections[tag][0] + index * fmt.size)[0]
+
+    def _bisect(self, tag, address):
+        ''' Index of the first record of <tag> at or after <address>. '''
+        low, high = 0, self.count(tag)
+        while low < high:
+            middle = (low + high) // 2
+            if self._address(tag, middle) < address:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _text(self, offset, length):
+        start = self._sections[STRINGS][0] + offset
+        return self._map[start:start + length].decode("utf-8")
+
+    def _block(self, index):
+        start, end, first_instruction, instructions, first_edge, edges, needs_label = \
+            self._unpack(BLOCKS, index)
+        return {"type": "block",
+                "start": start,
+                "end": end,
+                "needs_label": bool(needs_label),
+                "instructions": range(first_instruction, first_instruction + instructions),
+                "edges": range(first_edge, first_edge + edges)}
+
+    def _instruction(self, index):
+        address, length, flow, target, offset, text_length = self._unpack(INSTRUCTIONS, index)
+        return {"type": "instruction",
+                "address": address,
+                "length": length,
+                "text": self._text(offset, text_length),
+                "flow": FLOWS[flow],
+                "target": None if target == NONE else target}
+
+    def _edge(self, index):
+        start, to, kind, offset, length = self._unpack(EDGES, index)
+        edge = {"type": "edge",
+                "from": start,
+                "to": None if to == NONE else to,
+                "kind": EDGE_KINDS[kind]}
+        if edge["to"] is None:
+            edge["note"] = self._text(offset, length)
+        return edge
+
+    def blocks(self):
+        for index in range(self.count(BLOCKS)):
+            yield self._block(index)
+
+    def block_at(self, address):
+        ''' The block containing <address>, or None. '''
+        index = self._bisect(BLOCKS, address + 1) - 1
+        if index >= 0:
+            block = self._block(index)
+            if block["end"] >= address:
+                return block
+        return None
+
+    def instructions(self, start=0, end=NONE):
+        ''' The instructions starting within [start, end], in address order. '''
+        index = self._bisect(INSTRUCTIONS, start)
+        while index < self.count(INSTRUCTIONS) and self._address(INSTRUCTIONS, index) <= end:
+            yield self._instruction(index)
+            index += 1
+
+    def instruction_at(self, address):
+        index = self._bisect(INSTRUCTIONS, address)
+        if index < self.count(INSTRUCTIONS) and self._address(INSTRUCTIONS, index) == address:
+            return self._instruction(index)
+        return None
+
+    def edges_from(self, block):
+        ''' The edges leaving <block>, as returned by block_at() or blocks(). '''
+        return [self._edge(index) for index in block["edges"]]
+
+    def label(self, address):
+        ''' The name of the label at <address>, or None. '''
+        index = self._bisect(LABELS, address)
+        if index < self.count(LABELS):
+            label_address, offset, length, symbol_type = self._unpack(LABELS, index)
+            if label_address == address:
+                return self._text(offset, length)
+        return None
+
+    def labels(self):
+        for index in range(self.count(LABELS)):
+            address, offset, length, symbol_type = self._unpack(LABELS, index)
+            yield {"type": "label",
+                   "address": address,
+                   "name": self._text(offset, length),
+                   "symbol": SYMBOL_TYPES[symbol_type]}
+
+    def jump_HLs(self):
+        return [self._address(JUMP_HLS, index) for index in range(self.count(JUMP_HLS))]
+
+    def stack_tricks(self):
+        return [self._address(STACK_TRICKS, index) for index in range(self.count(STACK_TRICKS))]
@@ -4,9 +4,13 @@
 #
 # Instruction set described at ?
 #
+import re
 import sys
 
-from exectrace import ExecTrace, ERROR, hex8, hex16
+from exectrace import ExecTrace, ERROR, DFS, SUBROUTINE, hex8, hex16
+from exectrace import NUMBER, SYMBOL, TARGET
+from exectrace.resolve import INDEX, RegisterFile, numeric_text, add, combine, double, bounded
+from exectrace.resolve import load_byte, load_word
 
 def twos_compl(v):
   if v & (1 << 7):
@@ -35,516 +39,765 @@ assert twos_compl(0x80) == -0x80
 assert twos_compl(0x81) == -0x7F
 
 
+REG8 = ['al', 'cl', 'dl', 'bl', 'ah', 'ch', 'dh', 'bh']
+REG16 = ['ax', 'cx', 'dx', 'bx', 'sp', 'bp', 'si', 'di']
+SEGMENT_REGS = ['es', 'cs', 'ss', 'ds']
+EFFECTIVE_ADDRESSES = ['bx + si', 'bx + di', 'bp + si', 'bp + di',
+                       'si', 'di', 'bp', 'bx']
+ARITHMETIC = ['add', 'or', 'adc', 'sbb', 'and', 'sub', 'xor', 'cmp']
+GROUP3 = ['test', None, 'not', 'neg', 'mul', 'imul', 'div', 'idiv']
+
+# Segment override prefixes and the text they prepend to memory operands.
+# CS is the segment the code is traced in, so its override prints nothing.
+SEGMENT_PREFIXES = {
+  0x26: "es:",
+  0x2e: "",
+  0x36: "ss:",
+  0x3e: "ds:",
+}
+REP_PREFIX = 0xf3
+
+
+def _build_modrm_table():
+  '''One (mod, reg, r/m, template, displacement size) entry per ModRM byte.
+     The template renders a memory operand once its displacement is known.
+     It is None both for register operands (mod == 0b11) and for the
+     direct 16-bit address form (mod == 0b00, r/m == 6).'''
+  table = []
+  for modrm in range(256):
+    mod = modrm >> 6
+    reg = (modrm >> 3) & 7
+    r_m = modrm & 7
+    ea = EFFECTIVE_ADDRESSES[r_m]
+    if mod == 0b11:
+      table.append((mod, reg, r_m, None, 0))
+    elif mod == 0b00 and r_m == 6:
+      table.append((mod, reg, r_m, None, 2))
+    elif mod == 0b00:
+      table.append((mod, reg, r_m, "[%s]" % ea, 0))
+    elif mod == 0b01:
+      table.append((mod, reg, r_m, "[%s + 0x%%02X]" % ea, 1))
+    else:
+      table.append((mod, reg, r_m, "[%s + 0x%%04X]" % ea, 2))
+  return table
+
+MODRM = _build_modrm_table()
+
+_NUMBER = (NUMBER,)
+_SYMBOL = (SYMBOL,)
+_SEGMENT_SYMBOL = (NUMBER, SYMBOL)
+_TARGET = (TARGET,)
+_NO_VALUES = ()
+
+
+# Operand handlers for the decode tables below.
+# Each one receives the trace and the entry's template
+# and returns the disassembled instruction: either its text or a
+# (template, operand kinds, value, ...) tuple, only rendered as text
+# when the listing is written.
+
+def _rm_operand(trace, modrm, regs):
+  ''' Fetches the displacement of a r/m operand and returns its text
+      together with the values still to be rendered in it: the
+      direct address form leaves a %s placeholder for its variable name.
+  '''
+  mod, reg, r_m, template, size = MODRM[modrm]
+  if mod == 0b11: # r/m is treated as a REG field
+    return regs[r_m], _NO_VALUES
+  if size == 0:
+    return trace.cur_segment + template, _NO_VALUES
+  disp = trace.fetch()
+  if size == 2:
+    disp = disp | (trace.fetch() << 8)
+  if template is None:
+    return trace.cur_segment + "[%s]", (disp,)
+  return trace.cur_segment + template % disp, _NO_VALUES
+
+def _instruction(text, values):
+  if values:
+    return (text, _SYMBOL) + values
+  return text
+
+def _imm8(trace, template):
+  return (template, _NUMBER, trace.fetch())
+
+def _imm16(trace, template):
+  imm = trace.fetch()
+  imm = imm | (trace.fetch() << 8)
+  return (template, _NUMBER, imm)
+
+def _addr16(trace, template):
+  addr = trace.fetch()
+  addr = addr | (trace.fetch() << 8)
+  return (template, _SEGMENT_SYMBOL, trace.cur_segment, addr)
+
+def _mov_ah(trace, template):
+  imm = trace.fetch()
+  if trace.fetch_failed_at is None:
+    trace.ax = imm << 8 | (trace.ax & 0xFF)
+  return (template, _NUMBER, imm)
+
+def _mov_ax(trace, template):
+  imm = trace.fetch()
+  imm = imm | (trace.fetch() << 8)
+  if trace.fetch_failed_at is None:
+    trace.ax = imm
+  return (template, _NUMBER, imm)
+
+def _rel8_branch(trace, template):
+  imm = trace.fetch()
+  addr = trace.PC + twos_compl(imm)
+  trace.conditional_branch(addr)
+  return (template, _TARGET, addr)
+
+def _rel8_jump(trace, template):
+  imm = trace.fetch()
+  addr = trace.PC + twos_compl(imm)
+  trace.unconditional_jump(addr)
+  return (template, _TARGET, addr)
+
+def _rel16_call(trace, template):
+  addr = trace.fetch()
+  addr = addr | (trace.fetch() << 8)
+  addr = (trace.PC + twos_compl16(addr)) & 0xFFFF
+  trace.subroutine(addr)
+  return (template, _TARGET, addr)
+
+def _rel16_jump(trace, template):
+  addr = trace.fetch()
+  addr = addr | (trace.fetch() << 8)
+  addr = (trace.PC + twos_compl16(addr)) & 0xFFFF
+  trace.unconditional_jump(addr)
+  return (template, _TARGET, addr)
+
+def _return(trace, template):
+  trace.return_from_subroutine()
+  return template
+
+def _int(trace, template):
+  imm = trace.fetch()
+  if trace.ax & 0xff00 == 0x4C00 and imm == 0x21:
+    # Program has ended and asked to return to DOS,
+    # so as far as the crawl goes, this is a return:
+    trace.return_from_subroutine()
+  return (template, _NUMBER, imm)
+
+def _illegal(trace, opcode):
+  trace.illegal_instruction(opcode)
+  return "; DISASM ERROR! Illegal instruction (opcode = %s)" % hex8(opcode)
+
+def _illegal_modrm(trace, opcode, modrm):
+  trace.illegal_instruction(opcode << 8 | modrm)
+  return ""
+
+def _reg_rm(trace, template): # op reg, r/m
+  text, regs = template
+  modrm = trace.fetch()
+  reg = regs[MODRM[modrm][1]]
+  operand, values = _rm_operand(trace, modrm, regs)
+  return _instruction(text % (reg, operand), values)
+
+def _rm_reg(trace, template): # op r/m, reg
+  text, regs = template
+  modrm = trace.fetch()
+  reg = regs[MODRM[modrm][1]]
+  operand, values = _rm_operand(trace, modrm, regs)
+  return _instruction(text % (operand, reg), values)
+
+def _sreg_rm(trace, template): # mov Seg, r/m
+  modrm = trace.fetch()
+  sreg = SEGMENT_REGS[MODRM[modrm][1] & 3]
+  operand, values = _rm_operand(trace, modrm, REG16)
+  return _instruction(template % (sreg, operand), values)
+
+def _rm_sreg(trace, opcode): # mov r/m, Seg
+  modrm = trace.fetch()
+  reg = MODRM[modrm][1]
+  if reg > 3:
+    return _illegal_modrm(trace, opcode, modrm)
+  operand, values = _rm_operand(trace, modrm, REG16)
+  return _instruction("mov %s, %s" % (operand, SEGMENT_REGS[reg]), values)
+
+def _arithmetic_imm(trace, template): # op r/m, imm
+  regs, imm_size = template
+  modrm = trace.fetch()
+  op = ARITHMETIC[MODRM[modrm][1]]
+  operand, values = _rm_operand(trace, modrm, regs)
+  imm = trace.fetch()
+  if imm_size == 2:
+    imm = trace.fetch() << 8 | imm
+    return _instruction(f"{op} {operand}, 0x{imm:04X}", values)
+  return _instruction(f"{op} {operand}, 0x{imm:02X}", values)
+
+def _pop_rm(trace, opcode):
+  modrm = trace.fetch()
+  if MODRM[modrm][1] != 0:
+    return _illegal_modrm(trace, opcode, modrm)
+  operand, values = _rm_operand(trace, modrm, REG16)
+  return _instruction("pop %s" % operand, values)
+
+def _mov_rm_imm8(trace, opcode):
+  modrm = trace.fetch()
+  if MODRM[modrm][1] != 0:
+    return _illegal_modrm(trace, opcode, modrm)
+  operand, values = _rm_operand(trace, modrm, REG8)
+  return _instruction(f"mov {operand}, 0x{trace.fetch():02X}", values)
+
+def _mov_rm_imm16(trace, opcode):
+  modrm = trace.fetch()
+  mod, reg, r_m, template, size = MODRM[modrm]
+  if reg != 0:
+    return _illegal_modrm(trace, opcode, modrm)
+
+  if mod == 0b00 and template is None:
+    addr = trace.fetch()
+    addr = addr | (trace.fetch() << 8)
+
+    value = trace.fetch()
+    value = value | (trace.fetch() << 8)
+
+    # this is incomplete and may fail in some contexts:
+    if trace.cur_segment == "es:" and value <= 0x03ff:
+      trace.setup_ivt(addr, value)
+
+    return f"mov {trace.cur_segment}[0x{addr:04X}], 0x{value:04X}"
+
+  operand, values = _rm_operand(trace, modrm, REG16)
+  value = trace.fetch()
+  value = value | (trace.fetch() << 8)
+  return _instruction(f"mov {operand}, 0x{value:04X}", values)
+
+def _group3(trace, opcode): # test/not/neg/mul/imul/div/idiv r/m16
+  modrm = trace.fetch()
+  op = GROUP3[MODRM[modrm][1]]
+  if op is None:
+    return _illegal_modrm(trace, opcode, modrm)
+  operand, values = _rm_operand(trace, modrm, REG16)
+  if op == "test":
+    imm = trace.fetch()
+    imm = imm | (trace.fetch() << 8)
+    return _instruction(f"test {operand}, 0x{imm:04X}", values)
+  return _instruction(f"{op} {operand}", values)
+
+def _group5(trace, opcode): # FIXME! only far calls, near jumps and pushes are decoded
+  modrm = trace.fetch()
+  reg = MODRM[modrm][1]
+  if reg == 3:
+    operand, values = _rm_operand(trace, modrm, REG16)
+    return _instruction("call dword ptr %s" % operand, values)
+  elif reg == 4:
+    # Where it goes is for exectrace.resolve to work out:
+    operand, values = _rm_operand(trace, modrm, REG16)
+    trace.return_from_subroutine()
+    return _instruction("jmp %s" % operand, values)
+  elif reg == 6:
+    operand, values = _rm_operand(trace, modrm, REG16)
+    return _instruction("push %s" % operand, values)
+  return _illegal_modrm(trace, opcode, modrm)
+
+
+def _build_base_instructions():
+  simple_instructions = {
+    0x06: "push es",
+    0x07: "pop es",
+    0x0e: "push cs",
+    0x16: "push ss",
+    0x17: "pop ss",
+    0x1e: "push ds",
+    0x1f: "pop ds",
+    0x60: "pusha",
+    0x61: "popa",
+    0x90: "nop",
+    0x9c: "pushf",
+    0x9d: "popf",
+    0xa4: "movsb",
+    0xaa: "stosb",
+    0xab: "stosw",
+    0xac: "lodsb",
+    0xec: "in al, dx",
+    0xee: "out dx, al",
+    0xef: "out dx, ax",
+    0xf9: "stc",
+    0xfa: "cli",
+    0xfb: "sti",
+  }
+
+  table = [(_illegal, opcode) for opcode in range(256)]
+  for opcode, text in simple_instructions.items():
+    table[opcode] = (None, text)
+
+  for opcode in range(0x40, 0x60):
+    op = ["inc", "dec", "push", "pop"][(opcode >> 3) & 3]
+    table[opcode] = (None, "%s %s" % (op, REG16[opcode & 7]))
+
+  table[0x00] = (_rm_reg, ("add %s, %s", REG8))
+  table[0x0b] = (_reg_rm, ("or %s, %s", REG16))
+  table[0x0c] = (_imm8, "or al, 0x%02X")
+  table[0x24] = (_imm8, "and al, 0x%02X")
+  table[0x2b] = (_reg_rm, ("sub %s, %s", REG16))
+  table[0x32] = (_reg_rm, ("xor %s, %s", REG8))
+  table[0x33] = (_reg_rm, ("xor %s, %s", REG16))
+  table[0x3d] = (_imm16, "cmp ax, 0x%04X")
+  table[0x68] = (_imm16, "push 0x%04X")
+  table[0x6a] = (_imm8, "push 0x%02X")
+
+  for opcode, cond in ((0x70, "jo"), (0x72, "jc"), (0x74, "je"), (0x75, "jne"),
+                       (0x77, "ja"), (0x7d, "jnl"), (0x7f, "jg")):
+    table[opcode] = (_rel8_branch, cond + " %s")
+
+  table[0x80] = (_arithmetic_imm, (REG8, 1))
+  table[0x81] = (_arithmetic_imm, (REG16, 2))
+  table[0x83] = (_arithmetic_imm, (REG16, 1))
+
+  # DATA TRANSFER
+  # MOV = Move
+  # Register/Memory to/from Register
+  # 100010 d w | mod reg r/m
+  # (reg names a general register of the size given by w, never a segment register)
+  table[0x88] = (_rm_reg, ("mov %s, %s", REG8))
+  table[0x89] = (_rm_reg, ("mov %s, %s", REG16))
+  table[0x8a] = (_reg_rm, ("mov %s, %s", REG8))
+  table[0x8b] = (_reg_rm, ("mov %s, %s", REG16))
+  table[0x8c] = (_rm_sreg, 0x8c)
+  table[0x8e] = (_sreg_rm, "mov %s, %s")
+  table[0x8f] = (_pop_rm, 0x8f)
+
+  table[0xa0] = (_imm16, "mov al, [0x%04X]")
+  table[0xa2] = (_addr16, "mov %s[%s], al")
+  table[0xa8] = (_imm8, "test al, 0x%02X")
+  table[0xb0] = (_imm8, "mov al, 0x%02X")
+  table[0xb4] = (_mov_ah, "mov ah, 0x%02X")
+  table[0xb8] = (_mov_ax, "mov ax, 0x%04X")
+  table[0xb9] = (_imm16, "mov cx, 0x%04X")
+  table[0xba] = (_imm16, "mov dx, 0x%04X")
+  table[0xbb] = (_imm16, "mov bx, 0x%04X")
+  table[0xbe] = (_imm16, "lea si, 0x%04X")
+  table[0xbf] = (_imm16, "lea di, 0x%04X")
+  table[0xc3] = (_return, "retn")
+  table[0xc6] = (_mov_rm_imm8, 0xc6)
+  table[0xc7] = (_mov_rm_imm16, 0xc7)
+  table[0xcd] = (_int, "int 0x%02X")
+  table[0xcf] = (_return, "iret")
+  table[0xe2] = (_rel8_branch, "loop %s")
+  table[0xe4] = (_imm8, "in al, 0x%02X")
+  table[0xe6] = (_imm8, "out 0x%02X, al")
+  table[0xe8] = (_rel16_call, "call %s")
+  table[0xe9] = (_rel16_jump, "jmp %s")
+  table[0xeb] = (_rel8_jump, "jmp %s")
+  table[0xf7] = (_group3, 0xf7)
+  table[0xff] = (_group5, 0xff)
+  return table
+
+BASE_INSTRUCTIONS = _build_base_instructions()
+
+
+# How the operand values of each handler's entries are encoded,
+# as the bytes that follow the opcode. Those of the handlers of a
+# ModRM byte are displacements given as an address (mod 0, r/m 6):
+_BYTE_OPERAND = "byte"
+_WORD_OPERAND = "word"
+_REL8_OPERAND = "rel8"
+_REL16_OPERAND = "rel16"
+_OPERAND_ENCODINGS = {
+  _imm8: _BYTE_OPERAND,
+  _imm16: _WORD_OPERAND,
+  _addr16: _WORD_OPERAND,
+  _mov_ah: _BYTE_OPERAND,
+  _mov_ax: _WORD_OPERAND,
+  _int: _BYTE_OPERAND,
+  _rel8_branch: _REL8_OPERAND,
+  _rel8_jump: _REL8_OPERAND,
+  _rel16_call: _REL16_OPERAND,
+  _rel16_jump: _REL16_OPERAND,
+}
+_MODRM_HANDLERS = (_reg_rm, _rm_reg, _sreg_rm, _rm_sreg, _arithmetic_imm, _pop_rm,
+                   _mov_rm_imm8, _mov_rm_imm16, _group3, _group5)
+# Those where the reg field of the ModRM byte selects the operation:
+_EXTENDED_BY_MODRM = (_arithmetic_imm, _pop_rm, _mov_rm_imm8, _mov_rm_imm16, _group3, _group5)
+
+# The displacements and immediates that handlers write in the text,
+# rather than leaving them as values, and the segment overrides:
+_HEX_TOKEN = re.compile(r"0x([0-9A-F]{4}|[0-9A-F]{2})\b")
+_SEGMENT_OVERRIDE = re.compile(r"\b(es|ss|ds):")
+_OVERRIDE_PREFIXES = {text: prefix for prefix, text in SEGMENT_PREFIXES.items() if text}
+
+
+def _operand_template(text):
+  ''' Returns <text> with the numbers in it replaced by placeholders,
+      and the list of their (value, size in bytes).
+  '''
+  tokens = []
+  def placeholder(match):
+    digits = match.group(1)
+    tokens.append((int(digits, 16), len(digits) // 2))
+    return "0x" + "#" * len(digits)
+  return _HEX_TOKEN.sub(placeholder, text), tokens
+
+
+class _Probe():
+  ''' Stands for the trace while a handler decodes <code>
+      followed by zeros, ignoring whatever the handler reports.
+  '''
+  def __init__(self, code):
+    self.code = code
+    self.PC = 1
+    self.cur_segment = ""
+    self.ax = 0
+    self.fetch_failed_at = None
+
+  def fetch(self):
+    value = self.code[self.PC] if self.PC < len(self.code) else 0
+    self.PC += 1
+    return value
+
+  def __getattr__(self, name):
+    return lambda *args, **kwargs: None
+
+
+def _build_encodings():
+  ''' Inverts the decode table by decoding every opcode (and every
+      ModRM byte after it) with zero operand bytes, mapping the text of
+      each entry, with placeholders for its numbers, to the (opcode
+      bytes, operand encodings, length) of its instructions. Where
+      several opcodes decode to the same text, the first one in table
+      order is what an assembler would pick, except that register to
+      register forms, assembled either way, keep the others too.
+  '''
+  encodings = {}
+  def probe(handler, template, code):
+    trace = _Probe(code)
+    entry = handler(trace, template)
+    if entry == "": # an illegal ModRM byte
+      return
+    if entry.__class__ is str:
+      text, values = entry, ()
+    else:
+      text, values = entry[0], [value for value in entry[2:] if value.__class__ is not str]
+
+    if handler is _illegal:
+      key, tokens = text, () # the text tells which opcode it is
+    else:
+      key, tokens = _operand_template(text)
+    if handler in _MODRM_HANDLERS:
+      operands = (_WORD_OPERAND,) * len(values)
+    else:
+      operands = (_OPERAND_ENCODINGS.get(handler),) * len(values)
+
+    length = trace.PC
+    head = length - sum(size for value, size in tokens) \
+                  - sum(2 if operand in (_WORD_OPERAND, _REL16_OPERAND) else 1 for operand in operands)
+    if key not in encodings:
+      encodings[key] = ([code[:head]], operands, length)
+    elif handler in _MODRM_HANDLERS and MODRM[code[1]][0] == 0b11:
+      # Between registers, either direction bit gives the same instruction:
+      encodings[key][0].append(code[:head])
+
+  for opcode, (handler, template) in enumerate(BASE_INSTRUCTIONS):
+    if handler is None:
+      encodings[template] = ([bytes([opcode])], (), 1)
+    elif handler in _MODRM_HANDLERS:
+      for modrm in range(256):
+        probe(handler, template, bytes([opcode, modrm]))
+    else:
+      probe(handler, template, bytes([opcode]))
+  return encodings
+
+ENCODINGS = _build_encodings()
+
+
+# Value propagation, for exectrace.resolve:
+REGISTERS_8086 = RegisterFile({"ax": ("ah", "al"), "bx": ("bh", "bl"),
+                               "cx": ("ch", "cl"), "dx": ("dh", "dl")})
+_VALUE_REGISTERS = set(REG8 + REG16)
+_MEMORY_OPERAND = re.compile(r"^\[(?:(\w\w)(?: \+ (0x[0-9A-F]+))?|(0x[0-9A-F]+))\]$")
+# Those that only change the register they are given first:
+_WRITE_FIRST_OPERAND = ("mov", "lea", "add", "or", "adc", "sbb", "and", "sub", "xor",
+                        "inc", "dec", "neg", "not", "pop", "in")
+# Those that change neither registers nor flags, as far as is tracked:
+_UNTRACKED_EFFECTS = ("push", "out", "nop", "cli", "sti", "pushf", "cmp", "test")
+_CONSTANT_OPERATIONS = {
+  "sub": lambda x, y: x - y,
+  "and": lambda x, y: x & y,
+  "or": lambda x, y: x | y,
+  "xor": lambda x, y: x ^ y,
+}
+
+def _overlaps(a, b):
+  ''' Whether the registers <a> and <b> share any bits. '''
+  return a == b or REGISTERS_8086.halves.get(a) == b or \
+         REGISTERS_8086.halves.get(b) == a
+
+def _operand_value(trace, state, operand, bits):
+  ''' The value of a register, number or memory operand of <bits> bits.
+      Memory is only read for the segment the code is traced in.
+  '''
+  if operand in _VALUE_REGISTERS:
+    return state.get(operand)
+  if operand.startswith("0x"):
+    return int(operand, 16)
+  memory = _MEMORY_OPERAND.match(operand)
+  if memory is None:
+    return None
+  register, displacement, direct = memory.groups()
+  if direct is not None:
+    address = int(direct, 16)
+  elif register not in _VALUE_REGISTERS:
+    return None
+  else:
+    address = add(state.get(register), int(displacement or "0", 16))
+  if address is None:
+    return None
+  return (load_word if bits == 16 else load_byte)(trace, address)
+
+def _propagated_value(trace, state, mnemonic, operands):
+  ''' Returns the value the instruction sets its first operand to,
+      if it can be worked out, or None.
+  '''
+  bits = 16 if operands[0] in REG16 else 8
+  mask = (1 << bits) - 1
+  if mnemonic in ("mov", "lea"):
+    return _operand_value(trace, state, operands[1], bits)
+  if mnemonic in ("inc", "dec"):
+    return add(state.get(operands[0]), 1 if mnemonic == "inc" else mask, bits)
+  if len(operands) < 2:
+    return None
+  if mnemonic in ("sub", "xor") and operands[1] == operands[0]:
+    return 0
+  value = state.get(operands[0])
+  operand = _operand_value(trace, state, operands[1], bits)
+  if operand.__class__ is int and bits == 16 and len(operands[1]) == 4:
+    # The byte immediate of 83 /r is sign-extended:
+    operand = twos_compl(operand) & mask
+  if mnemonic == "add":
+    if operands[1] == operands[0]:
+      return double(value, bits)
+    return add(value, operand, bits)
+  if mnemonic in _CONSTANT_OPERATIONS:
+    return combine(_CONSTANT_OPERATIONS[mnemonic], value, operand, mask)
+  return None
+
+
+
 class MSDOS_Trace(ExecTrace):
   def __init__(self,
                exefile,
                loglevel=ERROR,
                relocation_blocks=None,
-               variables={},
-               subroutines={},
-               stack_whitelist=[]):
+               variables=None,
+               subroutines=None,
+               stack_whitelist=None,
+               scheduling=DFS,
+               recent_events=0,
+               external_regions=None):
     super(MSDOS_Trace, self).__init__(exefile,
                                       loglevel,
                                       relocation_blocks,
                                       variables,
-                                      subroutines)
+                                      subroutines,
+                                      scheduling=scheduling,
+                                      recent_events=recent_events,
+                                      external_regions=external_regions)
     self.cur_segment = ""
+    self.ax = 0
+
+  def get_state(self):
+    state = super(MSDOS_Trace, self).get_state()
+    state["ax"] = self.ax
+    return state
+
+  def set_state(self, state):
+    super(MSDOS_Trace, self).set_state(state)
+    self.ax = state["ax"]
 
   def imm16(self, v):
-    if v in self.subroutines.keys():
-      return self.subroutines[v][0]
-    elif v in self.variables.keys():
-      return self.variables[v][0]
-    else:
-      return hex16(v)
+    return self.symbols.value(v)
 
 
   def get_label(self, addr):
-    if addr in self.subroutines.keys():
-      return self.subroutines[addr][0]
-    elif addr in self.variables.keys():
-      return self.variables[addr][0]
-    else:
-      return "LABEL_%04X" % addr
+    return self.symbols.label(addr)
 
 
   def output_disasm_headers(self):
     header = "; Generated by MSDOS_ExecTrace\n"
 
-    for addr, (label, comment) in self.subroutines.items():
-      header += "%s:\tequ %s\t; %s\n" % (label, hex16(addr), comment)
+    for sub in self.symbols.of_type(SUBROUTINE):
+      header += "%s:\tequ %s\t; %s\n" % (sub.name, hex16(sub.address), sub.comment)
+    header += self.external_stubs()
 
     return header
 
   def setup_ivt(self, addr, value):
     if addr % 4 == 0:
       print(f"Registering IVT entry: 0x{value:04X}")
-      self.schedule_entry_point(0x280 + value) # FIXME! the correct value will not always be 0x280 here.
-
-  def reg8(self, value):
-    return ["al", "cl", "dl", "bl",
-            "ah", "ch", "dh", "bh"][value & 7]
-
-  def reg16(self, value):
-    return ["ax", "cx", "dx", "bx",
-            "sp", "bp", "si", "di"][value & 7]
-
-  def ea_disp(self, r_m):
-    if r_m == 0: return "bx + si"
-    if r_m == 1: return "bx + di"
-    if r_m == 2: return "bp + si"
-    if r_m == 3: return "bp + di"
-    if r_m == 4: return "si"
-    if r_m == 5: return "di"
-    if r_m == 6: return "bp"
-    if r_m == 7: return "bx"
-
-  def segment_reg(self, value):
-    return ["es", "cs", "ss", "ds"][value & 3]
+      self.schedule_entry_point(0x280 + value, needs_label=True) # FIXME! the correct value will not always be 0x280 here.
+
+  def propagate(self, state, address, entry):
+    text = numeric_text(entry)
+    mnemonic, _, operands = text.partition(" ")
+    operands = [operand.strip() for operand in operands.split(",")] if operands else []
+    if mnemonic.startswith("j") or mnemonic in _UNTRACKED_EFFECTS:
+      if mnemonic == "cmp":
+        state.pop("cmp", None)
+        compare = _operand_value(self, state, operands[1], 16)
+        if operands[0] in _VALUE_REGISTERS and compare.__class__ is int:
+          state["cmp"] = (operands[0], compare)
+      elif mnemonic == "test":
+        state.pop("cmp", None)
+      return
+    if mnemonic not in _WRITE_FIRST_OPERAND or not operands:
+      # Such as calls, interrupts and string instructions:
+      state.clear()
+      return
+
+    register = operands[0]
+    if register not in _VALUE_REGISTERS:
+      if mnemonic not in ("mov", "pop"):
+        state.pop("cmp", None)
+      return
+    value = _propagated_value(self, state, mnemonic, operands)
+    compare = state.get("cmp")
+    if compare is not None and (mnemonic not in ("mov", "lea", "pop", "in") or
+                                _overlaps(compare[0], register)):
+      del state["cmp"]
+    REGISTERS_8086.set(state, register, value)
+
+  def branch_state(self, state, address, entry, taken):
+    # After "cmp reg, n", "jc" is taken when reg is below n,
+    # and "ja" is not taken when it is up to n:
+    compare = state.get("cmp")
+    mnemonic = numeric_text(entry).partition(" ")[0]
+    if compare is not None:
+      register, count = compare
+      if mnemonic == "jc" and taken:
+        REGISTERS_8086.set(state, register, bounded(state.get(register), count))
+      elif mnemonic == "ja" and not taken:
+        REGISTERS_8086.set(state, register, bounded(state.get(register), count + 1))
+    return state
+
+  def jump_value(self, state, address, entry):
+    text = numeric_text(entry)
+    if not text.startswith("jmp ") or text.startswith("jmp 0x"):
+      return None
+    operand = text[4:]
+    if operand in REG16:
+      return state.get(operand)
+    memory = _MEMORY_OPERAND.match(operand)
+    if memory is None or memory.group(1) is None:
+      return _operand_value(self, state, operand, 16)
+    # Without the decoding of shl, an index the code doubled before
+    # jumping through a table of words is unknown here:
+    index = state.get(memory.group(1))
+    if index is None or (index.__class__ is tuple and index[0] == INDEX and index[2] == 1):
+      index = double(index)
+    return load_word(self, add(index, int(memory.group(2) or "0", 16)))
+
+  def opcode_family(self, address, opcode):
+    # Prefixes are skipped, and opcodes whose ModRM byte
+    # extends them are told apart by its reg field:
+    code = self.read_bytes(address, 16)
+    for i, byte in enumerate(code):
+      if byte not in SEGMENT_PREFIXES and byte != REP_PREFIX:
+        handler = BASE_INSTRUCTIONS[byte][0]
+        if handler in _EXTENDED_BY_MODRM and i + 1 < len(code):
+          return "%02X /%d" % (byte, MODRM[code[i + 1]][1])
+        return "%02X" % byte
+    return "%02X" % opcode
+
+  def encode_instruction(self, address, entry):
+    if entry.__class__ is str:
+      text, values = entry, ()
+    else:
+      text, values = entry[0], entry[2:]
+
+    prefixes = bytearray()
+    if text.startswith("rep "):
+      prefixes.append(REP_PREFIX)
+      text = text[4:]
+    numbers = []
+    for value in values:
+      if value.__class__ is not str:
+        numbers.append(value)
+      elif value: # the segment override of _addr16()
+        prefixes.append(_OVERRIDE_PREFIXES[value])
+    override = _SEGMENT_OVERRIDE.search(text)
+    if override is not None:
+      prefixes.append(_OVERRIDE_PREFIXES[override.group(0)])
+      text = text[:override.start()] + text[override.end():]
+
+    encoding = ENCODINGS.get(text)
+    tokens = ()
+    if encoding is None:
+      key, tokens = _operand_template(text)
+      encoding = ENCODINGS.get(key)
+      if encoding is None:
+        return None
+
+    heads, operands, length = encoding
+    end = address + len(prefixes) + length
+    head = heads[0]
+    if len(heads) > 1:
+      # Any of the encodings an assembler may pick will do:
+      image_head = self.read_bytes(address + len(prefixes), len(head))
+      if image_head in heads:
+        head = image_head
+
+    encoded = prefixes + head
+    for operand, value in zip(operands, numbers):
+      if operand == _REL8_OPERAND or operand == _REL16_OPERAND:
+        value -= end
+        if operand == _REL8_OPERAND:
+          if not -128 <= value <= 127:
+            return None
+          encoded.append(value & 0xFF)
+          continue
+      if operand == _BYTE_OPERAND:
+        encoded.append(value & 0xFF)
+      else:
+        encoded += bytes((value & 0xFF, (value >> 8) & 0xFF))
+    for value, size in tokens:
+      encoded += value.to_bytes(size, "little")
+    return bytes(encoded)
 
   def disasm_instruction(self, opcode):
-
-    if opcode == 0x26:
-      self.cur_segment = "es:"
-      opcode = self.fetch()
-    elif opcode == 0x2e:
-      self.cur_segment = "" # CS:
-      opcode = self.fetch()
-    elif opcode == 0xf3:
-      return "rep " + self.disasm_instruction(self.fetch())
-
-    simple_instructions = {
-      0x06: "push es",
-      0x07: "pop es",
-      0x0e: "push cs",
-      0x16: "push ss",
-      0x17: "pop ss",
-      0x1e: "push ds",
-      0x1f: "pop ds",
-      0x50: "push ax",
-      0x58: "pop ax",
-      0x60: "pusha",
-      0x61: "popa",
-      0x90: "nop",
-      0x9c: "pushf",
-      0x9d: "popf",
-      0xa4: "movsb",
-      0xaa: "stosb",
-      0xab: "stosw",
-      0xac: "lodsb",
-      0xec: "in al, dx",
-      0xee: "out dx, al",
-      0xef: "out dx, ax",
-      0xf9: "stc",
-      0xfa: "cli",
-      0xfb: "sti",
-    }
-
-    if opcode in simple_instructions:
-      return simple_instructions[opcode]
-
-    elif opcode == 0x00: # FIXME!
-      imm = self.fetch()
-      return f"add FIXME:0x{imm:02X}"
-
-    elif opcode == 0x0b:
-      op1 = self.fetch()
-      reg = (op1 >> 3) & 7
-      r_m = op1 & 7
-      return f"or {self.reg16(reg)}, {self.reg16(r_m)}"
-
-    elif opcode == 0x0c:
-      imm = self.fetch()
-      return f"or al, 0x{imm:02X}"
-
-    elif opcode == 0x24:
-      imm = self.fetch()
-      return f"and al, 0x{imm:02X}"
-
-    elif opcode == 0x2b: # sub	reg  r/m
-      op1 = self.fetch()
-      reg = (op1 >> 3) & 7
-      r_m = op1 & 7
-      return f"sub {self.reg16(reg)}, {self.reg16(r_m)}"
-
-    elif opcode == 0x32: # xor 	reg8  r/m8
-      op1 = self.fetch()
-      reg = (op1 >> 3) & 7
-      r_m = op1 & 7
-      return f"xor {self.reg8(reg)}, {self.reg8(r_m)}"
-
-    elif opcode == 0x33: # xor 	reg16  r/m16
-      op1 = self.fetch()
-      reg = (op1 >> 3) & 7
-      r_m = op1 & 7
-      return f"xor {self.reg16(reg)}, {self.reg16(r_m)}"
-
-    elif opcode == 0x3d: # cmp ax, iw
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      return f"cmp ax, 0x{imm:04X}"
-
-    elif opcode & 0xE0 == 0x40:
-      reg = self.reg16(opcode & 7)
-      op = ["inc", "dec", "push", "pop"][(opcode >> 3) & 3] 
-      return f"{op} {reg}"
-
-    elif opcode == 0x68: # push iw
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      return f"push 0x{imm:04X}"
-
-    elif opcode == 0x6a: # push ib
-      imm = self.fetch()
-      return f"push 0x{imm:02X}"
-
-    elif opcode == 0x70: # jo addr
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "jo %s" % self.get_label(addr)
-
-    elif opcode == 0x72: # jc addr
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "jc %s" % self.get_label(addr)
-
-    elif opcode == 0x74: # je addr
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "je %s" % self.get_label(addr)
-
-    elif opcode == 0x75: # jne addr
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "jne %s" % self.get_label(addr)
-
-    elif opcode == 0x77: # ja addr
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "ja %s" % self.get_label(addr)
-
-    elif opcode == 0x7d: # jnl addr
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "jnl %s" % self.get_label(addr)
-
-    elif opcode == 0x7f: # jg addr
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "jg %s" % self.get_label(addr)
-
-    elif opcode & 0xFE == 0x80:
-      op1 = self.fetch()
-      op = ["add", "or", "adc", "sbb",
-            "and", "sub", "xor", "cmp"][(op1 >> 3) & 7]
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      imm = self.fetch()
-      if opcode & 1:
-        imm = self.fetch() << 8 | imm
-        return f"{op} [{self.getVariableName(addr)}], 0x{imm:04X}"
-      else:
-        return f"{op} [{self.getVariableName(addr)}], 0x{imm:02X}"
-
-#    elif opcode & 0xFE == 0x82:
-#      op1 = self.fetch()
-#      op = ["add", None, "adc", "sbb",
-#            None, "sub", None, "cmp"][(op1 >> 3) & 7]
-#      addr = self.fetch()
-#      addr = addr | (self.fetch() << 8)
-#      imm = self.fetch()
-#      if op:
-#        if opcode & 1:
-#          return f"{op} [{self.getVariableName(addr)}], 0x{imm:02X}"
-#        else:
-#          return f"{op} [{self.getVariableName(addr)}], 0x{imm:02X}"
-#      else:
-#        self.illegal_instruction(opcode << 8 | op1)
-#        return ""
-	
-    elif opcode == 0x83: # op r/m, ib
-      op1 = self.fetch()
-      imm = self.fetch()
-
-      mod = (op1 >> 6) & 3
-      op = ["add", "or", "adc", "sbb",
-            "and", "sub", "xor", "cmp"][(op1 >> 3) & 7]
-      if mod == 0b11:
-        reg = self.reg16(op1 & 7)
-        return f"{op} {reg}, 0x{imm:02X}"
-      else:
-        imm2 = self.fetch()
-        ea = self.ea_disp(op1 & 7)
-        return f"{op} [{ea} + 0x{imm:02X}], 0x{imm2:02X}"
-
-    elif opcode & 0xFC == 0x88: # DATA TRANSFER
-                                # MOV = Move
-                                # Register/Memory to/from Register
-                                # 100010 d w | mod reg r/m
-      op1 = self.fetch()
-      d = (opcode >> 1) & 1
-      w = opcode & 1
-      mod = (op1 >> 6) & 3
-      reg = (op1 >> 3) & 7
-      r_m = op1 & 7
-      reg_str = self.segment_reg(reg)
-
-      if mod == 0b11: # r/m is treated as a REG field
-        if w==0: # byte instruction
-          r_m_str = self.reg8(r_m)
-        else:
-          r_m_str = self.reg16(r_m)
-
-        if d==0: # from reg
-          return f"mov {r_m_str}, {reg_str}"
-        else: # d==1: to reg
-          return f"mov {reg_str}, {r_m_str}"
-
-      elif mod == 0b00: # ...FIXME!
-        if op1 & 7 == 5:
-          ea = self.ea_disp(op1 & 7)
-          if w==0:
-            reg_str = self.reg8(reg)
-          else:
-            reg_str = self.reg16(reg)
-          return f"mov {reg_str}, {self.cur_segment}[{ea}]"
-
-        elif op1 & 7 == 6:
-          imm = self.fetch()
-          imm = imm | (self.fetch() << 8)
-          if reg_str == "ax":
-            self.ax = imm
-          return f"mov {reg_str}, {self.cur_segment}[{self.getVariableName(imm)}]"
-
-      # FIXME!
-      self.illegal_instruction(opcode << 8 | op1)
-      return ""
-
-    elif opcode == 0x8c: # DATA TRANSFER
-                         # MOV = Move
-                         # Segment Register to Register/Memory
-                         # 10001100 mod 0 reg r/m
-      op1 = self.fetch()
-      mod = (op1 >> 6) & 3
-      zero = (op1 >> 5) & 1; assert zero == 0
-      reg = (op1 >> 3) & 3
-      r_m = op1 & 7
-      if mod == 0b11: # r/m is treated as a REG field
-        return f"mov {self.reg16(r_m)}, {self.segment_reg(reg)}"
-      else:
-        # FIXME!
-        self.illegal_instruction(opcode << 8 | op1)
-        return ""
-
-    elif opcode == 0x8e: # MOV 	Seg 	r/m
-      op1 = self.fetch()
-      reg = (op1 >> 3) & 3
-      r_m = op1 & 7
-      return f"mov {self.segment_reg(reg)}, {self.reg16(r_m)}"
-
-    elif opcode == 0x8f:
-      foo = self.fetch()
-      if foo == 0x06:
-        imm = self.fetch()
-        imm = imm | (self.fetch() << 8)
-        return f"pop {self.cur_segment}[{self.getVariableName(imm)}]"
-      else:
-        self.illegal_instruction(opcode << 8 | foo)
-        return ""
-
-    elif opcode == 0xa0: # mov al, [iw]
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      return f"mov al, [0x{imm:04X}]"
-
-    elif opcode == 0xa2:
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      return f"mov {self.cur_segment}[{self.getVariableName(imm)}], al"
-
-    elif opcode == 0xa8:
-      imm = self.fetch()
-      return f"test al, 0x{imm:02X}"
-
-    elif opcode == 0xb0: # mov al, ib
-      imm = self.fetch()
-      return f"mov al, 0x{imm:02X}"
-
-    elif opcode == 0xb4: # mov ah, ib
-      imm = self.fetch()
-      try:
-        self.ax = imm << 8 | (self.ax & 0xFF)
-      except:
-        self.ax = imm << 8
-      return f"mov ah, 0x{imm:02X}"
-
-    elif opcode == 0xb8: # mov ax, iw
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      self.ax = imm
-      return f"mov ax, 0x{imm:04X}"
-
-    elif opcode == 0xb9: # mov cx, iw
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      return f"mov cx, 0x{imm:04X}"
-
-    elif opcode == 0xba: # mov dx, iw
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      return f"mov dx, 0x{imm:04X}"
-
-    elif opcode == 0xbb: # mov bx, iw
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      return f"mov bx, 0x{imm:04X}"
-
-    elif opcode == 0xbe:
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      return f"lea si, 0x{imm:04X}"
-
-    elif opcode == 0xbf:
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      return f"lea di, 0x{imm:04X}"
-
-    elif opcode == 0xc3: # return from subroutine
-      self.return_from_subroutine()
-      return "retn"
-
-    elif opcode == 0xcd: # int n
-      imm = self.fetch()
-      if self.ax & 0xff00 == 0x4C00 and imm == 0x21:
-        # Program has ended and asked to return to DOS
-        self.restart_from_another_entry_point()
-      return f"int 0x{imm:02X}"
-
-    elif opcode == 0xcf: # iret
-      self.return_from_subroutine()
-      return "iret"
-
-    elif opcode == 0xc6: # mov ??, ?? FIXME!
-      foo = self.fetch()
-      if foo == 0x06:
-        addr = self.fetch()
-        addr = addr | (self.fetch() << 8)
-
-        imm = self.fetch()
-        return f"mov [0x{addr:04X}], 0x{imm:02X}"
+    # Segment overrides only apply to the instruction they prefix.
+    self.cur_segment = ""
+    rep = False
+    while True:
+      if opcode in SEGMENT_PREFIXES:
+        self.cur_segment = SEGMENT_PREFIXES[opcode]
+      elif opcode == REP_PREFIX:
+        rep = True
       else:
-        self.illegal_instruction(opcode << 8 | foo)
-        return ""
-
-    elif opcode == 0xc7:
-      foo = self.fetch()
-      if foo == 0x06:
-        addr = self.fetch()
-        addr = addr | (self.fetch() << 8)
-
-        value = self.fetch()
-        value = value | (self.fetch() << 8)
-
-        # this is incomplete and may fail in some contexts:
-        if self.cur_segment == "es:" and value <= 0x03ff:
-          self.setup_ivt(addr, value)
+        break
+      opcode = self.fetch()
 
-        return f"mov {self.cur_segment}[0x{addr:04X}], 0x{value:04X}"
-      else:
-        self.illegal_instruction(opcode << 8 | foo)
-        return ""
-
-    elif opcode == 0xe2:
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "loop %s" % self.get_label(addr)
-
-    elif opcode == 0xe4:
-      imm = self.fetch()
-      return f"in al, 0x{imm:02X}"
-
-    elif opcode == 0xe6:
-      imm = self.fetch()
-      return f"out 0x{imm:02X}, al"
-
-    elif opcode == 0xe8:
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      addr = (self.PC + twos_compl16(addr)) & 0xFFFF
-      self.subroutine(addr)
-      return "call %s" % self.get_label(addr)
-
-    elif opcode == 0xe9:
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      addr = (self.PC + twos_compl16(addr)) & 0xFFFF
-      self.unconditional_jump(addr)
-      return "jmp %s" % self.get_label(addr)
-
-    elif opcode == 0xeb:
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.unconditional_jump(addr)
-      return "jmp %s" % self.get_label(addr)
-
-    elif opcode == 0xf7: #FIXME!
-      foo = self.fetch()
-      if foo == 0xdb:
-        return f"neg bx"
-      elif foo == 0xc1:
-        imm = self.fetch()
-        return f"test cx, 0x{imm:02X}"
-      elif foo == 0xe1:
-        return f"mul cx"
-      elif foo == 0xe3:
-        return f"mul bx"
-      else:
-        self.illegal_instruction(opcode << 8 | foo)
-        return ""
-
-    elif opcode == 0xff: # push ... FIXME!
-      op1 = self.fetch()
-      if op1 == 0x36:
-        imm = self.fetch()
-        imm = imm | (self.fetch() << 8)
-        return f"push {self.cur_segment}[0x{imm:04X}]"
-      elif op1 == 0x1e:
-        imm = self.fetch()
-        imm = imm | (self.fetch() << 8)
-        return f"call dword ptr {self.cur_segment}[0x{imm:04X}]"
-      else:
-        self.illegal_instruction(opcode << 8 | op1)
-        return ""
+    handler, template = BASE_INSTRUCTIONS[opcode]
+    if handler is None:
+      instruction = template
     else:
-      self.illegal_instruction(opcode)
-      return "; DISASM ERROR! Illegal instruction (opcode = %s)" % hex8(opcode)
-
-if __name__ == '__main__':
-  if len(sys.argv) != 2:
-    print("usage: {} <filename.exe>".format(sys.argv[0]))
-  else:
-    program = sys.argv[1]
-    print("disassembling {}...".format(program))
-
-    # MZ DOS header format described at:
-    # http://www.delorie.com/djgpp/doc/exe/
-    #
-    # And also here:
-    # https://web.archive.org/web/20100420081240/http://www.frontiernet.net:80/~fys/exehdr.htm
-    exe = open(program ,"rb")
+      instruction = handler(self, template)
+    if rep:
+      if isinstance(instruction, tuple):
+        return ("rep " + instruction[0],) + instruction[1:]
+      return "rep " + instruction
+    return instruction
+
+def read_mz_header(program):
+  ''' Parses the header of a MZ DOS executable.
+      Returns a dict with its fields, the relocation table and
+      the entry point and relocation blocks to trace it with.
+  '''
+  # MZ DOS header format described at:
+  # http://www.delorie.com/djgpp/doc/exe/
+  #
+  # And also here:
+  # https://web.archive.org/web/20100420081240/http://www.frontiernet.net:80/~fys/exehdr.htm
+  with open(program, "rb") as exe:
     header = exe.read(0x1B)
     image_last_page_size = header[0x03] << 8 | header[0x02]
-    image_num_pages = header[0x05] << 8 | header[0x04]    
+    image_num_pages = header[0x05] << 8 | header[0x04]
     num_relocs = header[0x07] << 8 | header[0x06]
-    header_size = header[0x09] << 8 | header[0x08]    
+    header_size = header[0x09] << 8 | header[0x08]
     initial_IP = header[0x15] << 8 | header[0x14]
     initial_CS = header[0x17] << 8 | header[0x16]
     reloc_table_offset = header[0x19] << 8 | header[0x18]
@@ -557,24 +810,35 @@ if __name__ == '__main__':
       segment = reloc_table[4*i + 3] << 8 | reloc_table[4*i + 2]
       exe_relocs.append((offset, segment))
 
-    exe.close()
+  image_size = image_last_page_size + 512 * image_num_pages
+  return {"initial_CS": initial_CS,
+          "initial_IP": initial_IP,
+          "header_size": header_size,
+          "image_size": image_size,
+          "reloc_table_offset": reloc_table_offset,
+          "relocations": exe_relocs,
+          "entry_point": initial_CS * 16 + initial_IP,
+          "relocation_blocks": [(header_size*16, 0, image_size)]}
 
-    image_size = image_last_page_size + 512 * image_num_pages
+if __name__ == '__main__':
+  if len(sys.argv) != 2:
+    print("usage: {} <filename.exe>".format(sys.argv[0]))
+  else:
+    program = sys.argv[1]
+    print("disassembling {}...".format(program))
 
-    print(f"Initial CS:IP = {initial_CS:04X}:{initial_IP:04X}\n"
-          f"Num Relocs = {num_relocs}\n"
-          f"Header size = {header_size} paragraphs = {header_size*16} bytes\n"
-          f"Image size = {image_size} bytes\n"
+    mz = read_mz_header(program)
+    print(f"Initial CS:IP = {mz['initial_CS']:04X}:{mz['initial_IP']:04X}\n"
+          f"Num Relocs = {len(mz['relocations'])}\n"
+          f"Header size = {mz['header_size']} paragraphs = {mz['header_size']*16} bytes\n"
+          f"Image size = {mz['image_size']} bytes\n"
           f"program = {program}\n"
-          f"Reloc. Table Offset = {reloc_table_offset:04X}\n"
+          f"Reloc. Table Offset = {mz['reloc_table_offset']:04X}\n"
           f"Relocations:")
-    for reloc in exe_relocs:
+    for reloc in mz["relocations"]:
       print(f"  offset:{reloc[0]:04X} segment:{reloc[1]:04X}")
 
-    entry =  initial_CS * 16 + initial_IP
-    reloc = [(header_size*16, 0, image_size)]
-
     trace = MSDOS_Trace(program,
-                        relocation_blocks=reloc)
-    trace.run(entry_points=[entry])
+                        relocation_blocks=mz["relocation_blocks"])
+    trace.run(entry_points=[mz["entry_point"]])
     trace.save_disassembly_listing("{}.asm".format(program.split(".")[0]))
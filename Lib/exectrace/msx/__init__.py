@@ -5,9 +5,13 @@
 # Instruction set described at http://clrhome.org/table/
 # MSX BIOS calls documented at http://www.tabalabs.com.br/msx/msx_tech_hb/msxtech_tabalabs.pdf
 #
+import re
 import sys
 
-from exectrace import ExecTrace, ERROR, hex8, hex16
+from exectrace import ExecTrace, ExternalRegion, ERROR, DFS, SUBROUTINE, hex8, hex16
+from exectrace import NUMBER, BYTE, SYMBOL, TARGET, CALL_TARGET
+from exectrace.resolve import RegisterFile, numeric_text, add, combine, double, bounded
+from exectrace.resolve import load_byte, load_word
 
 
 MSX_BIOS_CALLS = {
@@ -28,68 +32,705 @@ MSX_BIOS_CALLS = {
   0x0144: ("PHYDIO", "Performs operation for mass storage devices such as disks."),
 }
 
+# Calls into the BIOS are given the names of its entry points
+# instead of being traced, unless the image maps these addresses:
+MSX_BIOS = ExternalRegion("MSX BIOS", 0x0000, 0x3FFF, MSX_BIOS_CALLS)
+
 def twos_compl(v):
   if v & (1 << 7):
     v -= (1 << 8)
   return v
 
 
+# Operand handlers for the decode tables below.
+# Each one receives the trace and the entry's template
+# and returns the disassembled instruction: either its text or a
+# (template, operand kinds, value, ...) tuple, only rendered as text
+# when the listing is written.
+
+_NUMBER = (NUMBER,)
+_NUMBERS = (NUMBER, NUMBER)
+_BYTE = (BYTE,)
+_SYMBOL = (SYMBOL,)
+_TARGET = (TARGET,)
+_CALL_TARGET = (CALL_TARGET,)
+
+def _stack_trick(trace, template):
+  # This may be used to change exec flow
+  # by changing the ret address in the stack
+  trace.register_stack_trick(trace.PC-1)
+  return template
+
+def _imm8(trace, template):
+  return (template, _BYTE, trace.fetch())
+
+def _imm16(trace, template):
+  imm = trace.fetch()
+  imm = imm | (trace.fetch() << 8)
+  return (template, _SYMBOL, imm)
+
+def _imm16_sp(trace, template):
+  imm = trace.fetch()
+  imm = imm | (trace.fetch() << 8)
+  trace.register_stack_trick(trace.PC-1)
+  return (template, _SYMBOL, imm)
+
+def _addr16(trace, template):
+  addr = trace.fetch()
+  addr = addr | (trace.fetch() << 8)
+  return (template, _SYMBOL, addr)
+
+def _addr16_sp(trace, template):
+  addr = trace.fetch()
+  addr = addr | (trace.fetch() << 8)
+  trace.register_stack_trick(trace.PC-1)
+  return (template, _SYMBOL, addr)
+
+def _rel8_branch(trace, template):
+  imm = trace.fetch()
+  addr = trace.PC + twos_compl(imm)
+  trace.conditional_branch(addr)
+  return (template, _TARGET, addr)
+
+def _rel8_jump(trace, template):
+  imm = trace.fetch()
+  addr = trace.PC + twos_compl(imm)
+  trace.unconditional_jump(addr)
+  return (template, _TARGET, addr)
+
+def _abs16_branch(trace, template):
+  addr = trace.fetch()
+  addr = addr | (trace.fetch() << 8)
+  trace.conditional_branch(addr)
+  return (template, _TARGET, addr)
+
+def _abs16_jump(trace, template):
+  addr = trace.fetch()
+  addr = addr | (trace.fetch() << 8)
+  trace.unconditional_jump(addr)
+  return (template, _TARGET, addr)
+
+def _call(trace, template):
+  addr = trace.fetch()
+  addr = addr | (trace.fetch() << 8)
+  trace.subroutine(addr)
+  return (template, _CALL_TARGET, addr)
+
+def _return(trace, template):
+  trace.return_from_subroutine()
+  return template
+
+def _conditional_return(trace, template):
+  trace.conditional_return()
+  return template
+
+def _jump_HL(trace, template):
+  trace.register_jump_HL(trace.PC-1)
+  trace.return_from_subroutine()
+  return template
+
+def _jump_index(trace, template):
+  trace.register_jump_HL(trace.PC-2)
+  trace.return_from_subroutine()
+  return template
+
+def _illegal(trace, template):
+  code, text = template
+  trace.illegal_instruction(code)
+  return text
+
+def _prefix(trace, table):
+  handler, template = table[trace.fetch()]
+  if handler is None:
+    return template
+  return handler(trace, template)
+
+def _index_offset(trace, template):
+  return (template, _NUMBER, trace.fetch())
+
+def _index_offset_imm8(trace, template):
+  offs = trace.fetch()
+  imm = trace.fetch()
+  return (template, _NUMBERS, offs, imm)
+
+def _index_bit(trace, table):
+  offs = trace.fetch()
+  return (table[trace.fetch()], _BYTE, offs)
+
+
+REG8 = ['b', 'c', 'd', 'e', 'h', 'l', '(hl)', 'a']
+REG16 = ['bc', 'de', 'hl', 'sp']
+REG16_AF = ['bc', 'de', 'hl', 'af']
+CONDITIONS = ['nz', 'z', 'nc', 'c', 'po', 'pe', 'p', 'm']
+ALU = ['add a,', 'adc a,', 'sub', 'sbc a,', 'and', 'xor', 'or', 'cp']
+ROTATIONS = ['rlc', 'rrc', 'rl', 'rr', 'sla', 'sra', 'sll', 'srl']
+
+
+def _build_base_instructions():
+  simple_instructions = {
+    0x00: "nop",
+    0x02: "ld (bc), a",
+    0x07: "rlca",
+    0x08: "ex af, af'",
+    0x0a: "ld a, (bc)",
+    0x0f: "rrca",
+    0x12: "ld (de), a",
+    0x17: "rla",
+    0x1a: "ld a, (de)",
+    0x1f: "rra",
+    0x27: "daa",
+    0x2f: "cpl",
+    0x37: "scf",
+    0x3f: "ccf",
+    0xd9: "exx",
+    0xe3: "ex (sp), hl",
+    0xeb: "ex de, hl",
+    0xf3: "di",
+    0xfb: "ei",
+  }
+  relative_branches = {
+    0x10: "djnz %s",
+    0x20: "jr nz, %s",
+    0x28: "jr z, %s",
+    0x30: "jr nc, %s",
+    0x38: "jr c, %s",
+  }
+  port_accesses = {
+    0xd3: "out (%s), a",
+    0xdb: "in a, (%s)",
+  }
+  variable_accesses = {
+    0x22: "ld (%s), hl",
+    0x2A: "ld hl, (%s)",
+    0x32: "ld (%s), a",
+    0x3a: "ld a, (%s)",
+  }
+
+  table = []
+  for opcode in range(256):
+    rp = REG16[(opcode >> 4) & 3]
+    if opcode in simple_instructions:
+      entry = (None, simple_instructions[opcode])
+    elif opcode == 0xf9:
+      entry = (_stack_trick, "ld sp, hl")
+    elif opcode & 0xCF == 0x01: # ld reg16, word
+      entry = (_imm16_sp if rp == 'sp' else _imm16, "ld %s, %%s" % rp)
+    elif opcode & 0xCF == 0x03: # inc reg16
+      entry = (_stack_trick if rp == 'sp' else None, "inc %s" % rp)
+    elif opcode & 0xC7 == 0x04: # inc reg8
+      entry = (None, "inc %s" % REG8[(opcode >> 3) & 7])
+    elif opcode & 0xC7 == 0x05: # dec reg8
+      entry = (None, "dec %s" % REG8[(opcode >> 3) & 7])
+    elif opcode & 0xC7 == 0x06: # ld reg8, byte
+      entry = (_imm8, "ld %s, %%s" % REG8[(opcode >> 3) & 7])
+    elif opcode & 0xCF == 0x09: # add hl, reg16
+      entry = (None, "add hl, %s" % rp)
+    elif opcode & 0xCF == 0x0B: # dec reg16
+      entry = (_stack_trick if rp == 'sp' else None, "dec %s" % rp)
+    elif opcode in relative_branches:
+      entry = (_rel8_branch, relative_branches[opcode])
+    elif opcode == 0x18:
+      entry = (_rel8_jump, "jr %s")
+    elif opcode in variable_accesses:
+      entry = (_addr16, variable_accesses[opcode])
+    elif opcode in port_accesses:
+      entry = (_imm8, port_accesses[opcode])
+    elif opcode == 0x76:
+      entry = (_return, "halt")
+    elif opcode & 0xC0 == 0x40: # ld reg8, reg8
+      entry = (None, "ld %s, %s" % (REG8[(opcode >> 3) & 7], REG8[opcode & 7]))
+    elif opcode & 0xC0 == 0x80: # alu a, reg8
+      entry = (None, "%s %s" % (ALU[(opcode >> 3) & 7], REG8[opcode & 7]))
+    elif opcode & 0xC7 == 0xC0: # conditional ret
+      entry = (_conditional_return, "ret %s" % CONDITIONS[(opcode >> 3) & 7])
+    elif opcode & 0xCF == 0xC1: # pop reg
+      entry = (None, "pop %s" % REG16_AF[(opcode >> 4) & 3])
+    elif opcode & 0xC7 == 0xC2: # jp cond, **
+      entry = (_abs16_branch, "jp %s, %%s" % CONDITIONS[(opcode >> 3) & 7])
+    elif opcode & 0xC7 == 0xC4: # conditional CALL
+      entry = (_call, "call %s, %%s" % CONDITIONS[(opcode >> 3) & 7])
+    elif opcode & 0xCF == 0xC5: # push reg
+      entry = (None, "push %s" % REG16_AF[(opcode >> 4) & 3])
+    elif opcode & 0xC7 == 0xC6: # alu a, byte
+      entry = (_imm8, "%s %%s" % ALU[(opcode >> 3) & 7])
+    elif opcode & 0xC7 == 0xC7: # rst
+      entry = (_return, "rst %s" % hex8(((opcode >> 3) & 7) * 0x08))
+    elif opcode == 0xC3: # jump addr
+      entry = (_abs16_jump, "jp %s")
+    elif opcode == 0xC9: # RET
+      entry = (_return, "ret")
+    elif opcode == 0xCB: # BIT INSTRUCTIONS:
+      entry = (_prefix, CB_INSTRUCTIONS)
+    elif opcode == 0xCD: # CALL
+      entry = (_call, "call %s")
+    elif opcode == 0xDD: # IX INSTRUCTIONS:
+      entry = (_prefix, IX_INSTRUCTIONS)
+    elif opcode == 0xFD: # IY INSTRUCTIONS:
+      entry = (_prefix, IY_INSTRUCTIONS)
+    elif opcode == 0xE9:
+      entry = (_jump_HL, "jp (hl)")
+    elif opcode == 0xED: # EXTENDED INSTRUCTIONS:
+      entry = (_prefix, ED_INSTRUCTIONS)
+    else:
+      entry = (_illegal, (opcode, "; DISASM ERROR! Illegal instruction (opcode = %s)" % hex8(opcode)))
+    table.append(entry)
+  return table
+
+
+def _build_bit_instructions(operand):
+  table = []
+  for ext_opcode in range(256):
+    n = (ext_opcode >> 3) & 7
+    if operand is None:
+      target = REG8[ext_opcode & 7]
+    else:
+      target = operand
+    if ext_opcode & 0xC0 == 0x00: # bit rotates and shifts
+      table.append("%s %s" % (ROTATIONS[n], target))
+    elif ext_opcode & 0xC0 == 0x40: # bit n, ??
+      table.append("bit %d, %s" % (n, target))
+    elif ext_opcode & 0xC0 == 0x80: # res n, ??
+      table.append("res %d, %s" % (n, target))
+    else: # set n, ??
+      table.append("set %d, %s" % (n, target))
+  return table
+
+
+def _build_extended_instructions():
+  simple_instructions = {
+    0x44: "neg",
+    0x49: "out (c), c",
+    0x4C: "neg",
+    0x52: "sbc hl, de",
+    0x54: "neg",
+    0x56: "im 1",
+    0x59: "out (c), e",
+    0x5C: "neg",
+    0x64: "neg",
+    0x69: "out (c), l",
+    0x6C: "neg",
+    0x74: "neg",
+    0x79: "out (c), a",
+    0x7C: "neg",
+    0xb0: "ldir",
+  }
+
+  table = []
+  for ext_opcode in range(256):
+    rp = REG16[(ext_opcode >> 4) & 3]
+    if ext_opcode in simple_instructions:
+      entry = (None, simple_instructions[ext_opcode])
+    elif ext_opcode & 0xCF == 0x43:
+      entry = (_addr16, "ld (%%s), %s" % rp)
+    elif ext_opcode & 0xCF == 0x4B:
+      entry = (_addr16_sp if rp == 'sp' else _addr16, "ld %s, (%%s)" % rp)
+    else:
+      entry = (_illegal, ((0xED << 8) | ext_opcode,
+                          "; DISASM ERROR! Illegal extended instruction (ext_opcode = %s)" % hex8(ext_opcode)))
+    table.append(entry)
+  return table
+
+
+def _build_index_instructions(opcode, ireg):
+  simple_instructions = {
+    0x09: "add %s, bc",
+    0x19: "add %s, de",
+    0x23: "inc %s",
+    0x29: "add %s, ix",
+    0x39: "add %s, sp",
+    0xE1: "pop %s",
+    0xE5: "push %s",
+  }
+
+  table = []
+  for i_opcode in range(256):
+    if i_opcode in simple_instructions:
+      entry = (None, simple_instructions[i_opcode] % ireg)
+    elif i_opcode == 0x21:
+      entry = (_imm16, "ld %s, %%s" % ireg)
+    elif i_opcode == 0x34:
+      entry = (_index_offset, "inc (%s + %%s)" % ireg)
+    elif i_opcode == 0x35:
+      entry = (_index_offset, "dec (%s + %%s)" % ireg)
+    elif i_opcode == 0x36:
+      entry = (_index_offset_imm8, "ld (%s + %%s), %%s" % ireg)
+    elif i_opcode & 0xCF == 0x4E:
+      entry = (_index_offset, "ld %s, (%s + %%s)" % (['c', 'e', 'l', 'a'][(i_opcode >> 4) & 3], ireg))
+    elif i_opcode in [0x46, 0x56, 0x66]:
+      entry = (_index_offset, "ld %s, (%s + %%s)" % (['b', 'd', 'h'][(i_opcode >> 4) & 3], ireg))
+    elif i_opcode in [0x70, 0x71, 0x72, 0x73, 0x74, 0x75, 0x77]:
+      entry = (_index_offset, "ld (%s + %%s), %s" % (ireg, REG8[i_opcode & 7]))
+    elif i_opcode & 0xCF == 0x86:
+      entry = (_index_offset, "%s (%s + %%s)" % (['add a,', 'sub', 'and', 'or'][(i_opcode >> 4) & 3], ireg))
+    elif i_opcode & 0xCF == 0x8E:
+      entry = (_index_offset, "%s (%s + %%s)" % (['adc a,', 'sbc', 'xor', 'cp'][(i_opcode >> 4) & 3], ireg))
+    elif i_opcode == 0xE9:
+      entry = (_jump_index, "jp (%s)" % ireg)
+    elif i_opcode == 0xCB: # BIT INSTRUCTIONS:
+      entry = (_index_bit, _build_bit_instructions("(%s + %%s)" % ireg))
+    else:
+      entry = (_illegal, ((opcode << 8) | i_opcode,
+                          "; DISASM ERROR! Illegal %s instruction (%s_opcode = %s)" % (ireg, ireg, hex8(i_opcode))))
+    table.append(entry)
+  return table
+
+
+# Decode tables, indexed by opcode, holding (handler, template) pairs.
+# A handler of None means the template is the whole instruction text.
+CB_INSTRUCTIONS = [(None, text) for text in _build_bit_instructions(None)]
+ED_INSTRUCTIONS = _build_extended_instructions()
+IX_INSTRUCTIONS = _build_index_instructions(0xDD, "ix")
+IY_INSTRUCTIONS = _build_index_instructions(0xFD, "iy")
+BASE_INSTRUCTIONS = _build_base_instructions()
+
+
+# How the operand values of each handler's entries are encoded,
+# as the bytes that follow the opcode:
+_BYTE_OPERAND = "byte"
+_WORD_OPERAND = "word"
+_REL8_OPERAND = "rel8"
+_OPERAND_ENCODINGS = {
+  _imm8: (_BYTE_OPERAND,),
+  _imm16: (_WORD_OPERAND,),
+  _imm16_sp: (_WORD_OPERAND,),
+  _addr16: (_WORD_OPERAND,),
+  _addr16_sp: (_WORD_OPERAND,),
+  _rel8_branch: (_REL8_OPERAND,),
+  _rel8_jump: (_REL8_OPERAND,),
+  _abs16_branch: (_WORD_OPERAND,),
+  _abs16_jump: (_WORD_OPERAND,),
+  _call: (_WORD_OPERAND,),
+  _index_offset: (_BYTE_OPERAND,),
+  _index_offset_imm8: (_BYTE_OPERAND, _BYTE_OPERAND),
+  _index_bit: (_BYTE_OPERAND,),
+}
+
+
+def _build_encodings():
+  ''' Inverts the decode tables, mapping the template of each entry
+      to the (opcode bytes, operand encodings, trailing bytes, length)
+      of the instructions decoded to it. Where several opcodes decode
+      to the same text, the first one in table order (the one without
+      prefix, or the lowest one) is what an assembler would pick.
+  '''
+  encodings = {}
+  def add(template, code, operands, trailer):
+    length = len(code) + len(trailer) + sum(2 if operand == _WORD_OPERAND else 1
+                                            for operand in operands)
+    encodings.setdefault(template, (code, operands, trailer, length))
+
+  def walk(table, prefix):
+    for opcode, (handler, template) in enumerate(table):
+      code = prefix + bytes([opcode])
+      if handler is _prefix:
+        walk(template, code)
+      elif handler is _index_bit:
+        # DD CB <offset> <opcode>: the opcode comes after the operand.
+        # All 8 register fields decode the same, the documented one being 6:
+        for bit_opcode in sorted(range(256), key=lambda op: op & 7 != 6):
+          add(template[bit_opcode], code, _OPERAND_ENCODINGS[handler], bytes([bit_opcode]))
+      elif handler is _illegal:
+        add(template[1], code, (), b"")
+      else:
+        add(template, code, _OPERAND_ENCODINGS.get(handler, ()), b"")
+  walk(BASE_INSTRUCTIONS, b"")
+  return encodings
+
+ENCODINGS = _build_encodings()
+
+
+# Registers read and written by each instruction, told from its text.
+# Registers are named in upper case, and IXH, IXL, IYH and IYL count
+# as IX and IY.
+
+_PAIRS = {"af": ("A", "F"), "bc": ("B", "C"), "de": ("D", "E"), "hl": ("H", "L")}
+_NAMES = dict(_PAIRS)
+_NAMES.update({r: (r.upper(),) for r in "abcdehl"})
+_NAMES.update({"ix": ("IX",), "ixh": ("IX",), "ixl": ("IX",),
+               "iy": ("IY",), "iyh": ("IY",), "iyl": ("IY",)})
+
+_MEMORY = re.compile(r"\((hl|bc|de|ix|iy|c)\b")
+
+_BLOCK_TRANSFERS = {
+  "ldi": "BCDEHL", "ldd": "BCDEHL", "ldir": "BCDEHL", "lddr": "BCDEHL",
+  "cpi": "BCHL", "cpd": "BCHL", "cpir": "BCHL", "cpdr": "BCHL",
+  "ini": "BHL", "ind": "BHL", "inir": "BHL", "indr": "BHL",
+  "outi": "BHL", "outd": "BHL", "otir": "BHL", "otdr": "BHL",
+}
+_ARITHMETIC = ("add", "adc", "sub", "sbc", "and", "or", "xor", "cp")
+
+
+def registers_of(operand):
+  ''' The registers an operand names, as a tuple. '''
+  return _NAMES.get(operand, ())
+
+
+def address_registers(operand):
+  ''' The registers read to get the address of a memory operand. '''
+  memory = _MEMORY.match(operand)
+  if memory is None:
+    return ()
+  if memory.group(1) == "c":
+    return ("B", "C")  # the port of "in r, (c)" is BC
+  return registers_of(memory.group(1))
+
+
+def instruction_effects(text):
+  ''' Returns the (read, written) sets of registers of a decoded
+      instruction given by its text. Calls, returns and jumps only
+      read their condition, and SP, I and R are not tracked.
+  '''
+  mnemonic, _, operands = text.partition(" ")
+  operands = [operand.strip() for operand in operands.split(",")] if operands else []
+  read = set()
+  written = set()
+  for operand in operands:
+    read.update(address_registers(operand))
+
+  if mnemonic == "ld":
+    dst, src = operands
+    written.update(registers_of(dst))
+    read.update(registers_of(src))
+    if src in ("i", "r"):
+      written.add("F")
+  elif mnemonic == "push":
+    read.update(registers_of(operands[0]))
+  elif mnemonic == "pop":
+    written.update(registers_of(operands[0]))
+  elif mnemonic == "ex":
+    for operand in operands:
+      registers = registers_of(operand.rstrip("'"))
+      read.update(registers)
+      written.update(registers)
+  elif mnemonic == "exx":
+    read.update("BCDEHL")
+    written.update("BCDEHL")
+  elif mnemonic in _ARITHMETIC:
+    if len(operands) == 1:
+      operands = ["a"] + operands
+    dst, src = operands
+    read.update(registers_of(dst))
+    read.update(registers_of(src))
+    if mnemonic in ("adc", "sbc"):
+      read.add("F")
+    if mnemonic != "cp":
+      written.update(registers_of(dst))
+    written.add("F")
+  elif mnemonic in ("inc", "dec"):
+    registers = registers_of(operands[0])
+    read.update(registers)
+    written.update(registers)
+    if len(registers) < 2 and operands[0] not in ("ix", "iy"):
+      written.add("F")
+  elif mnemonic in ("rlca", "rrca", "rla", "rra", "cpl", "neg", "daa"):
+    read.add("A")
+    written.update(("A", "F"))
+    if mnemonic in ("rla", "rra", "daa"):
+      read.add("F")
+  elif mnemonic in ("scf", "ccf"):
+    read.add("F")
+    written.add("F")
+  elif mnemonic in ROTATIONS:
+    for operand in operands:
+      written.update(registers_of(operand))
+    read.update(registers_of(operands[0]))
+    written.add("F")
+    if mnemonic in ("rl", "rr"):
+      read.add("F")
+  elif mnemonic == "bit":
+    read.update(registers_of(operands[1]))
+    written.add("F")
+  elif mnemonic in ("set", "res"):
+    for operand in operands[1:]:
+      written.update(registers_of(operand))
+    read.update(registers_of(operands[1]))
+  elif mnemonic in ("rld", "rrd"):
+    read.add("A")
+    written.update(("A", "F"))
+  elif mnemonic in _BLOCK_TRANSFERS:
+    registers = _BLOCK_TRANSFERS[mnemonic]
+    read.update(registers)
+    written.update(registers)
+    written.add("F")
+    if mnemonic.startswith("cp"):
+      read.add("A")
+    elif mnemonic[:2] in ("in", "ou", "ot"):
+      read.add("C")
+  elif mnemonic == "in":
+    written.update(registers_of(operands[0]))
+    if operands[1] == "(c)":
+      written.add("F")
+    else:
+      read.add("A")  # "in a, (n)" puts A on the high half of the port
+  elif mnemonic == "out":
+    read.update(registers_of(operands[1]))
+    if operands[0] != "(c)":
+      read.add("A")
+  elif mnemonic == "djnz":
+    read.add("B")
+    written.add("B")
+  elif mnemonic in ("jp", "jr", "call", "ret"):
+    if operands and operands[0] in CONDITIONS:
+      read.add("F")
+    if operands and operands[0] in ("(hl)", "(ix)", "(iy)"):
+      read.update(address_registers(operands[0]))
+  return read, written
+
+
+# What instructions do to the values of registers, as propagated by
+# ExecTrace.resolve_computed_jumps() (see exectrace.resolve). The state
+# of the registers also keeps, as "cmp", the constant A was last
+# compared to, for the conditional branch that follows.
+Z80_REGISTERS = RegisterFile({"BC": ("B", "C"), "DE": ("D", "E"), "HL": ("H", "L")})
+_VALUE_REGISTERS = {"a": "A", "b": "B", "c": "C", "d": "D", "e": "E", "h": "H", "l": "L",
+                    "bc": "BC", "de": "DE", "hl": "HL", "ix": "IX", "iy": "IY"}
+_INDEXED = re.compile(r"\((ix|iy) \+ (\w+)\)$")
+_CONSTANT_OPERATIONS = {
+  "sub": lambda x, y: x - y,
+  "and": lambda x, y: x & y,
+  "or": lambda x, y: x | y,
+  "xor": lambda x, y: x ^ y,
+}
+
+def _operand_value(trace, state, operand, load):
+  ''' The value of a register or number, or of memory addressed
+      by them, read by the <load> function of exectrace.resolve.
+  '''
+  register = _VALUE_REGISTERS.get(operand)
+  if register is not None:
+    return state.get(register)
+  if operand.startswith("("):
+    indexed = _INDEXED.match(operand)
+    if indexed is not None:
+      offset = twos_compl(int(indexed.group(2), 0))
+      address = add(state.get(indexed.group(1).upper()), offset & 0xFFFF)
+    else:
+      address = _operand_value(trace, state, operand[1:-1], None)
+    if address is None or load is None:
+      return None
+    return load(trace, address)
+  try:
+    return int(operand, 0)
+  except ValueError:
+    return None
+
+def _propagated_value(trace, state, mnemonic, operands):
+  ''' Returns the register the instruction sets to a value that can
+      be worked out, and that value, or None.
+  '''
+  if mnemonic == "ld":
+    register = _VALUE_REGISTERS.get(operands[0])
+    if register is None:
+      return None
+    load = load_word if len(register) == 2 else load_byte
+    return register, _operand_value(trace, state, operands[1], load)
+
+  if mnemonic in _ARITHMETIC:
+    if len(operands) == 1:
+      operands = ["a"] + operands
+    register = _VALUE_REGISTERS.get(operands[0])
+    if register is None:
+      return None
+    bits = 16 if len(register) == 2 else 8
+    value = state.get(register)
+    if mnemonic == "add":
+      if operands[1] == operands[0]:
+        return register, double(value, bits)
+      return register, add(value, _operand_value(trace, state, operands[1], load_byte), bits)
+    if mnemonic in ("sub", "xor") and operands[1] == operands[0]:
+      return register, 0
+    if mnemonic in _CONSTANT_OPERATIONS:
+      operand = _operand_value(trace, state, operands[1], load_byte)
+      return register, combine(_CONSTANT_OPERATIONS[mnemonic], value, operand, 0xFF)
+    return None
+
+  if mnemonic in ("inc", "dec"):
+    register = _VALUE_REGISTERS.get(operands[0])
+    if register is None:
+      return None
+    mask = 0xFFFF if len(register) == 2 else 0xFF
+    return register, add(state.get(register), 1 if mnemonic == "inc" else mask, mask.bit_length())
+
+  if mnemonic in ("rlca", "sla"):
+    # As long as the top bit is clear, which it is for indexes:
+    register = _VALUE_REGISTERS.get(operands[0] if operands else "a")
+    if register is None:
+      return None
+    return register, double(state.get(register), 8)
+  return None
+
+
+
 class MSX_Trace(ExecTrace):
+  # The Z80 decoder only depends on the bytes it fetches and on trace.PC:
+  PARALLEL_CALLBACKS = ("subroutine",
+                        "return_from_subroutine",
+                        "conditional_return",
+                        "conditional_branch",
+                        "unconditional_jump",
+                        "illegal_instruction",
+                        "schedule_entry_point",
+                        "register_jump_HL",
+                        "register_stack_trick")
+
   def __init__(self,
                romfile,
                loglevel=ERROR,
                relocation_blocks=None,
-               variables={},
-               subroutines={},
-               stack_whitelist=[]):
-    # subroutines.update(MSX_BIOS_CALLS) # TODO: How can we make the disasm aware of the BIOS calls labels and addresses
-                                         #       but not attempt to disasm the BIOS?
+               variables=None,
+               subroutines=None,
+               stack_whitelist=None,
+               scheduling=DFS,
+               recent_events=0,
+               external_regions=(MSX_BIOS,)):
     super(MSX_Trace, self).__init__(romfile,
                                     loglevel,
                                     relocation_blocks,
                                     variables,
-                                    subroutines)
+                                    subroutines,
+                                    scheduling=scheduling,
+                                    recent_events=recent_events,
+                                    external_regions=external_regions)
     self.jump_HLs = []
     self.stack_tricks = []
-    self.stack_whitelist = stack_whitelist
+    self.stack_manipulations = []
+    self.stack_whitelist = list(stack_whitelist or [])
+
+  def get_state(self):
+    state = super(MSX_Trace, self).get_state()
+    state["jump_HLs"] = self.jump_HLs
+    state["stack_manipulations"] = self.stack_manipulations
+    return state
+
+  def set_state(self, state):
+    super(MSX_Trace, self).set_state(state)
+    self.jump_HLs = state["jump_HLs"]
+    # The whitelist may have changed since the state was saved:
+    self.stack_manipulations = state["stack_manipulations"]
+    self.stack_tricks = [addr for addr in self.stack_manipulations
+                         if addr not in self.stack_whitelist]
 
   def imm16(self, v):
-    if v in self.subroutines.keys():
-      if isinstance(self.subroutines[v], tuple):
-        return self.subroutines[v][0]
-      else: # is string:
-        return self.subroutines[v]
-    elif v in self.variables.keys():
-      return self.variables[v][0]
-    else:
-      return hex16(v)
+    return self.symbols.value(v)
 
   def get_subroutine_comment(self, addr):
-    if addr in self.subroutines.keys():
-      if isinstance(self.subroutines[addr], tuple):
-        return self.subroutines[addr][1]
-      else:
-        return None
+    return self.symbols.comment(addr)
 
   def get_label(self, addr):
-    if addr in self.subroutines.keys():
-      if isinstance(self.subroutines[addr], tuple):
-        return self.subroutines[addr][0]
-      else: # is string:
-        return self.subroutines[addr]
-    elif addr in self.variables.keys():
-      return self.variables[addr][0]
-    #elif addr < 0x4000:
-    #  sys.exit("Unknown BIOS call: %s" % hex16(addr))
-    else:
-      return "LABEL_%04X" % addr
+    return self.symbols.label(addr)
 
   def register_jump_HL(self, addr):
+    if self.fetch_failed_at is not None:
+      return
     if addr not in self.jump_HLs:
       self.jump_HLs.append(addr)
 
 
   def register_stack_trick(self, addr):
+    if self.fetch_failed_at is not None:
+      return
+    if addr not in self.stack_manipulations:
+      self.stack_manipulations.append(addr)
     if addr not in self.stack_tricks and \
        addr not in self.stack_whitelist:
       self.stack_tricks.append(addr)
@@ -98,8 +739,12 @@ class MSX_Trace(ExecTrace):
   def print_jp_HLs(self):
     if self.jump_HLs:
       print('\n"JP (HL)" instructions found at:\n')
+      resolved = self.jump_resolver.resolved if self.jump_resolver is not None else {}
       for j in self.jump_HLs:
-        print("\t0x%04X" % j)
+        if resolved.get(j):
+          print("\t0x%04X -> %s" % (j, ", ".join("0x%04X" % t for t in resolved[j])))
+        else:
+          print("\t0x%04X" % j)
 
 
   def print_stack_manipulation(self):
@@ -113,449 +758,97 @@ class MSX_Trace(ExecTrace):
     header = "; Generated by MSX_ExecTrace\n"
     header += "; git clone https://git.savannah.nongnu.org/git/z80asm.git\n\n"
 
-    for addr, v in self.subroutines.items():
-      if addr < 0x4000:
-        if isinstance(v, tuple):
-          label, comment = v
-          header += "%s:\tequ %s\t; %s\n" % (label, hex16(addr), comment)
+    for sub in self.symbols.of_type(SUBROUTINE):
+      if sub.address < 0x4000:
+        if sub.comment is not None:
+          header += "%s:\tequ %s\t; %s\n" % (sub.name, hex16(sub.address), sub.comment)
         else:
-          label = v
-          header += "%s:\tequ %s\n" % (label, hex16(addr))
+          header += "%s:\tequ %s\n" % (sub.name, hex16(sub.address))
+    header += self.external_stubs()
 
     return header
 
 
-  def disasm_instruction(self, opcode):
-
-    simple_instructions = {
-      0x00: "nop",
-      0x02: "ld (bc), a",
-      0x07: "rlca",
-      0x08: "ex af, af'",
-      0x0f: "rrca",
-      0x12: "ld (de), a",
-      0x17: "rla",
-      0x1a: "ld a, (de)",
-      0x1f: "rra",
-      0x27: "daa",
-      0x2f: "cpl",
-      0x37: "scf",
-      0xd9: "exx",
-      0xeb: "ex de, hl",
-      0xf3: "di",
-      0xfb: "ei",
-    }
-
-    if opcode in simple_instructions:
-      return simple_instructions[opcode]
-
-    elif opcode == 0xf9:
-      # This may be used to change exec flow
-      # by changing the ret address in the stack
-      self.register_stack_trick(self.PC-1)
-      return "ld sp, hl"
-
-    elif opcode & 0xCF == 0x01: # ld reg16, word
-      STR = ['bc', 'de', 'hl', 'sp']
-      imm = self.fetch()
-      imm = imm | (self.fetch() << 8)
-      if ((opcode >> 4) & 3) == 3:
-        self.register_stack_trick(self.PC-1)
-      return "ld %s, %s" % (STR[(opcode >> 4) & 3], self.imm16(imm))
-
-    elif opcode & 0xCF == 0x03: # inc reg16
-      STR = ['bc', 'de', 'hl', 'sp']
-      if ((opcode >> 4) & 3) == 3:
-        self.register_stack_trick(self.PC-1)
-      return "inc %s" % STR[(opcode >> 4) & 3]
-
-    elif opcode & 0xCF == 0x04: # inc reg8
-      STR = ['b', 'd', 'h', '(hl)']
-      return "inc %s" % STR[(opcode >> 4) & 3]
-
-    elif opcode & 0xCF == 0x05: # dec reg8
-      STR = ['b', 'd', 'h', '(hl)']
-      return "dec %s" % STR[(opcode >> 4) & 3]
-
-    elif opcode & 0xCF == 0x06: # ld _8, byte
-      STR = ['b', 'd', 'h', '(hl)']
-      imm = self.fetch()
-      return "ld %s, %s" % (STR[(opcode >> 4) & 3], hex8(imm))
-
-    elif opcode & 0xCF == 0x09: # add hl, reg16 
-      STR = ['bc', 'de', 'hl', 'sp']
-      return "add hl, %s" % STR[(opcode >> 4) & 3]
-
-    elif opcode & 0xCF == 0x0B: #
-      STR = ['bc', 'de', 'hl', 'sp']
-      if ((opcode >> 4) & 3) == 3:
-        self.register_stack_trick(self.PC-1)
-      return "dec %s" % STR[(opcode >> 4) & 3]
-
-    elif opcode & 0xCF == 0x0C: # inc reg8
-      STR = ['c', 'e', 'l', 'a']
-      return "inc %s" % STR[(opcode >> 4) & 3]
-
-    elif opcode & 0xCF == 0x0D: # dec reg8
-      STR = ['c', 'e', 'l', 'a']
-      return "dec %s" % STR[(opcode >> 4) & 3]
-
-    elif opcode & 0xCF == 0x0E: # ld reg, byte
-      STR = ['c', 'e', 'l', 'a']
-      imm = self.fetch()
-      return "ld %s, %s" % (STR[(opcode >> 4) & 3], hex8(imm))
-
-    elif opcode == 0x10:
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "djnz %s" % self.get_label(addr)
-
-    elif opcode == 0x18:
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.unconditional_jump(addr)
-      return "jr %s" % self.get_label(addr)
-
-    elif opcode == 0x20:
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "jr nz, %s" % self.get_label(addr)
-
-    elif opcode == 0x22: # 
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      return "ld (%s), hl" % self.getVariableName(addr)
-
-    elif opcode == 0x28:
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "jr z, %s" % self.get_label(addr)
-
-    elif opcode == 0x2A:
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      return "ld hl, (%s)" % self.getVariableName(addr)
-
-    elif opcode == 0x30:
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "jr nc, %s" % self.get_label(addr)
-
-    elif opcode == 0x32: # 
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      return "ld (%s), a" % self.getVariableName(addr)
-
-    elif opcode == 0x38:
-      imm = self.fetch()
-      addr = self.PC + twos_compl(imm)
-      self.conditional_branch(addr)
-      return "jr c, %s" % self.get_label(addr)
-
-    elif opcode == 0x3e: # 
-      imm = self.fetch()
-      return "ld a, %s" % hex8(imm)
-
-    elif opcode == 0x3a: # 
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      return "ld a, (%s)" % self.getVariableName(addr)
-
-    elif opcode == 0x76:
-      self.return_from_subroutine()
-      return "halt"
-
-    elif opcode & 0xC0 == 0x40: # ld ??, ??
-      STR = ['b', 'c', 'd', 'e', 'h', 'l', '(hl)', 'a']
-      return "ld %s, %s" % (STR[(opcode >> 3) & 0x07], STR[opcode & 0x07])
-
-    elif opcode & 0xC0 == 0x80:
-      STR1 = ['add a,', 'adc a,', 'sub', 'sbc a,', 'and', 'xor', 'or', 'cp']
-      STR2 = ['b', 'c', 'd', 'e', 'h', 'l', '(hl)', 'a']
-      return "%s %s" % (STR1[(opcode >> 3) & 0x07], STR2[opcode & 0x07])
-
-    elif opcode & 0xC7 == 0xC0: # conditional ret
-      STR = ['nz', 'z', 'nc', 'c', 'po', 'pe', 'p', 'm']
-      self.schedule_entry_point(self.PC, needs_label=False)
-      self.return_from_subroutine()
-      return "ret %s" % STR[(opcode >> 3) & 7]
-
-    elif opcode & 0xCF == 0xC1: # pop reg
-      STR = ['bc', 'de', 'hl', 'af']
-      return "pop %s" % STR[(opcode >> 4) & 3]
-
-    elif opcode & 0xC7 == 0xC2: # jp cond, **
-      STR = ['nz', 'z', 'nc', 'c', 'po', 'pe', 'p', 'm']
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      self.conditional_branch(addr)
-      return "jp %s, %s" % (STR[(opcode >> 3) & 7], self.get_label(addr))
-
-    elif opcode & 0xC7 == 0xC4: # conditional CALL
-      STR = ['nz', 'z', 'nc', 'c', 'po', 'pe', 'p', 'm']
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      self.subroutine(addr)
-      comment = self.get_subroutine_comment(addr)
-      cond = STR[(opcode >> 3) & 7]
-      if comment:
-        return "call %s, %s\t; %s" % (cond, self.get_label(addr), comment)
-      else:
-        return "call %s, %s" % (cond, self.get_label(addr))
-
-    elif opcode & 0xCF == 0xC5: # push reg
-      STR = ['bc', 'de', 'hl', 'af']
-      return "push %s" % STR[(opcode >> 4) & 3]
-
-    elif opcode & 0xC7 == 0xC6: # 
-      STR = ['add a,', 'adc a,', 'sub', 'sbc a,', 'and', 'xor', 'or', 'cp']
-      imm = self.fetch()
-      return "%s %s" % (STR[(opcode >> 3) & 7], hex8(imm))
-
-    elif opcode & 0xC7 == 0xC7: # rst
-      self.return_from_subroutine()
-      return "rst %s" % hex8(((opcode >> 3) & 7) * 0x08)
-
-    elif opcode == 0xC3: # jump addr
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      self.unconditional_jump(addr)
-      return "jp %s" % self.get_label(addr)
-
-    elif opcode == 0xC6:
-      value = self.fetch()
-      return "add a, %s" % hex8(value)
-
-    elif opcode == 0xC9: # RET
-      self.return_from_subroutine()
-      return "ret"
-
-
-
-    elif opcode == 0xCB: # BIT INSTRUCTIONS:
-      ext_opcode = self.fetch()
-
-      ext_instructions = {
-        0x11: "rl c",
-      }
-      if ext_opcode in ext_instructions:
-        return ext_instructions[ext_opcode]
-
-      elif ext_opcode & 0xC0 == 0x00: # bit rotates and shifts
-        STR1 = ['rlc', 'rrc', 'rl', 'rr', 'sla', 'sra', 'sll', 'srl']
-        STR2 = ['b', 'c', 'd', 'e', 'h', 'l', '(hl)', 'a']
-        return "%s %s" % (STR1[(ext_opcode >> 3) & 0x07], STR2[ext_opcode & 0x07])
-
-      elif ext_opcode & 0xC0 == 0x40: # bit n, ??
-        STR = ['b', 'c', 'd', 'e', 'h', 'l', '(hl)', 'a']
-        n = (ext_opcode >> 3) & 7
-        return "bit %d, %s" % (n, STR[ext_opcode & 0x07])
-
-      elif ext_opcode & 0xC0 == 0x80: # res n, ??
-        STR = ['b', 'c', 'd', 'e', 'h', 'l', '(hl)', 'a']
-        n = (ext_opcode >> 3) & 7
-        return "res %d, %s" % (n, STR[ext_opcode & 0x07])
-
-      elif ext_opcode & 0xC0 == 0xC0: # set n, ??
-        STR = ['b', 'c', 'd', 'e', 'h', 'l', '(hl)', 'a']
-        n = (ext_opcode >> 3) & 7
-        return "set %d, %s" % (n, STR[ext_opcode & 0x07])
-
-      else:
-        self.illegal_instruction((opcode << 8) | ext_opcode)
-        return "; DISASM ERROR! Illegal bit instruction (ext_opcode = %s)" % hex8(ext_opcode)
-
-
-    elif opcode == 0xcd: # CALL
-      addr = self.fetch()
-      addr = addr | (self.fetch() << 8)
-      self.subroutine(addr)
-      comment = self.get_subroutine_comment(addr)
-      if comment:
-        return "call %s\t; %s" % (self.get_label(addr), comment)
-      else:
-        return "call %s" % self.get_label(addr)
-
-
-
-
-    elif opcode in [0xDD, 0xFD]: # IX/IY INSTRUCTIONS:
-      i_opcode = self.fetch()
-      if opcode == 0xDD:
-        ireg = "ix"
-      else:
-        ireg = "iy"
-
-      i_instructions = {
-        0x09: "add %s, bc",
-        0x19: "add %s, de",
-        0x23: "inc %s",
-        0x29: "add %s, ix",
-        0x39: "add %s, sp",
-        0xE1: "pop %s",
-        0xE5: "push %s",
-      }
-      if i_opcode in i_instructions:
-        return i_instructions[i_opcode] % ireg
-
-      elif i_opcode == 0x21: #
-        imm = self.fetch()
-        imm = imm | (self.fetch() << 8)
-        return "ld %s, %s" % (ireg, self.imm16(imm))
-
-      elif i_opcode == 0x34: #
-        offs = self.fetch()
-        return "inc (%s + %s)" % (ireg, offs)
-
-      elif i_opcode == 0x35: #
-        offs = self.fetch()
-        return "dec (%s + %s)" % (ireg, offs)
-
-      elif i_opcode == 0x36: #
-        offs = self.fetch()
-        imm = self.fetch()
-        return "ld (%s + %s), %s" % (ireg, offs, imm)
-
-      elif i_opcode & 0xCF == 0x4E: #
-        STR = ['c', 'e', 'l', 'a']
-        imm = self.fetch()
-        return "ld %s, (%s + %s)" % (STR[(i_opcode >> 4) & 3], ireg, imm)
-
-      elif i_opcode in [0x46, 0x56, 0x66]: #
-        STR = ['b', 'd', 'h']
-        imm = self.fetch()
-        return "ld %s, (%s + %s)" % (STR[(i_opcode >> 4) & 3], ireg, imm)
-
-      elif i_opcode in [0x70, 0x71, 0x72, 0x73, 0x74, 0x75, 0x77]: #
-        STR = ['b', 'c', 'd', 'e', 'h', 'l', None, 'a']
-        imm = self.fetch()
-        return "ld (%s + %s), %s" % (ireg, imm, STR[i_opcode & 7])
-
-      elif i_opcode & 0xCF == 0x86: #
-        STR = ['add a,', 'sub', 'and', 'or']
-        imm = self.fetch()
-        return "%s (%s + %s)" % (STR[(i_opcode >> 4) & 3], ireg, imm)
-
-      elif i_opcode & 0xCF == 0x8E: #
-        STR = ['adc a,', 'sbc', 'xor', 'cp']
-        imm = self.fetch()
-        return "%s (%s + %s)" % (STR[(i_opcode >> 4) & 3], ireg, imm)
-
-      elif i_opcode == 0xCB: # BIT INSTRUCTIONS:
-        ireg_offs = "(%s + %s)" % (ireg, hex8(self.fetch()))
-        bit_opcode = self.fetch()
-
-        if bit_opcode & 0xC0 == 0x00: # bit rotates and shifts
-          STR = ['rlc', 'rrc', 'rl', 'rr', 'sla', 'sra', 'sll', 'srl']
-          return "%s %s" % (STR[(bit_opcode >> 3) & 0x07], ireg_offs)
-
-        elif bit_opcode & 0xC0 == 0x40: # bit n, ??
-          n = (bit_opcode >> 3) & 7
-          return "bit %d, %s" % (n, ireg_offs)
-
-        elif bit_opcode & 0xC0 == 0x80: # res n, ??
-          n = (bit_opcode >> 3) & 7
-          return "res %d, %s" % (n, ireg_offs)
-
-        elif bit_opcode & 0xC0 == 0xC0: # set n, ??
-          n = (bit_opcode >> 3) & 7
-          return "set %d, %s" % (n, ireg_offs)
-
-        else:
-          self.illegal_instruction((opcode << 16) | (i_opcode << 8) | bit_opcode)
-          return "; DISASM ERROR! Illegal %s bit instruction (bit_opcode = %s)" % hex8(ireg, bit_opcode)
-
-      else:
-        self.illegal_instruction((opcode << 8) | i_opcode)
-        return "; DISASM ERROR! Illegal %s instruction (%s_opcode = %s)" % (ireg, ireg, hex8(i_opcode))
-
-
-
-    elif opcode == 0xE6: # 
-      imm = self.fetch()
-      return "and %s" % hex8(imm)
-
-    elif opcode == 0xE9:
-      self.register_jump_HL(self.PC-1)
-      self.return_from_subroutine()
-      return "jp (hl)"
-
-    elif opcode == 0xED: # EXTENDED INSTRUCTIONS:
-      ext_opcode = self.fetch()
-
-      ext_instructions = {
-        0x44: "neg",
-        0x49: "out (c), c",
-        0x4C: "neg",
-        0x52: "sbc hl, de",
-        0x54: "neg",
-        0x56: "im 1",
-        0x59: "out (c), e",
-        0x5C: "neg",
-        0x64: "neg",
-        0x69: "out (c), l",
-        0x6C: "neg",
-        0x74: "neg",
-        0x79: "out (c), a",
-        0x7C: "neg",
-        0xb0: "ldir",
-      }
-      if ext_opcode in ext_instructions:
-        return ext_instructions[ext_opcode]
-
-      elif ext_opcode & 0xCF == 0x43:
-        STR = ['bc', 'de', 'hl', 'sp']
-        addr = self.fetch()
-        addr = addr | (self.fetch() << 8)
-        return "ld (%s), %s" % (self.getVariableName(addr), STR[(ext_opcode >> 4) & 3])
-
-      elif ext_opcode & 0xCF == 0x4B:
-        STR = ['bc', 'de', 'hl', 'sp']
-        addr = self.fetch()
-        addr = addr | (self.fetch() << 8)
-        if ((ext_opcode >> 4) & 3) == 3:
-          self.register_stack_trick(self.PC-1)
-        return "ld %s, (%s)" % (STR[(ext_opcode >> 4) & 3], self.getVariableName(addr))
-
-      elif ext_opcode == 0x5B:
-        addr = self.fetch()
-        addr = addr | (self.fetch() << 8)
-        return "ld de, (%s)" % self.getVariableName(addr)
-
-      elif ext_opcode == 0x73:
-        addr = self.fetch()
-        addr = addr | (self.fetch() << 8)
-        return "ld (%s), sp" % self.getVariableName(addr)
-
-      elif ext_opcode == 0x7B:
-        addr = self.fetch()
-        addr = addr | (self.fetch() << 8)
-        self.register_stack_trick(self.PC-1)
-        return "ld sp, (%s)" % self.getVariableName(addr)
-
+  def propagate(self, state, address, entry):
+    text = numeric_text(entry)
+    if text == "ex de, hl":
+      Z80_REGISTERS.exchange(state, "DE", "HL")
+      return
+    read, written = instruction_effects(text)
+    mnemonic, _, operands = text.partition(" ")
+    operands = [operand.strip() for operand in operands.split(",")] if operands else []
+    result = _propagated_value(self, state, mnemonic, operands)
+    compare = None
+    if mnemonic == "cp":
+      compare = _operand_value(self, state, operands[-1], load_byte)
+
+    for register in written:
+      Z80_REGISTERS.set(state, register, None)
+    if "F" in written:
+      state.pop("cmp", None)
+    if result is not None:
+      Z80_REGISTERS.set(state, *result)
+    if compare.__class__ is int:
+      state["cmp"] = compare
+
+  def branch_state(self, state, address, entry, taken):
+    mnemonic, _, operands = numeric_text(entry).partition(" ")
+    condition = operands.split(",")[0]
+    # After "cp n", the carry flag tells whether A is below n:
+    compare = state.get("cmp")
+    if compare is not None and condition in ("c", "nc"):
+      if (condition == "c") == taken:
+        Z80_REGISTERS.set(state, "A", bounded(state.get("A"), compare))
+    return state
+
+  def jump_value(self, state, address, entry):
+    text = numeric_text(entry)
+    if text.startswith("jp (") and text.endswith(")"):
+      return state.get(text[4:-1].upper())
+    return None
+
+  def opcode_family(self, address, opcode):
+    # Prefixed opcodes are told apart by the byte after the prefix,
+    # or for DD CB and FD CB by the one after their offset:
+    code = self.read_bytes(address, 4)
+    if opcode in (0xCB, 0xED) and len(code) > 1:
+      return "%02X %02X" % (opcode, code[1])
+    if opcode in (0xDD, 0xFD) and len(code) > 1:
+      if code[1] == 0xCB and len(code) > 3:
+        return "%02X CB %02X" % (opcode, code[3])
+      return "%02X %02X" % (opcode, code[1])
+    return "%02X" % opcode
+
+  def encode_instruction(self, address, entry):
+    if entry.__class__ is str:
+      template, values = entry, ()
+    else:
+      template, values = entry[0], entry[2:]
+    encoding = ENCODINGS.get(template)
+    if encoding is None:
+      return None
+
+    code, operands, trailer, length = encoding
+    if not operands:
+      return code
+    encoded = bytearray(code)
+    for operand, value in zip(operands, values):
+      if operand == _WORD_OPERAND:
+        encoded += bytes((value & 0xFF, (value >> 8) & 0xFF))
+      elif operand == _REL8_OPERAND:
+        offset = value - (address + length)
+        if not -128 <= offset <= 127:
+          return None
+        encoded.append(offset & 0xFF)
       else:
-        self.illegal_instruction((opcode << 8) | ext_opcode)
-        return "; DISASM ERROR! Illegal extended instruction (ext_opcode = %s)" % hex8(ext_opcode)
-
-    elif opcode == 0xee:
-      value = self.fetch()
-      return "xor %s" % hex8(value)
-
-    elif opcode == 0xf6:
-      value = self.fetch()
-      return "or %s" % hex8(value)
+        encoded.append(value & 0xFF)
+    return bytes(encoded + trailer)
 
-    elif opcode == 0xfe:
-      value = self.fetch()
-      return "cp %s" % hex8(value)
-
-    else:
-      self.illegal_instruction(opcode)
-      return "; DISASM ERROR! Illegal instruction (opcode = %s)" % hex8(opcode)
+  def disasm_instruction(self, opcode):
+    handler, template = BASE_INSTRUCTIONS[opcode]
+    if handler is None:
+      return template
+    return handler(self, template)
 
 if __name__ == '__main__':
   if len(sys.argv) not in [2, 3]:
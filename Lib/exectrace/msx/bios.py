@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Released under the terms of the GNU GPL version 3 or later.
+#
+# Symbols and stubs for the MSX BIOS, taken from a BIOS image instead of
+# the hand-written MSX_BIOS_CALLS.
+#
+# The image is traced once with MSX_Trace from the entry vectors of the
+# BIOS (the documented addresses of MSX_BIOS_VECTORS). Each vector gets
+# a summary of the routine behind it: where it goes to, the registers it
+# reads before writing them and the ones it may leave changed. Summaries
+# are cached on disk, so that traces of games only load them:
+#
+#   > from exectrace.msx import MSX_Trace
+#   > from exectrace.msx.bios import MSXBios
+#   > bios = MSXBios("cbios_main_msx1.rom")
+#   > trace = MSX_Trace("galaga.rom", external_regions=[bios])
+#
+# Register usage is worked out from the text of the decoded instructions
+# and is approximate: calls are assumed to change what their routine may
+# change, and registers a routine pushes and pops are assumed to be
+# preserved.
+
+import gzip
+import hashlib
+import inspect
+import os
+import pickle
+
+from exectrace import ExternalRegion, CALL, BRANCH, JUMP, RETURN, render
+from exectrace.msx import CONDITIONS, instruction_effects, registers_of
+
+BIOS_CACHE_VERSION = 1
+
+# Documented entry vectors of the MSX1 BIOS:
+MSX_BIOS_VECTORS = {
+  0x0000: "CHKRAM", 0x0008: "SYNCHR", 0x000C: "RDSLT",  0x0010: "CHRGTR",
+  0x0014: "WRSLT",  0x0018: "OUTDO",  0x001C: "CALSLT", 0x0020: "DCOMPR",
+  0x0024: "ENASLT", 0x0028: "GETYPR", 0x0030: "CALLF",  0x0038: "KEYINT",
+  0x003B: "INITIO", 0x003E: "INIFNK", 0x0041: "DISSCR", 0x0044: "ENASCR",
+  0x0047: "WRTVDP", 0x004A: "RDVRM",  0x004D: "WRTVRM", 0x0050: "SETRD",
+  0x0053: "SETWRT", 0x0056: "FILVRM", 0x0059: "LDIRMV", 0x005C: "LDIRVM",
+  0x005F: "CHGMOD", 0x0062: "CHGCLR", 0x0066: "NMI",    0x0069: "CLRSPR",
+  0x006C: "INITXT", 0x006F: "INIT32", 0x0072: "INIGRP", 0x0075: "INIMLT",
+  0x0078: "SETTXT", 0x007B: "SETT32", 0x007E: "SETGRP", 0x0081: "SETMLT",
+  0x0084: "CALPAT", 0x0087: "CALATR", 0x008A: "GSPSIZ", 0x008D: "GRPPRT",
+  0x0090: "GICINI", 0x0093: "WRTPSG", 0x0096: "RDPSG",  0x0099: "STRTMS",
+  0x009C: "CHSNS",  0x009F: "CHGET",  0x00A2: "CHPUT",  0x00A5: "LPTOUT",
+  0x00A8: "LPTSTT", 0x00AB: "CNVCHR", 0x00AE: "PINLIN", 0x00B1: "INLIN",
+  0x00B4: "QINLIN", 0x00B7: "BREAKX", 0x00BA: "ISCNTC", 0x00BD: "CKCNTC",
+  0x00C0: "BEEP",   0x00C3: "CLS",    0x00C6: "POSIT",  0x00C9: "FNKSB",
+  0x00CC: "ERAFNK", 0x00CF: "DSPFNK", 0x00D2: "TOTEXT", 0x00D5: "GTSTCK",
+  0x00D8: "GTTRIG", 0x00DB: "GTPAD",  0x00DE: "GTPDL",  0x00E1: "TAPION",
+  0x00E4: "TAPIN",  0x00E7: "TAPIOF", 0x00EA: "TAPOON", 0x00ED: "TAPOUT",
+  0x00F0: "TAPOOF", 0x00F3: "STMOTR", 0x00F6: "LFTQ",   0x00F9: "PUTQ",
+  0x00FC: "RIGHTC", 0x00FF: "LEFTC",  0x0102: "UPC",    0x0105: "TUPC",
+  0x0108: "DOWNC",  0x010B: "TDOWNC", 0x010E: "SCALXY", 0x0111: "MAPXY",
+  0x0114: "FETCHC", 0x0117: "STOREC", 0x011A: "SETATR", 0x011D: "READC",
+  0x0120: "SETC",   0x0123: "NSETCX", 0x0126: "GTASPC", 0x0129: "PNTINI",
+  0x012C: "SCANR",  0x012F: "SCANL",  0x0132: "CHGCAP", 0x0135: "CHGSND",
+  0x0138: "RSLREG", 0x013B: "WSLREG", 0x013E: "RDVDP",  0x0141: "SNSMAT",
+  0x0144: "PHYDIO", 0x0147: "FORMAT", 0x014A: "ISFLIO", 0x014D: "OUTDLP",
+  0x0150: "GETVCP", 0x0153: "GETVC2", 0x0156: "KILBUF", 0x0159: "CALBAS",
+}
+
+BIOS_SIZE = 0x8000  # BIOS and BASIC, in pages 0 and 1
+
+# Registers, in the order summaries list them:
+REGISTERS = ("A", "F", "B", "C", "D", "E", "H", "L", "IX", "IY")
+def format_registers(registers):
+  ''' Lists <registers> in the order of REGISTERS, naming pairs,
+      such as "AF, BC, E".
+  '''
+  names = []
+  pending = [register for register in REGISTERS if register in registers]
+  while pending:
+    register = pending.pop(0)
+    if pending and register + pending[0] in ("AF", "BC", "DE", "HL"):
+      register += pending.pop(0)
+    names.append(register)
+  return ", ".join(names)
+
+
+class _Routine():
+  ''' The instructions reached from the entry of a routine,
+      without following calls, with their successors.
+  '''
+  __slots__ = ("entry", "successors", "effects", "calls", "pushed", "popped", "pushes")
+
+  def __init__(self, trace, entry):
+    self.entry = entry
+    self.successors = {}
+    self.effects = {}
+    self.calls = {}  # address of a call instruction -> its target
+    self.pushed = set()
+    self.popped = set()
+    self.pushes = {}  # address of a push -> the registers it saves
+
+    pending = [entry]
+    while pending:
+      address = pending.pop()
+      if address in self.successors or address not in trace.disasm:
+        continue
+      text = render(trace, trace.disasm[address])
+      self.effects[address] = instruction_effects(text)
+      mnemonic, _, operands = text.partition(" ")
+      if mnemonic == "push":
+        self.pushes[address] = set(registers_of(operands))
+        self.pushed.update(self.pushes[address])
+      elif mnemonic == "pop":
+        self.popped.update(registers_of(operands))
+
+      flow, target = trace.flows.get(address, (None, None))
+      following = address + trace.instruction_length(address)
+      successors = []
+      if flow in (None, CALL, BRANCH) or \
+         (flow == RETURN and mnemonic == "ret" and operands in CONDITIONS):
+        successors.append(following)
+      if flow in (BRANCH, JUMP):
+        successors.append(target)
+      if flow == CALL:
+        self.calls[address] = target
+      elif mnemonic == "rst":
+        self.calls[address] = int(operands, 0)
+      self.successors[address] = [s for s in successors if s in trace.disasm]
+      pending.extend(self.successors[address])
+
+  def clobbers(self, summaries):
+    clobbered = set()
+    for address, (read, written) in self.effects.items():
+      clobbered |= written
+      if address in self.calls:
+        clobbered |= summaries.get(self.calls[address], ((), ()))[1]
+    return clobbered - (self.pushed & self.popped)
+
+  def uses(self, summaries):
+    ''' The registers read before being written on some path, worked
+        out by a backward liveness analysis.
+    '''
+    predecessors = {address: [] for address in self.successors}
+    for address, successors in self.successors.items():
+      for successor in successors:
+        predecessors[successor].append(address)
+
+    # Saving a register to restore it later is no use of its value:
+    preserved = self.pushed & self.popped
+    live = {address: set() for address in self.successors}
+    pending = list(self.successors)
+    while pending:
+      address = pending.pop()
+      read, written = self.effects[address]
+      if address in self.pushes:
+        read = read - (self.pushes[address] & preserved)
+      if address in self.calls:
+        callee_uses, callee_clobbers = summaries.get(self.calls[address], ((), ()))
+        read = read | set(callee_uses)
+        written = written | set(callee_clobbers)
+      live_out = set()
+      for successor in self.successors[address]:
+        live_out |= live[successor]
+      live_in = read | (live_out - written)
+      if live_in != live[address]:
+        live[address] = live_in
+        pending.extend(predecessors[address])
+    return live.get(self.entry, set())
+
+
+def summarize(trace, entries):
+  ''' Returns a dict mapping each of the <entries> of a finished trace,
+      and every routine they call, to the (uses, clobbers) frozensets
+      of registers of the routine.
+  '''
+  routines = {}
+  pending = list(entries)
+  while pending:
+    entry = pending.pop()
+    if entry not in routines:
+      routines[entry] = _Routine(trace, entry)
+      pending.extend(routines[entry].calls.values())
+
+  # What routines may change only grows as that of their callees does,
+  # so it is found first. Then the same goes for what they read:
+  summaries = {entry: (frozenset(), frozenset()) for entry in routines}
+  changed = True
+  while changed:
+    changed = False
+    for entry, routine in routines.items():
+      clobbers = frozenset(routine.clobbers(summaries))
+      if clobbers != summaries[entry][1]:
+        summaries[entry] = (frozenset(), clobbers)
+        changed = True
+
+  changed = True
+  while changed:
+    changed = False
+    for entry, routine in routines.items():
+      uses = frozenset(routine.uses(summaries))
+      if uses != summaries[entry][0]:
+        summaries[entry] = (uses, summaries[entry][1])
+        changed = True
+  return summaries
+
+
+def analyze_bios(romfile, vectors=None):
+  ''' Traces the BIOS image <romfile> from its entry <vectors>, a dict
+      of addresses to names (MSX_BIOS_VECTORS by default), and returns
+      a dict mapping the address of each vector to its summary:
+      name, address of its routine, and sorted uses and clobbers.
+  '''
+  from exectrace.msx import MSX_Trace
+
+  if vectors is None:
+    vectors = MSX_BIOS_VECTORS
+  with open(romfile, "rb") as rom_file:
+    image = rom_file.read(BIOS_SIZE)
+  vectors = {address: name for address, name in vectors.items() if address < len(image)}
+
+  trace = MSX_Trace(image, relocation_blocks=((0x0000, 0x0000, len(image)),),
+                    subroutines=dict(vectors), external_regions=())
+  trace.run(entry_points=[])
+
+  summaries = summarize(trace, vectors)
+  table = {}
+  for address, name in vectors.items():
+    routine = address
+    flow, target = trace.flows.get(address, (None, None))
+    if flow == JUMP:
+      routine = target  # most vectors are a "jp" to their routine
+    uses, clobbers = summaries[address]
+    table[address] = {"name": name,
+                      "routine": routine,
+                      "uses": sorted(uses, key=REGISTERS.index),
+                      "clobbers": sorted(clobbers, key=REGISTERS.index)}
+  return table
+
+
+def _comment(vector):
+  comment = []
+  if vector["uses"]:
+    comment.append("uses %s" % format_registers(vector["uses"]))
+  if vector["clobbers"]:
+    comment.append("clobbers %s" % format_registers(vector["clobbers"]))
+  return "; ".join(comment) or None
+
+
+class MSXBios(ExternalRegion):
+  ''' The MSX BIOS as an external region whose symbols come from the
+      BIOS image <romfile>, analyzed by analyze_bios() the first time
+      and then loaded from <cache_dir>. Nothing is read until a trace
+      needs the symbols, and they are only loaded once.
+  '''
+  __slots__ = ("romfile", "cache_dir", "vectors", "_table")
+
+  def __init__(self, romfile, cache_dir=None, vectors=None):
+    self.name = "MSX BIOS"
+    self.start = 0x0000
+    self.end = 0x3FFF
+    self.romfile = romfile
+    if cache_dir is None:
+      cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                              os.path.expanduser("~/.cache")),
+                               "exectrace")
+    self.cache_dir = cache_dir
+    self.vectors = vectors
+    self._table = None
+
+  @property
+  def symbols(self):
+    return {address: (vector["name"], _comment(vector))
+            for address, vector in self.table.items()}
+
+  @property
+  def table(self):
+    ''' The summary of each entry vector, as given by analyze_bios(). '''
+    if self._table is None:
+      path = self.cache_path()
+      self._table = self.load(path)
+      if self._table is None:
+        self._table = analyze_bios(self.romfile, self.vectors)
+        self.save(path, self._table)
+    return self._table
+
+  def cache_key(self):
+    # Telling BIOS images apart does not need their analysis:
+    return (self.name, self.start, self.end, os.path.basename(self.cache_path()))
+
+  def cache_path(self):
+    from exectrace.msx import MSX_Trace
+
+    h = hashlib.sha1()
+    with open(self.romfile, "rb") as rom_file:
+      h.update(rom_file.read(BIOS_SIZE))
+    h.update(repr((BIOS_CACHE_VERSION, sorted((self.vectors or MSX_BIOS_VECTORS).items()))).encode())
+    # Changes to the decoder or to this analysis make for new summaries:
+    for cls in MSX_Trace.__mro__[:-1] + (MSXBios,):
+      try:
+        with open(inspect.getsourcefile(cls), "rb") as source:
+          h.update(source.read())
+      except (TypeError, OSError):
+        pass
+    return os.path.join(self.cache_dir, "%s.bios.gz" % h.hexdigest()[:40])
+
+  def load(self, path):
+    try:
+      with gzip.open(path, "rb") as cache_file:
+        cached = pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      return None
+    if cached.get("version") != BIOS_CACHE_VERSION:
+      return None
+    return cached["vectors"]
+
+  def save(self, path, table):
+    os.makedirs(self.cache_dir, exist_ok=True)
+    temp_path = path + ".tmp"
+    with gzip.open(temp_path, "wb") as cache_file:
+      pickle.dump({"version": BIOS_CACHE_VERSION,
+                   "vectors": table}, cache_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
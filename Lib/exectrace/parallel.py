@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Parallel decoding of the code reachable from the entry points of a
+# trace, used by ExecTrace.crawl(processes=N).
+#
+# The order in which a trace visits its entry points decides where
+# blocks get split, which labels get registered and, since the crawl
+# stops at the first illegal instruction, even how much code is found.
+# So the partial results of independent crawls cannot simply be merged
+# into those of a serial crawl. What can be shared is the decoding:
+# the instruction at a given address always decodes the same way for
+# decoders listing their PARALLEL_CALLBACKS.
+#
+# Each worker crawls from a partition of the entry points, recording
+# every instruction it decodes together with the calls its decoder made
+# back into the trace. The serial crawl then replays those records in
+# its own order, doing all the block bookkeeping (including the splits
+# of overlapping blocks) exactly as it would have done by itself.
+
+import contextlib
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+
+class _Recorder():
+    ''' Mixed into the class of a trace by _recording_class() so that
+        each decoded instruction gets saved as an (entry, length, calls)
+        record, the one replayed by ExecTrace.replay_instruction().
+        Decoders are expected to call back the trace only after their
+        last fetch, as replay_instruction() does.
+    '''
+
+    def start_recording(self):
+        self.records = {}
+        self.calls = None
+
+    def disasm_instruction(self, opcode):
+        address = self.PC - 1
+        fetched = self.fetched - 1
+        self.calls = []
+        try:
+            entry = super(_Recorder, self).disasm_instruction(opcode)
+        finally:
+            calls, self.calls = self.calls, None
+        if self.fetch_failed_at is None:
+            self.records[address] = (entry, self.fetched - fetched, tuple(calls))
+        return entry
+
+    def end_block(self):
+        super(_Recorder, self).end_block()
+        # A worker only looks for code to decode, so instead of
+        # stopping at an illegal instruction it goes on with others:
+        return True
+
+
+def _recording_callback(name, method):
+    def callback(self, *args, **kwargs):
+        if self.calls is not None:
+            self.calls.append((name, args, kwargs))
+        return method(self, *args, **kwargs)
+    return callback
+
+
+def _recording_class(trace_class):
+    namespace = {name: _recording_callback(name, getattr(trace_class, name))
+                 for name in trace_class.PARALLEL_CALLBACKS}
+    return type("Recording" + trace_class.__name__, (_Recorder, trace_class), namespace)
+
+
+def _decode_partition(trace_class, relocation_blocks, image, roots):
+    ''' Runs in a worker process. <image> is either the bytes of the
+        image or the (name, size) of a shared memory block holding it.
+    '''
+    shm = None
+    if isinstance(image, tuple):
+        name, size = image
+        shm = shared_memory.SharedMemory(name=name)
+        image = shm.buf[:size]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        trace = _recording_class(trace_class)(image, relocation_blocks=relocation_blocks)
+        trace.start_recording()
+        for address in roots:
+            trace.schedule_entry_point(address, needs_label=True)
+        try:
+            trace.crawl()
+        except Exception:
+            # The records saved so far are still good. Whatever went
+            # wrong, the serial crawl will run into it again by itself.
+            pass
+    records = trace.records
+
+    if shm is not None:
+        # The views on the shared buffer must go before it can be closed:
+        del trace, image
+        shm.close()
+    return records
+
+
+def partition(roots, count):
+    ''' Deals the <roots> out to <count> workers, in scheduling order. '''
+    return [roots[i::count] for i in range(count) if roots[i::count]]
+
+
+def predecode(trace, processes):
+    ''' Decodes in <processes> worker processes the code reachable from
+        the pending entry points of <trace>. Returns {address: record}
+        for ExecTrace.crawl(). The result is empty, and the crawl simply
+        serial, if the decoder of the trace does not support this or if
+        there are not enough entry points to share.
+    '''
+    if type(trace).PARALLEL_CALLBACKS is None:
+        return {}
+    roots = [address for address, needs_label in trace.pending_entry_points]
+    partitions = partition(roots, processes)
+    if len(partitions) < 2:
+        return {}
+
+    shm = None
+    image = trace.image
+    if shared_memory is not None:
+        shm = shared_memory.SharedMemory(create=True, size=max(len(image), 1))
+        shm.buf[:len(image)] = image
+        image = (shm.name, len(image))
+    else:
+        image = bytes(image)
+
+    records = {}
+    try:
+        with ProcessPoolExecutor(len(partitions)) as pool:
+            futures = [pool.submit(_decode_partition,
+                                   type(trace),
+                                   trace.relocation_blocks,
+                                   image,
+                                   roots) for roots in partitions]
+            # The same address always decodes the same way,
+            # so records found by several workers are equal:
+            for future in futures:
+                records.update(future.result())
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    return records
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Resolution of computed jumps, used by ExecTrace.resolve_computed_jumps().
+#
+# Jumps such as "jp (hl)" or "jmp [bx + 0x1234]" end a block without
+# telling the crawl where they go. Here the values of the registers are
+# propagated over the code blocks found so far, with a worklist, until
+# they no longer change. The values are abstract:
+#
+#   None                           unknown
+#   int                            a constant
+#   frozenset of ints              one of a few constants
+#   (INDEX, 0, scale, count)       an unknown index times <scale>
+#   (ADDRESS, base, scale, count)  base + index * scale
+#   (BYTE_AT, base, scale, count)  the byte at base + index * scale
+#   (WORD_AT, base, scale, count)  the word at base + index * scale
+#
+# where <count>, if known, is how many values the index may take, as
+# bounded by a compare and a conditional branch before it. This is what
+# the usual ways of dispatching through a table come down to: a jump to
+# a WORD_AT goes to the pointers of a table, and a jump to an ADDRESS
+# with a known count to each of the entries of a table of jumps.
+#
+# What instructions do to the values is told by the decoder, through
+# ExecTrace.propagate(), branch_state() and jump_value(). A state maps
+# the names the decoder gives to its registers to their values, leaving
+# out the unknown ones.
+
+from exectrace import BRANCH, CALL, RETURN, CODE, OPCODE, DATA, VERBOSE, VARIABLE
+from exectrace import NUMBER, BYTE
+from exectrace.export import edge_kind
+
+INDEX = "index"
+ADDRESS = "address"
+BYTE_AT = "byte at"
+WORD_AT = "word at"
+
+MAX_VALUES = 16         # constants in a value set before it becomes unknown
+MAX_TABLE_ENTRIES = 128 # pointers read from a table of unknown length
+MAX_VISITS = 32         # times a block is revisited before its state is given up
+
+
+def numeric_text(entry):
+    ''' The text of a decoded instruction with all its operand values
+        written as numbers, instead of the names of their symbols.
+    '''
+    if entry.__class__ is str:
+        return entry
+    values = []
+    for kind, value in zip(entry[1], entry[2:]):
+        if kind == NUMBER:
+            values.append(value)
+        elif kind == BYTE:
+            values.append("0x%02X" % value)
+        else:
+            values.append("0x%04X" % value)
+    return entry[0] % tuple(values)
+
+
+def is_constant(value):
+    return value.__class__ is int
+
+
+def _constants(value):
+    if value.__class__ is int:
+        return (value,)
+    if value.__class__ is frozenset:
+        return value
+    return None
+
+
+def _value_set(values):
+    values = frozenset(values)
+    if len(values) == 1:
+        return next(iter(values))
+    if len(values) > MAX_VALUES:
+        return None
+    return values
+
+
+def join(a, b):
+    ''' The value of a register that holds <a> on one path and <b>
+        on another.
+    '''
+    if a == b:
+        return a
+    a_values, b_values = _constants(a), _constants(b)
+    if a_values is None or b_values is None:
+        return None
+    return _value_set(set(a_values) | set(b_values))
+
+
+def join_states(a, b):
+    joined = {}
+    for key, value in a.items():
+        if key in b:
+            value = join(value, b[key])
+            if value is not None:
+                joined[key] = value
+    return joined
+
+
+def freeze(state):
+    return tuple(sorted(state.items(), key=lambda item: item[0]))
+
+
+def apply(function, value, mask):
+    ''' Applies <function> to a constant or each one of a set of them. '''
+    values = _constants(value)
+    if values is None:
+        return None
+    return _value_set(function(v) & mask for v in values)
+
+
+def combine(function, a, b, mask):
+    ''' Applies <function> to each pair of the constants <a> and <b>
+        can be, if they are constants or sets of them.
+    '''
+    a_values, b_values = _constants(a), _constants(b)
+    if a_values is None or b_values is None:
+        return None
+    return _value_set(function(x, y) & mask for x in a_values for y in b_values)
+
+
+def add(a, b, bits=16):
+    ''' The value of a + b, in a register of <bits> bits. '''
+    mask = (1 << bits) - 1
+    if a.__class__ is not tuple and b.__class__ is not tuple:
+        return combine(lambda x, y: x + y, a, b, mask)
+    if a.__class__ is tuple and b.__class__ is tuple:
+        a, b = (a, b) if a[0] == ADDRESS else (b, a)
+        if a[0] == ADDRESS and b[0] == INDEX and a[3] == b[3]:
+            # Both are the same index, as in adding DE to HL twice:
+            return (ADDRESS, a[1], a[2] + b[2], a[3])
+        return None
+    table, offset = (a, b) if a.__class__ is tuple else (b, a)
+    if not is_constant(offset) or table[0] not in (INDEX, ADDRESS):
+        return None
+    if table[0] == INDEX:
+        return (ADDRESS, offset, table[2], table[3])
+    return (ADDRESS, (table[1] + offset) & mask, table[2], table[3])
+
+
+def double(value, bits=16):
+    ''' The value of a register added to itself. An unknown value
+        doubled is taken to be the index into a table of words.
+    '''
+    if value is None:
+        return (INDEX, 0, 2, None)
+    if value.__class__ is tuple:
+        if value[0] != INDEX:
+            return None
+        return (INDEX, 0, value[2] * 2, value[3])
+    return apply(lambda v: v * 2, value, (1 << bits) - 1)
+
+
+def bounded(value, count):
+    ''' The value of a register known to be below <count>. '''
+    if value is None:
+        return (INDEX, 0, 1, count)
+    if value.__class__ is tuple and value[0] == INDEX and value[2] == 1:
+        return (INDEX, 0, 1, count if value[3] is None else min(value[3], count))
+    return value
+
+
+def load_byte(trace, address):
+    ''' The value of the byte at <address>, read from the image. '''
+    if address.__class__ is tuple:
+        if address[0] == ADDRESS:
+            return (BYTE_AT,) + address[1:]
+        return None
+    values = _constants(address)
+    if values is None:
+        return None
+    loaded = [trace.read_byte(v) for v in values]
+    if None in loaded:
+        return None
+    return _value_set(loaded)
+
+
+def load_word(trace, address):
+    ''' The value of the word at <address>, read from the image. '''
+    if address.__class__ is tuple:
+        if address[0] == ADDRESS:
+            return (WORD_AT,) + address[1:]
+        return None
+    values = _constants(address)
+    if values is None:
+        return None
+    loaded = [trace.read_word(v) for v in values]
+    if None in loaded:
+        return None
+    return _value_set(loaded)
+
+
+def pair(high, low):
+    ''' The value of a register pair made of two 8-bit values. '''
+    if high == 0 and low is not None and (low.__class__ is not tuple or low[0] in (INDEX, BYTE_AT)):
+        return low
+    if high.__class__ is tuple and low.__class__ is tuple:
+        if high[0] == BYTE_AT and low[0] == BYTE_AT and high[1] == low[1] + 1 and \
+           high[2:] == low[2:]:
+            return (WORD_AT,) + low[1:]
+        return None
+    if is_constant(high) and is_constant(low):
+        return high << 8 | low
+    return None
+
+
+def high_byte(value):
+    return apply(lambda v: v >> 8, value, 0xFF)
+
+
+def low_byte(value):
+    return apply(lambda v: v, value, 0xFF)
+
+
+class RegisterFile():
+    ''' How the registers of a CPU make up its register pairs, so that
+        writing to either keeps the other up to date in a state.
+    '''
+
+    def __init__(self, pairs):
+        self.pairs = pairs  # name of a pair -> names of its (high, low) halves
+        self.halves = {}
+        for name, (high, low) in pairs.items():
+            self.halves[high] = name
+            self.halves[low] = name
+
+    def set(self, state, register, value):
+        if register in self.pairs:
+            high, low = self.pairs[register]
+            _store(state, register, value)
+            _store(state, high, high_byte(value))
+            _store(state, low, low_byte(value))
+        else:
+            _store(state, register, value)
+            name = self.halves.get(register)
+            if name is not None:
+                high, low = self.pairs[name]
+                _store(state, name, pair(state.get(high), state.get(low)))
+
+    def exchange(self, state, a, b):
+        ''' Swaps the values of the registers <a> and <b>, and of their
+            halves if they are pairs.
+        '''
+        swapped = [(a, b)]
+        if a in self.pairs:
+            swapped += zip(self.pairs[a], self.pairs[b])
+        for first, second in swapped:
+            first_value, second_value = state.get(first), state.get(second)
+            _store(state, first, second_value)
+            _store(state, second, first_value)
+
+
+def _store(state, key, value):
+    if value is None:
+        state.pop(key, None)
+    else:
+        state[key] = value
+
+
+class JumpResolver():
+    ''' Propagates values over the blocks of <trace> and works out the
+        targets of its computed jumps. The state at the end of each block
+        is kept for each state it started with, so that later rounds,
+        after the new code got crawled, only redo the blocks that changed.
+    '''
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.memo = {}
+        self.resolved = {}  # address of a computed jump -> its targets
+
+    def transfer(self, codeblock, state):
+        ''' Returns the state after the instructions of <codeblock>,
+            starting with <state>, and the address of the last one.
+        '''
+        key = (codeblock.start, codeblock.end, freeze(state))
+        result = self.memo.get(key)
+        if result is None:
+            trace = self.trace
+            state = dict(state)
+            address = last = codeblock.start
+            while address <= codeblock.end:
+                entry = trace.disasm.get(address)
+                if entry is None:
+                    address += 1
+                    continue
+                trace.propagate(state, address, entry)
+                last = address
+                address += trace.instruction_length(address)
+            result = self.memo[key] = (state, last)
+        return result
+
+    def propagate(self):
+        ''' Returns the blocks of the trace by start address and the
+            state each of them starts with once nothing changes anymore.
+            Blocks nothing leads to, and the code after a call, start
+            with nothing known.
+        '''
+        trace = self.trace
+        blocks = {}
+        for codeblock in trace.visited_ranges:
+            blocks.setdefault(codeblock.start, codeblock)
+
+        reached = set()
+        for codeblock in blocks.values():
+            reached.update(codeblock.next_block)
+        states = {start: {} for start in blocks if start not in reached}
+        pending = sorted(states, reverse=True)
+        visits = {}
+        while pending:
+            codeblock = blocks[pending.pop()]
+            out, last = self.transfer(codeblock, states[codeblock.start])
+            flow, target = trace.flows.get(last, (None, None))
+            for successor in codeblock.next_block:
+                if successor not in blocks: # an illegal opcode, or the middle of a block
+                    continue
+                kind = edge_kind(successor, flow, target)
+                if kind is None:
+                    continue
+                if flow == CALL and kind != CALL:
+                    state = {}
+                elif flow in (BRANCH, RETURN):
+                    state = trace.branch_state(dict(out), last, trace.disasm[last],
+                                               taken=kind == BRANCH)
+                    if state is None:
+                        continue
+                else:
+                    state = out
+                old = states.get(successor)
+                if old is not None:
+                    state = join_states(old, state)
+                    if state == old:
+                        continue
+                    visits[successor] = visits.get(successor, 0) + 1
+                    if visits[successor] > MAX_VISITS:
+                        state = {}
+                states[successor] = state
+                pending.append(successor)
+        return blocks, states
+
+    def resolve(self):
+        ''' Works out the targets of the computed jumps and schedules them.
+            Returns the number of targets that were not visited yet.
+        '''
+        trace = self.trace
+        blocks, states = self.propagate()
+        new_targets = 0
+        for start, codeblock in blocks.items():
+            if start not in states:
+                continue
+            out, last = self.transfer(codeblock, states[start])
+            if trace.flows.get(last, (None,))[0] != RETURN:
+                continue
+            value = trace.jump_value(out, last, trace.disasm[last])
+            if value is None:
+                continue
+            targets = self.targets(value)
+            if not targets:
+                continue
+            trace.log(VERBOSE, "Computed jump at {:#x} resolved to {} targets", last, len(targets))
+            self.resolved[last] = targets
+            for address in targets:
+                if not trace.already_visited(address) and \
+                   address not in trace.pending_entry_points:
+                    new_targets += 1
+                trace.schedule_entry_point(address, needs_label=True)
+        return new_targets
+
+    def targets(self, value):
+        ''' The addresses a jump to <value> may go to. '''
+        trace = self.trace
+        constants = _constants(value)
+        if constants is not None:
+            return sorted(constants)
+        if value.__class__ is not tuple:
+            return []
+        kind, base, scale, count = value
+        if kind == WORD_AT:
+            pointers = self.table_entries(base, scale, count)
+            if pointers and scale == 2 and base not in trace.symbols:
+                trace.symbols.define(base, "JUMP_TABLE_%04X" % base, VARIABLE,
+                                     kind="jump_table", length=len(pointers))
+                trace.symbols.labeled.add(base)
+                for address in range(base, base + 2 * len(pointers)):
+                    trace.visited_ranges.mark(address, DATA)
+                for pointer in pointers:
+                    trace.register_pointer(pointer)
+            return sorted(set(pointers))
+        if kind == ADDRESS and count is not None:
+            return [base + i * scale for i in range(count)]
+        return []
+
+    def table_entries(self, base, scale, count):
+        ''' Returns the pointers of the table at <base>, with an entry
+            every <scale> bytes. Without a <count>, the table ends before
+            the first entry that does not look like one.
+        '''
+        pointers = []
+        for i in range(count or MAX_TABLE_ENTRIES):
+            address = base + i * scale
+            pointer = self.trace.read_word(address)
+            if pointer is None:
+                break
+            if count is None and not self.plausible_entry(base, address, pointer):
+                break
+            pointers.append(pointer)
+        return pointers
+
+    def plausible_entry(self, base, address, pointer):
+        ''' Tells whether the word at <address> may still belong to the
+            table at <base>: it is not code, nor another symbol, and it
+            points to the start of code or to bytes not decoded yet.
+        '''
+        trace = self.trace
+        state = trace.address_map
+        if address != base and (address in trace.symbols or address in trace.symbols.labeled):
+            return False
+        if any(byte < len(state) and state[byte] & CODE for byte in (address, address + 1)):
+            return False
+        if trace.rom_address(pointer) is None or base <= pointer <= address + 1:
+            return False
+        if pointer < len(state) and (state[pointer] & DATA or
+                                     state[pointer] & (CODE | OPCODE) == CODE):
+            return False
+        return True
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Detection of tables of pointers, used by ExecTrace.find_pointer_tables().
+#
+# The bytes that are neither code nor declared data are read as
+# little-endian words, at both alignments, and each word is scored by
+# what it points to:
+#
+#   BLOCK_START   the start of a code block
+#   INSTRUCTION   the start of any other decoded instruction
+#   UNVISITED     a byte of the image not traced yet, or declared data
+#
+# Words pointing anywhere else (out of the image or into the middle of
+# an instruction) score nothing. Runs of words that all score something
+# are split where the operands of decoded instructions point to, as
+# that is where tables start. A part of a run that code points to is a
+# candidate table, even if the code it leads to was not traced yet.
+# Any other part needs an average score of at least <min_score>, all
+# code blocks by default, and none of its words may point to bytes not
+# traced yet: runs of random data would otherwise pass for tables, and
+# scheduling their targets would crawl garbage. A candidate is
+# "pointers" if one of its words points to declared data, and a
+# "jump_table" otherwise. Pointers are taken as logical addresses.
+#
+# With NumPy installed, the words are scored all at once, which takes
+# a fraction of a second for a 1 MiB image. Without it, the same is done
+# one word at a time.
+
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from exectrace import CODE, OPCODE, DATA, VARIABLE, NUMBER, SYMBOL
+
+BLOCK_START = 3
+INSTRUCTION = 2
+UNVISITED = 1
+
+
+def _flag_score(flags):
+    ''' The score of pointing to a byte with <flags> in trace.address_map. '''
+    if flags & CODE:
+        return INSTRUCTION if flags & OPCODE else 0
+    return UNVISITED
+
+_FLAG_SCORES = bytes(_flag_score(flags) for flags in range(256))
+_DATA_BYTES = bytes(1 if flags & DATA else 0 for flags in range(256))
+_FREE_BYTES = bytes(0 if flags & (CODE | DATA) else 1 for flags in range(256))
+
+
+class TableCandidate():
+    ''' A run of <length> words at <address> that looks like
+        a table of pointers of the given <kind>.
+    '''
+    __slots__ = ("address", "length", "kind", "score", "referenced")
+
+    def __init__(self, address, length, kind, score, referenced=False):
+        self.address = address
+        self.length = length
+        self.kind = kind
+        self.score = score
+        self.referenced = referenced  # whether code points to it
+
+    def name(self):
+        prefix = "JUMP_TABLE" if self.kind == "jump_table" else "POINTERS"
+        return "%s_%04X" % (prefix, self.address)
+
+    def variable(self):
+        ''' The (name, kind, length) it would be declared with
+            among the <variables> of an ExecTrace.
+        '''
+        return (self.name(), self.kind, self.length)
+
+    def __repr__(self):
+        return "<TableCandidate %s: %s of %d words, score %.2f>" % (
+            self.name(), self.kind, self.length, self.score)
+
+
+def mapped_regions(trace):
+    ''' Returns (start, bytes) for each run of mapped logical addresses. '''
+    bounds = []
+    page_size = 1 << trace.page_shift
+    start = None
+    for page, entry in enumerate(trace.page_table + [None]):
+        address = page << trace.page_shift
+        if entry is None:
+            if start is not None:
+                bounds.append((start, address))
+                start = None
+            continue
+        if start is None:
+            start = address
+        if entry[2] < page_size:  # the block ends within this page
+            bounds.append((start, address + entry[2]))
+            start = None
+
+    top = len(trace.address_map)
+    return [(start, trace.read_bytes(start, min(end, top) - start))
+            for start, end in bounds if min(end, top) > start]
+
+
+def target_scores(trace, regions):
+    ''' Returns the score of pointing to each 16-bit address, and
+        which of them are declared data.
+    '''
+    state = trace.address_map
+    scores = bytearray(0x10000)
+    data = bytearray(0x10000)
+    for start, image in regions:
+        if start >= 0x10000:
+            continue
+        end = min(start + len(image), 0x10000)
+        scores[start:end] = state[start:end].translate(_FLAG_SCORES)
+        data[start:end] = state[start:end].translate(_DATA_BYTES)
+    for codeblock in trace.visited_ranges:
+        if codeblock.start < 0x10000 and scores[codeblock.start]:
+            scores[codeblock.start] = BLOCK_START
+    return scores, data
+
+
+def referenced_addresses(trace):
+    ''' The sorted values of the operands of decoded instructions
+        that may be addresses.
+    '''
+    addresses = set()
+    for entry in trace.disasm.values():
+        if entry.__class__ is tuple:
+            for kind, value in zip(entry[1], entry[2:]):
+                if (kind == SYMBOL or kind == NUMBER) and value.__class__ is int:
+                    addresses.add(value)
+    return sorted(addresses)
+
+
+def _scan_numpy(data, free, scores, data_targets, alignment, min_length):
+    ''' Returns the (first, last + 1) indexes of the runs of at least
+        <min_length> words of <data>, from <alignment>, that all score
+        something, and the running sums of their scores, of those that
+        point to declared data, of those that point to bytes not traced
+        yet and of the changes from word to word.
+    '''
+    image = numpy.frombuffer(data, dtype=numpy.uint8)
+    free = numpy.frombuffer(free, dtype=numpy.uint8).astype(bool)
+    count = (len(image) - alignment) // 2
+    end = alignment + 2 * count
+    words = image[alignment:end].view("<u2")
+    word_scores = numpy.frombuffer(scores, dtype=numpy.uint8)[words]
+    word_scores[~(free[alignment:end:2] & free[alignment + 1:end:2])] = 0
+
+    valid = numpy.concatenate(([0], (word_scores > 0).astype(numpy.int8), [0]))
+    edges = numpy.flatnonzero(numpy.diff(valid))
+    starts, ends = edges[0::2], edges[1::2]
+    long_enough = ends - starts >= min_length
+    runs = list(zip(starts[long_enough].tolist(), ends[long_enough].tolist()))
+    if not runs:
+        return runs, None, None, None, None
+
+    to_data = numpy.frombuffer(data_targets, dtype=numpy.uint8)[words] & (word_scores > 0)
+    untraced = (word_scores == UNVISITED) & (to_data == 0)
+    totals = numpy.concatenate(([0], numpy.cumsum(word_scores, dtype=numpy.int64)))
+    to_data = numpy.concatenate(([0], numpy.cumsum(to_data, dtype=numpy.int64)))
+    untraced = numpy.concatenate(([0], numpy.cumsum(untraced, dtype=numpy.int64)))
+    changes = numpy.concatenate(([0], numpy.cumsum(words[1:] != words[:-1])))
+    return runs, totals, to_data, untraced, changes
+
+
+def _scan(data, free, scores, data_targets, alignment, min_length):
+    ''' Same as _scan_numpy(), a word at a time. '''
+    count = (len(data) - alignment) // 2
+    words = array("H", bytes(data[alignment:alignment + 2 * count]))
+    if sys.byteorder == "big":
+        words.byteswap()
+    word_scores = [scores[word] if free[alignment + 2 * i] and free[alignment + 2 * i + 1] else 0
+                   for i, word in enumerate(words)]
+
+    runs = []
+    first = None
+    for i, score in enumerate(word_scores + [0]):
+        if score and first is None:
+            first = i
+        elif not score and first is not None:
+            if i - first >= min_length:
+                runs.append((first, i))
+            first = None
+    if not runs:
+        return runs, None, None, None, None
+
+    totals = [0] + list(accumulate(word_scores))
+    to_data = [0] + list(accumulate(1 if score and data_targets[word] else 0
+                                    for word, score in zip(words, word_scores)))
+    untraced = [0] + list(accumulate(1 if score == UNVISITED and not data_targets[word] else 0
+                                     for word, score in zip(words, word_scores)))
+    changes = [0] + list(accumulate(1 if words[i] != words[i - 1] else 0
+                                    for i in range(1, len(words))))
+    return runs, totals, to_data, untraced, changes
+
+
+def find_tables(trace, min_length=4, min_score=BLOCK_START):
+    ''' Returns the candidate tables among the bytes of <trace> not yet
+        known as code or data, by address. Those of overlapping runs at
+        the other alignment are left out, as are runs shorter than
+        <min_length> words and, unless code points to them, those with
+        an average score below <min_score> or pointing to bytes not
+        traced yet.
+    '''
+    regions = mapped_regions(trace)
+    scores, data_targets = target_scores(trace, regions)
+    references = referenced_addresses(trace)
+    referenced_set = set(references)
+    scan = _scan if numpy is None else _scan_numpy
+
+    candidates = []
+    for start, data in regions:
+        free = trace.address_map[start:start + len(data)].translate(_FREE_BYTES)
+        for alignment in (0, 1):
+            runs, totals, to_data, untraced, changes = scan(data, free, scores, data_targets,
+                                                            alignment, min_length)
+            base = start + alignment
+            for first, last in runs:
+                # Tables start where code points to:
+                index = bisect_left(references, base + 2 * first)
+                bounds = [first]
+                while index < len(references) and references[index] < base + 2 * last:
+                    offset = references[index] - base
+                    if offset % 2 == 0 and offset // 2 > bounds[-1]:
+                        bounds.append(offset // 2)
+                    index += 1
+                bounds.append(last)
+
+                for i in range(len(bounds) - 1):
+                    low, high = bounds[i], bounds[i + 1]
+                    length = high - low
+                    address = base + 2 * low
+                    if length < min_length or changes[high - 1] == changes[low]:
+                        continue
+                    referenced = address in referenced_set
+                    score = (totals[high] - totals[low]) / float(length)
+                    if referenced or (score >= min_score and untraced[high] == untraced[low]):
+                        kind = "pointers" if to_data[high] - to_data[low] else "jump_table"
+                        candidates.append(TableCandidate(address, length, kind, float(score),
+                                                         referenced))
+
+    # The best of each set of overlapping candidates:
+    starts = []
+    chosen = []
+    for candidate in sorted(candidates, key=lambda c: (not c.referenced, -c.score * c.length,
+                                                       c.address)):
+        index = bisect_left(starts, candidate.address)
+        if index < len(starts) and starts[index] < candidate.address + 2 * candidate.length:
+            continue
+        if index > 0 and chosen[index - 1].address + 2 * chosen[index - 1].length > candidate.address:
+            continue
+        starts.insert(index, candidate.address)
+        chosen.insert(index, candidate)
+    return chosen
+
+
+def declare_table(trace, candidate):
+    ''' Declares <candidate> as it would have been among the <variables>
+        of the trace: as data, with its pointers labeled and, for a jump
+        table, scheduled as entry points.
+    '''
+    name, kind, length = candidate.variable()
+    trace.symbols.define(candidate.address, name, VARIABLE, kind=kind, length=length)
+    trace.symbols.labeled.add(candidate.address)
+    for address in range(candidate.address, candidate.address + 2 * length):
+        trace.visited_ranges.mark(address, DATA)
+    for i in range(length):
+        pointer = trace.read_word(candidate.address + 2 * i)
+        trace.register_pointer(pointer)
+        if kind == "jump_table":
+            trace.schedule_entry_point(pointer, needs_label=True)
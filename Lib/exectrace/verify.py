@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Round-trip check of a disassembly listing, used by
+# ExecTrace.verify_listing().
+#
+# Instead of writing the listing, assembling it and comparing checksums,
+# the image is rebuilt in memory from what the listing is made of: the
+# code blocks from the encoding of their decoded instructions, given by
+# the decoder, and the runs of data from the text of the db/dw
+# directives emitted for them. The rebuilt image is then compared with
+# the original one in bulk, and only if they differ do the mismatching
+# instructions and directives get looked for one by one.
+
+import re
+
+from exectrace import render
+
+_DIRECTIVE = re.compile(r"\s*(db|dw)\s+(.*)$")
+_HEX_BYTES = re.compile(r"\s*db\s+(0x[0-9A-Fa-f]{2}(?:\s*,\s*0x[0-9A-Fa-f]{2})*)\s*$")
+_OPERAND = re.compile(r'\s*("[^"]*"|[^,"]+)\s*(,|$)')
+_GENERATED_LABEL = re.compile(r"LABEL_([0-9A-F]{4})$")
+
+
+class Mismatch():
+    ''' An instruction or data directive of the listing, at <address>,
+        that does not assemble to the <expected> bytes of the image.
+        <source> is None for bytes the listing has nothing for,
+        and <encoded> is None if the source could not be encoded.
+    '''
+    __slots__ = ("address", "source", "encoded", "expected")
+
+    def __init__(self, address, source, encoded, expected):
+        self.address = address
+        self.source = source
+        self.encoded = encoded
+        self.expected = expected
+
+    def __repr__(self):
+        return "Mismatch(%#06x, %r, %r, %r)" % (self.address, self.source,
+                                                self.encoded, self.expected)
+
+    def __str__(self):
+        if self.source is None:
+            problem = "missing from the listing"
+        elif self.encoded is None:
+            problem = "%s: cannot be encoded" % self.source
+        else:
+            problem = "%s: encodes to %s" % (self.source, _hex_bytes(self.encoded))
+        return "%04X: %s, image has %s" % (self.address, problem, _hex_bytes(self.expected))
+
+
+def _hex_bytes(data):
+    return " ".join("%02X" % b for b in data) or "nothing"
+
+
+def resolve(trace, name):
+    ''' The address an assembler would give to a label of the listing. '''
+    address = trace.symbols.address_of(name)
+    if address is None:
+        generated = _GENERATED_LABEL.match(name)
+        if generated is not None:
+            address = int(generated.group(1), 16)
+    return address
+
+
+def parse_number(text):
+    try:
+        return int(text, 0)
+    except ValueError:
+        return None
+
+
+def encode_directive(trace, line):
+    ''' Returns the bytes of a "db" or "dw" line of the listing,
+        or None if it is not one or cannot be encoded.
+    '''
+    hex_bytes = _HEX_BYTES.match(line)
+    if hex_bytes is not None:
+        # Most of the data is plain bytes, as in "db 0x3E, 0x12":
+        return bytes.fromhex(hex_bytes.group(1).replace("0x", "").replace(",", ""))
+
+    directive = _DIRECTIVE.match(line)
+    if directive is None:
+        return None
+    mnemonic, operands = directive.groups()
+    encoded = bytearray()
+    pos = 0
+    while pos < len(operands):
+        operand = _OPERAND.match(operands, pos)
+        if operand is None:
+            return None
+        pos = operand.end()
+        text = operand.group(1).strip()
+        if mnemonic == "db" and text.startswith('"'):
+            try:
+                encoded += text[1:-1].encode("latin-1")
+            except UnicodeEncodeError:
+                return None
+            continue
+
+        value = parse_number(text)
+        if mnemonic == "db":
+            if value is None or not 0 <= value <= 0xFF:
+                return None
+            encoded.append(value)
+        else:
+            if value is None:
+                value = resolve(trace, text)
+            if value is None or not 0 <= value <= 0xFFFF:
+                return None
+            encoded += bytes((value & 0xFF, value >> 8))
+    return bytes(encoded)
+
+
+def iter_data_units(trace, start, end, variables, var_addrs):
+    ''' Yields an (address, length, encoded, line) tuple for every
+        directive the listing has for the data in [start, end).
+    '''
+    address = start
+    for chunk in trace._iter_data_listing(start, end, variables, var_addrs):
+        for line in chunk.split("\n"):
+            if not line.strip() or line.endswith(":"):
+                continue
+            encoded = encode_directive(trace, line)
+            if encoded is None:
+                # Where the data that follows starts is anybody's guess:
+                yield address, end - address, None, line.strip()
+                return
+            yield address, len(encoded), encoded, line.strip()
+            address += len(encoded)
+
+
+def iter_code_units(trace, codeblock):
+    ''' Yields an (address, length, encoded, entry) tuple for every
+        instruction the listing has for <codeblock>, walking it the
+        way ExecTrace._code_listing() does.
+    '''
+    address = codeblock.start
+    while address <= codeblock.end:
+        entry = trace.disasm.get(address)
+        if entry is None:
+            address += 1
+            continue
+        length = trace.instruction_length(address)
+        yield address, length, trace.encode_instruction(address, entry), entry
+        address += length
+
+
+def verify_listing(trace):
+    ''' Returns the list of Mismatch records, in address order,
+        for everything in the listing of <trace> that does not
+        assemble back to the bytes of its image.
+    '''
+    variables = {var.address: var for var in trace.symbols.variables()}
+    var_addrs = sorted(variables.keys())
+
+    mismatches = []
+    for reloc_to, reloc_end, sections in trace.iter_listing_sections():
+        units = []
+        for start, end, codeblock in sections:
+            if codeblock is None:
+                units.extend(iter_data_units(trace, start, end, variables, var_addrs))
+            else:
+                units.extend(iter_code_units(trace, codeblock))
+
+        # Shorter than the relocation block if the image ends before it:
+        image = trace.read_bytes(reloc_to, reloc_end - reloc_to)
+        if not all_encoded(units, reloc_to, reloc_to + len(image)) or \
+           b"".join([encoded for address, length, encoded, source in units]) != image:
+            mismatches.extend(find_mismatches(trace, reloc_to, image, units))
+    return mismatches
+
+
+def all_encoded(units, start, end):
+    ''' Tells whether the <units> encode, back to back, every byte
+        in [start, end) with exactly as many bytes as they were decoded
+        from, so that their encodings can be compared in bulk.
+    '''
+    address = start
+    for unit_address, length, encoded, source in units:
+        if unit_address != address or encoded is None or len(encoded) != length:
+            return False
+        address += length
+    return address == end
+
+
+def find_mismatches(trace, reloc_to, image, units):
+    mismatches = []
+    covered = bytearray(len(image))
+    for address, length, encoded, source in units:
+        offset = address - reloc_to
+        covered[offset:offset + length] = b"\1" * len(covered[offset:offset + length])
+        expected = image[offset:offset + length]
+        if encoded == expected:
+            continue
+        if not isinstance(source, str):
+            source = render(trace, source)
+        mismatches.append(Mismatch(address, source, encoded, expected))
+
+    # Bytes of the image for which the listing has nothing at all:
+    pos = covered.find(0)
+    while pos != -1:
+        stop = covered.find(1, pos)
+        if stop == -1:
+            stop = len(image)
+        mismatches.append(Mismatch(reloc_to + pos, None, b"", image[pos:stop]))
+        pos = covered.find(0, stop)
+
+    mismatches.sort(key=lambda m: m.address)
+    return mismatches
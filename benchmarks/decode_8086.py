@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Microbenchmark of the 8086 instruction decoder used by MSDOS_Trace.
+#
+# usage: decode_8086.py [image_size] [repetitions]
+#
+import sys
+import time
+
+from exectrace.msdos import MSDOS_Trace
+
+# Only straight-line instructions, so that decoding never ends a code block:
+INSTRUCTION_MIX = [
+  [0x90],                           # nop
+  [0xB0, 0x12],                     # mov al, 0x12
+  [0xB9, 0x10, 0x00],               # mov cx, 0x0010
+  [0xBB, 0x00, 0x20],               # mov bx, 0x2000
+  [0x8B, 0xC3],                     # mov ax, bx
+  [0x8A, 0x07],                     # mov al, [bx]
+  [0x88, 0x47, 0x02],               # mov [bx + 0x02], al
+  [0x8B, 0x86, 0x00, 0x01],         # mov ax, [bp + 0x0100]
+  [0x89, 0x1E, 0x00, 0x30],         # mov [0x3000], bx
+  [0x33, 0xC0],                     # xor ax, ax
+  [0x0B, 0xC9],                     # or cx, cx
+  [0x2B, 0x56, 0x04],               # sub dx, [bp + 0x04]
+  [0x83, 0xC3, 0x02],               # add bx, 0x02
+  [0x83, 0x7E, 0x06, 0x00],         # cmp [bp + 0x06], 0x00
+  [0x81, 0x06, 0x00, 0x30, 0x01, 0x00], # add [0x3000], 0x0001
+  [0x80, 0x3F, 0x20],               # cmp [bx], 0x20
+  [0x3D, 0x34, 0x12],               # cmp ax, 0x1234
+  [0x26, 0x8B, 0x05],               # mov ax, es:[di]
+  [0x26, 0xC7, 0x06, 0x00, 0x30, 0x00, 0x04], # mov es:[0x3000], 0x0400
+  [0xC6, 0x06, 0x02, 0x30, 0x01],   # mov [0x3002], 0x01
+  [0x8E, 0xC0],                     # mov es, ax
+  [0x8C, 0xD8],                     # mov ax, ds
+  [0xF7, 0xE3],                     # mul bx
+  [0xF3, 0xAB],                     # rep stosw
+  [0x50],                           # push ax
+  [0x58],                           # pop ax
+  [0xFF, 0x36, 0x00, 0x30],         # push [0x3000]
+  [0x8F, 0x06, 0x00, 0x30],         # pop [0x3000]
+]
+
+
+def build_image(size):
+  image = bytearray()
+  i = 0
+  while True:
+    instruction = INSTRUCTION_MIX[i % len(INSTRUCTION_MIX)]
+    if len(image) + len(instruction) > size:
+      break
+    image.extend(instruction)
+    i += 1
+  end = len(image)
+  image.extend([0x00] * (size - end))
+  return bytes(image), end
+
+
+def decode_all(trace, start, end):
+  count = 0
+  trace.current_entry_point = start
+  trace.PC = start
+  while trace.PC < start + end:
+    trace.disasm_instruction(trace.fetch())
+    count += 1
+  return count
+
+
+def main(size=0x10000, repetitions=5):
+  image, end = build_image(size)
+  trace = MSDOS_Trace(image, relocation_blocks=((0x0000, 0x0000, size),))
+
+  best = None
+  for _ in range(repetitions):
+    t0 = time.perf_counter()
+    count = decode_all(trace, 0x0000, end)
+    elapsed = time.perf_counter() - t0
+    if best is None or elapsed < best:
+      best = elapsed
+
+  print("{} instructions decoded in {:.4f}s: {:.0f} instructions/s".format(count, best, count / best))
+
+
+if __name__ == '__main__':
+  args = [int(arg, 0) for arg in sys.argv[1:]]
+  main(*args)
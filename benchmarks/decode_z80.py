@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Microbenchmark of the Z80 instruction decoder used by MSX_Trace.
+#
+# usage: decode_z80.py [image_size] [repetitions]
+#
+import sys
+import time
+
+from exectrace.msx import MSX_Trace
+
+# Only straight-line instructions, so that decoding never ends a code block:
+INSTRUCTION_MIX = [
+  [0x00],                     # nop
+  [0x3E, 0x12],               # ld a, 0x12
+  [0x06, 0x34],               # ld b, 0x34
+  [0x21, 0x00, 0xC0],         # ld hl, 0xC000
+  [0x11, 0x10, 0x00],         # ld de, 0x0010
+  [0x3A, 0x00, 0xE0],         # ld a, (0xE000)
+  [0x32, 0x01, 0xE0],         # ld (0xE001), a
+  [0x7E],                     # ld a, (hl)
+  [0x47],                     # ld b, a
+  [0x80],                     # add a, b
+  [0xE6, 0x0F],               # and 0x0F
+  [0xFE, 0x03],               # cp 0x03
+  [0x23],                     # inc hl
+  [0x19],                     # add hl, de
+  [0xC5],                     # push bc
+  [0xC1],                     # pop bc
+  [0xEB],                     # ex de, hl
+  [0xCB, 0x47],               # bit 0, a
+  [0xCB, 0x11],               # rl c
+  [0xED, 0x52],               # sbc hl, de
+  [0xED, 0xB0],               # ldir
+  [0xED, 0x5B, 0x00, 0xE0],   # ld de, (0xE000)
+  [0xDD, 0x21, 0x00, 0xE1],   # ld ix, 0xE100
+  [0xDD, 0x7E, 0x05],         # ld a, (ix + 5)
+  [0xDD, 0x36, 0x02, 0x10],   # ld (ix + 2), 16
+  [0xFD, 0x86, 0x03],         # add a, (iy + 3)
+  [0xFD, 0xCB, 0x04, 0x46],   # bit 0, (iy + 0x04)
+  [0xDD, 0xCB, 0x01, 0xFE],   # set 7, (ix + 0x01)
+]
+
+
+def build_image(size):
+  image = bytearray()
+  i = 0
+  while True:
+    instruction = INSTRUCTION_MIX[i % len(INSTRUCTION_MIX)]
+    if len(image) + len(instruction) > size:
+      break
+    image.extend(instruction)
+    i += 1
+  end = len(image)
+  image.extend([0x00] * (size - end))
+  return bytes(image), end
+
+
+def decode_all(trace, start, end):
+  count = 0
+  trace.current_entry_point = start
+  trace.PC = start
+  while trace.PC < start + end:
+    trace.disasm_instruction(trace.fetch())
+    count += 1
+  return count
+
+
+def main(size=0x8000, repetitions=5):
+  image, end = build_image(size)
+  trace = MSX_Trace(image, relocation_blocks=((0x0000, 0x4000, size),))
+
+  best = None
+  for _ in range(repetitions):
+    t0 = time.perf_counter()
+    count = decode_all(trace, 0x4000, end)
+    elapsed = time.perf_counter() - t0
+    if best is None or elapsed < best:
+      best = elapsed
+
+  print("{} instructions decoded in {:.4f}s: {:.0f} instructions/s".format(count, best, count / best))
+
+
+if __name__ == '__main__':
+  args = [int(arg, 0) for arg in sys.argv[1:]]
+  main(*args)
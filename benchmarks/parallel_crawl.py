@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Compares a serial crawl of an MSX ROM having many entry points
+# with crawls whose decoding is shared by worker processes.
+#
+# usage: parallel_crawl.py [routines] [processes...]
+#
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from decode_z80 import build_image
+from exectrace.msx import MSX_Trace
+
+ROM_SIZE = 0xB000
+ROM_BASE = 0x4000
+
+
+def build_rom(routines):
+  ''' Straight-line routines ending in "ret", one entry point each. '''
+  routine_size = ROM_SIZE // routines
+  routine, end = build_image(routine_size - 1)
+  routine = routine[:end] + bytes([0xC9]) + bytes(routine_size - end - 1)  # ret
+  image = routine * routines + bytes(ROM_SIZE - routine_size * routines)
+  entry_points = [ROM_BASE + i * routine_size for i in range(routines)]
+  return image, entry_points
+
+
+def crawl(image, entry_points, processes):
+  trace = MSX_Trace(image, relocation_blocks=((0x0000, ROM_BASE, ROM_SIZE),))
+  t0 = time.perf_counter()
+  trace.run(entry_points=entry_points, processes=processes)
+  return time.perf_counter() - t0, trace
+
+
+def main(routines=64, *process_counts):
+  image, entry_points = build_rom(routines)
+  serial_time, serial = crawl(image, entry_points, None)
+  print("serial:       {:.3f}s ({} instructions)".format(serial_time, len(serial.disasm)))
+  for processes in process_counts or (2, 4, os.cpu_count() or 1):
+    elapsed, trace = crawl(image, entry_points, processes)
+    assert trace.disasm == serial.disasm
+    print("{:2d} processes: {:.3f}s ({:.2f}x)".format(processes, elapsed, serial_time / elapsed))
+
+
+if __name__ == '__main__':
+  main(*[int(arg, 0) for arg in sys.argv[1:]])
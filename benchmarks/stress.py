@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Stress harness tracing adversarial ROM shapes at doubling sizes.
+#
+# For each shape, the runtime and peak memory of MSX_Trace.run() are
+# measured at every size and a power law is fitted to them. A shape
+# fails if either grows faster than --max-exponent (near-linear code
+# fits an exponent close to 1, quadratic code one close to 2), or if
+# its crawl does not finish within --timeout seconds. Each measurement
+# runs in a process of its own, so that a crawl that never terminates
+# can be killed and reported.
+#
+# usage: stress.py [--start N] [--steps N] [--max-exponent E]
+#                  [--timeout SECONDS] [-o OUTPUT] [shape...]
+#
+import argparse
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+
+# The exectrace package of this checkout, even if it is not installed:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Lib"))
+
+from exectrace.msx import MSX_Trace
+
+ROM_BASE = 0x4000
+ROM_SIZE = 0xC000
+
+
+def rom(code):
+  if len(code) > ROM_SIZE:
+    raise ValueError("shape does not fit in the ROM at this size")
+  return bytes(code) + bytes(ROM_SIZE - len(code))
+
+
+def word(address):
+  return [address & 0xFF, address >> 8]
+
+
+def split_every_block(n):
+  ''' A block of <n> nops, then <n> conditional jumps into each of its
+      instructions in ascending order, so that every one of them splits
+      the block visited before. '''
+  code = [0x00] * n + [0xC9]                 # nop ... ret
+  jumper = ROM_BASE + len(code)
+  for i in range(n):
+    code += [0xCA] + word(ROM_BASE + i)      # jp z, nop_i
+  code += [0xC9]
+  # Pending entry points are explored last in first out:
+  return rom(code), [jumper, ROM_BASE], {}
+
+
+def tiny_blocks(n):
+  ''' <n> blocks of a single instruction each. '''
+  code = [0x28, 0x00] * n + [0xC9]           # jr z, $+2 ... ret
+  return rom(code), [ROM_BASE], {}
+
+
+def conditional_return_chain(n):
+  ''' <n> routines each calling the next one after a conditional
+      return, so that the call chain is <n> deep and every return
+      address stays pending until the end of the chain. '''
+  code = []
+  for i in range(n):
+    next_routine = ROM_BASE + len(code) + 5
+    code += [0xC8] + [0xCD] + word(next_routine) + [0xC9]   # ret z; call next; ret
+  code += [0xC9]
+  return rom(code), [ROM_BASE], {}
+
+
+def long_pending_queue(n):
+  ''' A jump table of <n> entries, all of them scheduled before the
+      crawl starts, to routines that each call the one after them. '''
+  table_size = 2 * n
+  routines = [ROM_BASE + table_size + 4 * i for i in range(n)]
+  code = []
+  for address in routines:
+    code += word(address)
+  for address in routines[1:]:
+    code += [0xCD] + word(address) + [0xC9]                 # call next; ret
+  code += [0xC9]
+  return rom(code), [], {ROM_BASE: ("JUMP_TABLE", "jump_table", n)}
+
+
+SHAPES = {
+  "split_every_block": split_every_block,
+  "tiny_blocks": tiny_blocks,
+  "conditional_return_chain": conditional_return_chain,
+  "long_pending_queue": long_pending_queue,
+}
+
+
+def measure(shape, n, repetitions):
+  ''' Runs in a worker process. '''
+  image, entry_points, variables = SHAPES[shape](n)
+  with contextlib.redirect_stdout(io.StringIO()):
+    best = None
+    for _ in range(repetitions):
+      trace = MSX_Trace(image,
+                        relocation_blocks=((0x0000, ROM_BASE, ROM_SIZE),),
+                        variables=variables)
+      t0 = time.perf_counter()
+      trace.run(entry_points=entry_points)
+      elapsed = time.perf_counter() - t0
+      best = elapsed if best is None else min(best, elapsed)
+    del trace
+
+    # In a run of its own, since tracemalloc slows everything down.
+    # Only what run() allocates on top of the trace gets counted:
+    trace = MSX_Trace(image,
+                      relocation_blocks=((0x0000, ROM_BASE, ROM_SIZE),),
+                      variables=variables)
+    tracemalloc.start()
+    trace.run(entry_points=entry_points)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+  return {"size": n,
+          "instructions": len(trace.disasm),
+          "blocks": len(trace.visited_ranges),
+          "splits": trace.visited_ranges.splits,
+          "run_s": round(best, 6),
+          "peak_memory_kb": peak // 1024}
+
+
+def measure_with_timeout(shape, n, repetitions, timeout):
+  ''' Returns the result of measure(), or None if the crawl
+      did not terminate within <timeout> seconds. '''
+  pool = multiprocessing.Pool(1)
+  try:
+    return pool.apply_async(measure, (shape, n, repetitions)).get(timeout)
+  except multiprocessing.TimeoutError:
+    return None
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def growth_exponent(sizes, values):
+  ''' Slope of the least squares line through the (log size, log value)
+      points, that is the k of the best fitting value ~ size**k. '''
+  points = [(math.log(s), math.log(v)) for s, v in zip(sizes, values) if v > 0]
+  if len(points) < 2:
+    return None
+  mean_x = sum(x for x, _ in points) / len(points)
+  mean_y = sum(y for _, y in points) / len(points)
+  sxx = sum((x - mean_x) ** 2 for x, _ in points)
+  sxy = sum((x - mean_x) * (y - mean_y) for x, y in points)
+  return sxy / sxx
+
+
+def stress_shape(shape, sizes, repetitions, timeout, max_exponent):
+  results = []
+  for n in sizes:
+    result = measure_with_timeout(shape, n, repetitions, timeout)
+    if result is None:
+      print("{:26s} {:>6}  did not terminate within {}s".format(shape, n, timeout))
+      return {"shape": shape, "status": "timeout", "size": n, "results": results}
+    results.append(result)
+    print("{:26s} {:>6}  {:>7} instructions {:>6} blocks {:9.4f}s {:>7} KiB".format(
+          shape, n, result["instructions"], result["blocks"],
+          result["run_s"], result["peak_memory_kb"]))
+
+  time_exponent = growth_exponent(sizes, [r["run_s"] for r in results])
+  memory_exponent = growth_exponent(sizes, [r["peak_memory_kb"] for r in results])
+  worst = max(e for e in (time_exponent, memory_exponent, 0) if e is not None)
+  status = "ok" if worst <= max_exponent else "FAIL"
+  print("{:26s} runtime ~ n^{:.2f}, memory ~ n^{:.2f}: {}\n".format(
+        shape, time_exponent or 0, memory_exponent or 0, status))
+  return {"shape": shape,
+          "status": status,
+          "time_exponent": time_exponent,
+          "memory_exponent": memory_exponent,
+          "results": results}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Traces adversarial ROM shapes at doubling sizes.")
+  parser.add_argument("shapes", nargs="*", help="shapes to run (default: all of them)")
+  parser.add_argument("--start", type=int, default=512, help="smallest size")
+  parser.add_argument("--steps", type=int, default=5, help="number of doublings of the size")
+  parser.add_argument("--repetitions", type=int, default=3)
+  parser.add_argument("--max-exponent", type=float, default=1.5,
+                      help="fastest growth of runtime or memory accepted (default: 1.5)")
+  parser.add_argument("--timeout", type=float, default=60,
+                      help="seconds a single crawl may take before it counts as not terminating")
+  parser.add_argument("-o", "--output", default=None, help="writes the results to this JSON file")
+  args = parser.parse_args(argv)
+
+  sizes = [args.start << i for i in range(args.steps)]
+  reports = [stress_shape(shape, sizes, args.repetitions, args.timeout, args.max_exponent)
+             for shape in args.shapes or SHAPES]
+
+  if args.output is not None:
+    with open(args.output, "w") as output_file:
+      json.dump(reports, output_file, indent=2)
+  return 0 if all(report["status"] == "ok" for report in reports) else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Benchmark suite on the synthetic images of synth.py: instructions
+# traced per second by run(), listing bytes written per second by
+# save_disassembly_listing() and the peak memory of a trace.
+#
+# The results are saved as JSON, so that those of two commits can be
+# compared to spot regressions:
+#
+#   git checkout A && benchmarks/suite.py -o A.json
+#   git checkout B && benchmarks/suite.py -o B.json --compare A.json
+#
+# usage: suite.py [-o OUTPUT] [--compare BASELINE] [--threshold FRACTION]
+#                 [--repetitions N] [--quick] [case...]
+#
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The exectrace package of this checkout, even if it is not installed:
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Lib"))
+
+import synth
+from exectrace.msdos import MSDOS_Trace
+from exectrace.msx import MSX_Trace
+
+try:
+  import resource
+except ImportError:  # Not available on Windows
+  resource = None
+
+TRACE_CLASSES = {"z80": MSX_Trace, "8086": MSDOS_Trace}
+
+# name: (isa, size, branch_density, jump_tables, data_ratio)
+CASES = {
+  "z80-small":     ("z80", 0x2000, 0.10, 2, 0.2),
+  "z80-large":     ("z80", 0xC000, 0.10, 8, 0.2),
+  "z80-branchy":   ("z80", 0xC000, 0.30, 8, 0.2),
+  "z80-data":      ("z80", 0xC000, 0.10, 8, 0.6),
+  "z80-tables":    ("z80", 0xC000, 0.10, 32, 0.2),
+  "8086-small":    ("8086", 0x2000, 0.10, 2, 0.2),
+  "8086-large":    ("8086", 0xFFF0, 0.10, 8, 0.2),
+  "8086-branchy":  ("8086", 0xFFF0, 0.30, 8, 0.2),
+  "8086-data":     ("8086", 0xFFF0, 0.10, 8, 0.6),
+}
+QUICK_CASES = ["z80-small", "8086-small"]
+
+# Metrics where bigger is better, the others being better when smaller:
+THROUGHPUTS = ("instructions_per_s", "listing_bytes_per_s")
+
+
+def make_trace(synthetic):
+  return TRACE_CLASSES[synthetic.isa.name](synthetic.image,
+                                           relocation_blocks=synthetic.relocation_blocks,
+                                           variables=synthetic.variables)
+
+
+def run_trace(synthetic):
+  with contextlib.redirect_stdout(io.StringIO()):
+    trace = make_trace(synthetic)
+    t0 = time.perf_counter()
+    trace.run(entry_points=synthetic.entry_points)
+    return trace, time.perf_counter() - t0
+
+
+def peak_rss_kb():
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == "darwin":
+    peak //= 1024  # reported in bytes rather than kilobytes
+  return peak
+
+
+def best_time(operation, repetitions, min_time=0.2):
+  ''' Best of <repetitions> timings of <operation>, which returns how
+      long its timed part took. Like timeit, each timing repeats it for
+      at least <min_time> seconds, so that small images still give
+      stable figures.
+  '''
+  best = None
+  for _ in range(repetitions):
+    total = 0.0
+    calls = 0
+    while total < min_time:
+      total += operation()
+      calls += 1
+    best = total / calls if best is None else min(best, total / calls)
+  return best
+
+
+def timed_listing(trace):
+  listing = io.StringIO()
+  t0 = time.perf_counter()
+  trace.save_disassembly_listing(listing)
+  return time.perf_counter() - t0
+
+
+def bench_case(name, repetitions):
+  isa, size, branch_density, jump_tables, data_ratio = CASES[name]
+  synthetic = synth.build(isa, size, branch_density, jump_tables, data_ratio)
+
+  # Timings only get slower from noise, so the best one is kept:
+  run_time = best_time(lambda: run_trace(synthetic)[1], repetitions)
+  trace, _ = run_trace(synthetic)
+  listing_time = best_time(lambda: timed_listing(trace), repetitions)
+  listing = io.StringIO()
+  trace.save_disassembly_listing(listing)
+  listing_bytes = len(listing.getvalue().encode())
+
+  # In a run of its own, since tracemalloc slows everything down:
+  del trace
+  tracemalloc.start()
+  trace, _ = run_trace(synthetic)
+  trace.save_disassembly_listing(io.StringIO())
+  peak_memory = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+
+  return {"isa": isa,
+          "image_size": len(synthetic.image),
+          "branch_density": branch_density,
+          "jump_tables": jump_tables,
+          "data_ratio": data_ratio,
+          "instructions": len(trace.disasm),
+          "run_s": round(run_time, 6),
+          "instructions_per_s": round(len(trace.disasm) / run_time),
+          "listing_bytes": listing_bytes,
+          "listing_s": round(listing_time, 6),
+          "listing_bytes_per_s": round(listing_bytes / listing_time),
+          "peak_memory_kb": peak_memory // 1024}
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(results, baseline, threshold):
+  ''' Returns the lines describing how <results> differ from <baseline>,
+      and whether any metric got worse by more than <threshold>.
+  '''
+  lines = []
+  regressed = False
+  for name, result in results["cases"].items():
+    old = baseline["cases"].get(name)
+    if old is None:
+      continue
+    for metric in THROUGHPUTS + ("peak_memory_kb",):
+      if not old.get(metric) or result.get(metric) is None:
+        continue
+      change = result[metric] / old[metric] - 1
+      worse = -change if metric in THROUGHPUTS else change
+      flag = ""
+      if worse > threshold:
+        flag = "  REGRESSION"
+        regressed = True
+      lines.append("{:14s} {:20s} {:>12} -> {:>12} {:+7.1%}{}".format(
+                   name, metric, old[metric], result[metric], change, flag))
+    if old.get("instructions") != result["instructions"]:
+      lines.append("{:14s} traced {} instructions instead of {}".format(
+                   name, result["instructions"], old.get("instructions")))
+  return lines, regressed
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmarks tracing and listing synthetic images.")
+  parser.add_argument("cases", nargs="*", help="cases to run (default: all of them)")
+  parser.add_argument("-o", "--output", default=None, help="writes the results to this JSON file")
+  parser.add_argument("--compare", default=None, help="JSON results of a previous run to compare with")
+  parser.add_argument("--threshold", type=float, default=0.10,
+                      help="fraction by which a metric may get worse before it counts as a regression")
+  parser.add_argument("--repetitions", type=int, default=5)
+  parser.add_argument("--quick", action="store_true", help="runs only the small cases")
+  args = parser.parse_args(argv)
+
+  names = args.cases or (QUICK_CASES if args.quick else list(CASES))
+
+  results = {"commit": git_commit(),
+             "python": platform.python_version(),
+             "machine": platform.machine(),
+             "cases": {}}
+  for name in names:
+    result = bench_case(name, args.repetitions)
+    results["cases"][name] = result
+    print("{:14s} {:>8} instructions/s {:>10} listing bytes/s {:>8} KiB peak".format(
+          name, result["instructions_per_s"], result["listing_bytes_per_s"], result["peak_memory_kb"]))
+  results["peak_rss_kb"] = peak_rss_kb()
+
+  if args.output is not None:
+    with open(args.output, "w") as output_file:
+      json.dump(results, output_file, indent=2)
+
+  if args.compare is not None:
+    with open(args.compare) as baseline_file:
+      baseline = json.load(baseline_file)
+    lines, regressed = compare(results, baseline, args.threshold)
+    print("\ncompared with {}:".format(baseline.get("commit") or args.compare))
+    print("\n".join(lines))
+    return 1 if regressed else 0
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
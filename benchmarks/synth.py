@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Generator of synthetic Z80 and 8086 images for the benchmarks, so
+# that they do not depend on commercial ROMs.
+#
+# An image is a sequence of routines, separated by blocks of random
+# data that no code ever reaches. Routines are straight-line code from
+# the instruction mixes of decode_z80.py and decode_8086.py, sprinkled
+# with conditional branches to later instructions of the same routine,
+# forward jumps and calls to other routines, and ending with "ret".
+# Every routine calls the next one, so that a single entry point
+# reaches all of them, except for those only reachable through the
+# declared jump tables.
+#
+# usage: synth.py z80|8086 <output> [size] [branch_density] [jump_tables] [data_ratio] [seed]
+#
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The exectrace package of this checkout, even if it is not installed:
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Lib"))
+
+import decode_8086
+import decode_z80
+
+ROUTINE_SIZE = 256   # average, in bytes
+TABLE_ENTRIES = 8
+
+
+class Z80():
+  name = "z80"
+  base = 0x4000
+  max_size = 0xC000
+  mix = decode_z80.INSTRUCTION_MIX
+  branch_size = 2    # jr cc, rel8
+  jump_size = 3      # jp nn
+  call_size = 3      # call nn
+  ret = [0xC9]
+
+  @staticmethod
+  def branch(pc, target):
+    return [random.choice((0x20, 0x28, 0x30, 0x38)), (target - pc - 2) & 0xFF]
+
+  @staticmethod
+  def jump(pc, target):
+    return [0xC3, target & 0xFF, target >> 8]
+
+  @staticmethod
+  def call(pc, target):
+    return [0xCD, target & 0xFF, target >> 8]
+
+
+class I8086():
+  name = "8086"
+  base = 0x0000
+  max_size = 0x10000
+  mix = decode_8086.INSTRUCTION_MIX
+  branch_size = 2    # jcc rel8
+  jump_size = 3      # jmp rel16
+  call_size = 3      # call rel16
+  ret = [0xC3]
+
+  @staticmethod
+  def branch(pc, target):
+    return [random.choice((0x72, 0x74, 0x75, 0x7D)), (target - pc - 2) & 0xFF]
+
+  @staticmethod
+  def jump(pc, target):
+    offset = (target - pc - 3) & 0xFFFF
+    return [0xE9, offset & 0xFF, offset >> 8]
+
+  @staticmethod
+  def call(pc, target):
+    offset = (target - pc - 3) & 0xFFFF
+    return [0xE8, offset & 0xFF, offset >> 8]
+
+
+ISAS = {"z80": Z80, "8086": I8086}
+
+
+class SyntheticImage():
+  ''' The bytes of a synthetic image and what to trace it with. '''
+
+  def __init__(self, isa, image, entry_points, variables, code_size):
+    self.isa = isa
+    self.image = image
+    self.entry_points = entry_points
+    self.variables = variables
+    self.code_size = code_size
+
+  @property
+  def relocation_blocks(self):
+    return ((0x0000, self.isa.base, len(self.image)),)
+
+
+def plan_routine(isa, size, branch_density):
+  ''' Picks the kind and length of each instruction of a routine.
+      The branch targets are only known once routines are laid out.
+  '''
+  plan = []
+  used = 0
+  while used < size:
+    if random.random() < branch_density:
+      kind = random.choice(("branch", "branch", "branch", "call", "call", "jump"))
+      length = getattr(isa, kind + "_size")
+      plan.append((kind, length))
+    else:
+      instruction = random.choice(isa.mix)
+      length = len(instruction)
+      plan.append((instruction, length))
+    used += length
+  # Keeps the routines chained together:
+  plan.append(("next", isa.call_size))
+  plan.append((isa.ret, len(isa.ret)))
+  return plan
+
+
+def emit_routine(isa, plan, start, routines, next_routine):
+  addresses = []
+  pc = start
+  for _, length in plan:
+    addresses.append(pc)
+    pc += length
+
+  code = []
+  for i, (kind, length) in enumerate(plan):
+    pc = addresses[i]
+    if kind == "branch":
+      # Somewhere later in the routine, within reach of a rel8 offset:
+      later = [a for a in addresses[i + 1:] if a - pc - 2 <= 127]
+      code.extend(isa.branch(pc, random.choice(later)))
+    elif kind == "jump":
+      # Over a few instructions, which are then left unreachable:
+      code.extend(isa.jump(pc, random.choice(addresses[i + 1:i + 4])))
+    elif kind == "call":
+      code.extend(isa.call(pc, random.choice(routines)))
+    elif kind == "next":
+      code.extend(isa.call(pc, next_routine))
+    else:
+      code.extend(kind)
+  return code
+
+
+def build(isa, size=0x8000, branch_density=0.1, jump_tables=4, data_ratio=0.2, seed=0):
+  ''' Builds a SyntheticImage of <size> bytes for <isa> ("z80" or "8086").
+      <branch_density> is the fraction of instructions that branch, jump
+      or call, <jump_tables> the number of declared jump tables and
+      <data_ratio> the fraction of the image filled with unreachable data.
+      The same arguments always build the same image.
+  '''
+  if isinstance(isa, str):
+    isa = ISAS[isa]
+  size = min(size, isa.max_size)
+  random.seed(seed)
+
+  table_size = 2 * TABLE_ENTRIES
+  code_budget = int((size - jump_tables * table_size) * (1 - data_ratio))
+  data_budget = size - jump_tables * table_size - code_budget
+
+  plans = []
+  planned = 0
+  while True:
+    plan = plan_routine(isa, random.randint(ROUTINE_SIZE // 2, ROUTINE_SIZE * 3 // 2), branch_density)
+    length = sum(length for _, length in plan)
+    if planned + length > code_budget:
+      break
+    plans.append(plan)
+    planned += length
+  if not plans:
+    raise ValueError("image too small for a single routine")
+
+  # Lays out the routines with the data blocks between them:
+  gaps = [0] * len(plans)
+  for _ in range(data_budget):
+    gaps[random.randrange(len(plans))] += 1
+  starts = []
+  address = isa.base + jump_tables * table_size
+  for plan, gap in zip(plans, gaps):
+    starts.append(address)
+    address += sum(length for _, length in plan) + gap
+
+  # The routines called from the jump tables are not chained to the others:
+  table_targets = starts[-jump_tables * TABLE_ENTRIES:] if jump_tables else []
+  if len(table_targets) == len(starts):
+    table_targets = table_targets[1:]
+  chained = starts[:len(starts) - len(table_targets)]
+
+  image = bytearray()
+  variables = {}
+  for t in range(jump_tables):
+    address = isa.base + t * table_size
+    variables[address] = ("JUMP_TABLE_%d" % t, "jump_table", TABLE_ENTRIES)
+    for i in range(TABLE_ENTRIES):
+      target = random.choice(table_targets or starts)
+      image.extend((target & 0xFF, target >> 8))
+
+  for i, (plan, gap, start) in enumerate(zip(plans, gaps, starts)):
+    next_routine = chained[(chained.index(start) + 1) % len(chained)] if start in chained else chained[0]
+    image.extend(emit_routine(isa, plan, start, chained, next_routine))
+    image.extend(random.getrandbits(8) for _ in range(gap))
+
+  image.extend(bytes(size - len(image)))
+  return SyntheticImage(isa, bytes(image), [chained[0]], variables, planned)
+
+
+def main(isa, output, size=0x8000, branch_density=0.1, jump_tables=4, data_ratio=0.2, seed=0):
+  synthetic = build(isa, size, branch_density, jump_tables, data_ratio, seed)
+  with open(output, "wb") as image_file:
+    image_file.write(synthetic.image)
+  print("{}: {} bytes, {} bytes of code, entry point {:04X}, {} jump tables at {}".format(
+        output, len(synthetic.image), synthetic.code_size, synthetic.entry_points[0],
+        len(synthetic.variables), " ".join("%04X" % a for a in sorted(synthetic.variables))))
+
+
+if __name__ == '__main__':
+  types = [str, str, lambda v: int(v, 0), float, int, float, int]
+  main(*[t(arg) for t, arg in zip(types, sys.argv[1:])])
@@ -6,9 +6,9 @@
 RELOCATION_BLOCKS = (
 # physical, logical, length 
    (0x0000,  0x4000, 0x2000),
-#  (0x2000,  0x6000, 0x2000), # duplicate, ignore.
+   (0x0000,  0x6000, 0x2000), # mirror of 0x4000
    (0x4000,  0x8000, 0x2000),
-#  (0x6000,  0xA000, 0x2000), # duplicate, ignore.
+   (0x4000,  0xA000, 0x2000), # mirror of 0x8000
 )
 
 ENTRY_POINTS = [
@@ -68,6 +68,7 @@ STACK_WHITELIST = [
 ]
 
 
+import os
 import sys
 from exectrace import ERROR
 from exectrace.msx import MSX_Trace
@@ -85,9 +86,10 @@ else:
                     subroutines=KNOWN_SUBROUTINES,
                     stack_whitelist=STACK_WHITELIST)
 
-  trace.run(entry_points=ENTRY_POINTS)
+  # Set EXECTRACE_CACHE to a directory to reuse the trace of a previous run:
+  trace.run(entry_points=ENTRY_POINTS, cache_dir=os.environ.get("EXECTRACE_CACHE"))
   trace.print_jp_HLs()
   trace.print_stack_manipulation()
   trace.save_disassembly_listing("{}.asm".format(gamerom.split(".")[0]))
-  #trace.generate_graph(True)
+  #trace.export_cfg("{}.gv".format(gamerom.split(".")[0]), cluster_subroutines=True)
 
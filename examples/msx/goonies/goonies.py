@@ -29,6 +29,7 @@ STACK_WHITELIST = [
 ]
 
 
+import os
 import sys
 from exectrace import ERROR
 from exectrace.msx import MSX_Trace
@@ -46,7 +47,8 @@ else:
                     subroutines=KNOWN_SUBROUTINES,
                     stack_whitelist=STACK_WHITELIST)
 
-  trace.run(entry_points=ENTRY_POINTS)
+  # Set EXECTRACE_CACHE to a directory to reuse the trace of a previous run:
+  trace.run(entry_points=ENTRY_POINTS, cache_dir=os.environ.get("EXECTRACE_CACHE"))
   trace.print_jp_HLs()
   trace.print_stack_manipulation()
   trace.save_disassembly_listing("{}.asm".format(gamerom.split(".")[0]))
@@ -22,4 +22,7 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.6',
+    extras_require={
+        "numpy": ["numpy"],  # faster exectrace.tables
+    },
 )
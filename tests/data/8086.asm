@@ -0,0 +1,32 @@
+; Generated by MSDOS_ExecTrace
+DELAY:	equ 0x0010	; waits a bit
+
+
+	org 0x0000
+
+LABEL_0000:
+	call DELAY
+	je LABEL_0008
+	jmp LABEL_9000
+	lea si, 0x0030
+	lodsb
+	call LABEL_003E
+	retn
+	mov cx, 0x0004
+
+LABEL_0013:
+	loop LABEL_0013
+	retn
+LABEL_0016:
+	db 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
+	db 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
+	db 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
+	db 0x00, 0x00
+MESSAGE:
+	db "HELLO"
+LABEL_0035:
+	db 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
+	db 0x00
+	nop
+LABEL_003F:
+	db 0xB0
@@ -0,0 +1,33 @@
+; Generated by MSX_ExecTrace
+; git clone https://git.savannah.nongnu.org/git/z80asm.git
+
+
+
+	org 0x4000
+
+LABEL_4000:
+	call DELAY	; waits a bit
+	jr z, LABEL_4008
+	jp LABEL_8000
+	ld hl, MESSAGE
+	ld a, (hl)
+	call LABEL_403E
+	ret
+	ld b, 0x04
+
+LABEL_4012:
+	djnz LABEL_4012
+	ret
+LABEL_4015:
+	db 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
+	db 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
+	db 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
+	db 0x00, 0x00, 0x00
+MESSAGE:
+	db "HELLO"
+LABEL_4035:
+	db 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
+	db 0x00
+	nop
+LABEL_403F:
+	db 0x3E
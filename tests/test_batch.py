@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Lib"))
+
+from exectrace import batch
+
+
+class BrokenPool():
+    ''' Stands for a pool whose worker processes all died. '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, function, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool("a worker died"))
+        return future
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_manifest(self, jobs):
+        filename = os.path.join(self.directory, "manifest.json")
+        with open(filename, "w") as manifest_file:
+            json.dump({"output_dir": "out", "jobs": jobs}, manifest_file)
+        return filename
+
+    def test_jobs_of_the_same_name_are_rejected(self):
+        filename = self.write_manifest([{"image": "a/game.rom"}, {"image": "b/game.rom"}])
+        with self.assertRaises(ValueError):
+            batch.load_manifest(filename)
+
+    def test_jobs_can_be_told_apart_by_name(self):
+        filename = self.write_manifest([{"image": "a/game.rom"},
+                                        {"image": "b/game.rom", "name": "game-b"}])
+        jobs, output_dir = batch.load_manifest(filename)
+        self.assertEqual([job["name"] for job in jobs], ["game", "game-b"])
+
+    def test_dead_workers_are_reported_in_the_summary(self):
+        filename = self.write_manifest([{"image": "a.rom"}, {"image": "b.rom"}])
+        with mock.patch.object(batch, "make_pool", lambda max_workers: BrokenPool()):
+            self.assertEqual(batch.main([filename]), 1)
+        with open(os.path.join(self.directory, "out", "summary.json")) as summary_file:
+            summary = json.load(summary_file)
+        self.assertEqual([(job["name"], job["status"]) for job in summary],
+                         [("a", "error"), ("b", "error")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Lib"))
+
+from exectrace.msx.bios import analyze_bios
+
+# 0000: jp 0010
+# 0003: ld b, 0x01; call 0010; ret
+# 0010: push bc; ld b, a; ld a, (hl); pop bc; out (0x99), a; ret
+BIOS = bytearray(0x20)
+BIOS[0x00:0x03] = bytes([0xC3, 0x10, 0x00])
+BIOS[0x03:0x09] = bytes([0x06, 0x01, 0xCD, 0x10, 0x00, 0xC9])
+BIOS[0x10:0x17] = bytes([0xC5, 0x47, 0x7E, 0xC1, 0xD3, 0x99, 0xC9])
+VECTORS = {0x0000: "SAVES_BC", 0x0003: "CALLS_IT"}
+
+
+class SummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as directory:
+            romfile = os.path.join(directory, "bios.rom")
+            with open(romfile, "wb") as output:
+                output.write(BIOS)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.table = analyze_bios(romfile, VECTORS)
+
+    def test_saved_registers_are_not_used(self):
+        self.assertEqual(self.table[0x0000]["routine"], 0x0010)
+        self.assertEqual(self.table[0x0000]["uses"], ["A", "H", "L"])
+        self.assertEqual(self.table[0x0000]["clobbers"], ["A"])
+
+    def test_callers_get_what_the_callee_does(self):
+        self.assertEqual(self.table[0x0003]["uses"], ["A", "H", "L"])
+        self.assertEqual(self.table[0x0003]["clobbers"], ["A", "B"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Lib"))
+
+from exectrace import ExternalRegion
+from exectrace.msx import MSX_Trace, MSX_BIOS
+
+# 4000: call 9000
+# 4003: ret
+IMAGE = bytes([0xCD, 0x00, 0x90, 0xC9])
+
+HOOKS = ExternalRegion("HOOKS", 0x9000, 0x90FF, {0x9000: ("HOOK", None)})
+
+
+def listing(cache_dir, external_regions):
+    trace = MSX_Trace(IMAGE, relocation_blocks=((0, 0x4000, len(IMAGE)),),
+                      external_regions=external_regions)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(io.StringIO()):
+        trace.run(entry_points=[0x4000], cache_dir=cache_dir)
+        trace.save_disassembly_listing(output)
+    return output.getvalue()
+
+
+class ExternalRegionKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_added_region_is_not_hidden_by_a_warm_cache(self):
+        listing(self.cache_dir, (MSX_BIOS,))
+        warm = listing(self.cache_dir, (MSX_BIOS, HOOKS))
+        self.assertEqual(warm, listing(None, (MSX_BIOS, HOOKS)))
+        self.assertIn("HOOK:\tequ 0x9000", warm)
+
+
+if __name__ == "__main__":
+    unittest.main()
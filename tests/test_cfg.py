@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Lib"))
+
+from exectrace.cfg import build_cfg
+from exectrace.msx import MSX_Trace
+
+# 4000: jp 4006
+# 4003: db 0, 0, 0
+# 4006: ret nc
+# 4007: ret
+IMAGE = bytes([0xC3, 0x06, 0x40, 0x00, 0x00, 0x00, 0xD0, 0xC9])
+
+
+def traced(image, entry_points=(0x4000,)):
+    trace = MSX_Trace(image, relocation_blocks=((0, 0x4000, len(image)),))
+    with contextlib.redirect_stdout(io.StringIO()):
+        trace.run(entry_points=list(entry_points))
+    return trace
+
+
+class ExitTest(unittest.TestCase):
+
+    def test_jump_only_leads_to_its_target(self):
+        trace = traced(IMAGE)
+        self.assertEqual(trace.visited_ranges.find(0x4000).next_block, [0x4006])
+        nodes = build_cfg(trace)
+        self.assertEqual(nodes[0x4000].successors, [(0x4006, "jump")])
+        self.assertNotIn(0x4003, nodes)
+
+    def test_conditional_return_goes_on_with_the_next_instruction(self):
+        trace = traced(IMAGE)
+        self.assertEqual(trace.visited_ranges.find(0x4006).next_block, [0x4007])
+        nodes = build_cfg(trace)
+        self.assertEqual(nodes[0x4006].successors, [(0x4007, "next")])
+        self.assertEqual(nodes[0x4007].successors, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+
+import contextlib
+import io
+import json
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Lib"))
+
+from exectrace.export import BinaryExport
+from exectrace.msx import MSX_Trace
+
+# 4000: jp 4006
+# 4003: db 0, 0, 0
+# 4006: ret nc
+# 4007: ret
+IMAGE = bytes([0xC3, 0x06, 0x40, 0x00, 0x00, 0x00, 0xD0, 0xC9])
+
+
+def traced(image):
+    trace = MSX_Trace(image, relocation_blocks=((0, 0x4000, len(image)),))
+    with contextlib.redirect_stdout(io.StringIO()):
+        trace.run(entry_points=[0x4000])
+    return trace
+
+
+class EdgeTest(unittest.TestCase):
+
+    def edges(self, trace):
+        output = io.StringIO()
+        trace.export_jsonl(output)
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        return [(r["from"], r["to"], r["kind"]) for r in records if r["type"] == "edge"]
+
+    def test_jsonl_edges(self):
+        self.assertEqual(self.edges(traced(IMAGE)),
+                         [(0x4000, 0x4006, "jump"), (0x4006, 0x4007, "next")])
+
+    def test_binary_edges(self):
+        trace = traced(IMAGE)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "trace.extb")
+            trace.export_binary(filename)
+            with BinaryExport(filename) as export:
+                edges = [(e["from"], e["to"], e["kind"])
+                         for block in export.blocks() for e in export.edges_from(block)]
+        self.assertEqual(edges, [(0x4000, 0x4006, "jump"), (0x4006, 0x4007, "next")])
+
+    def test_other_version_is_reported(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "trace.extb")
+            with open(filename, "wb") as output:
+                output.write(struct.pack("<4sHH", b"EXTB", 99, 0))
+            with self.assertRaisesRegex(ValueError, r"\(version 99\)"):
+                BinaryExport(filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+#
+# Checks the disassembly listings of small images against the golden
+# ones in tests/data. After a change that is meant to alter the
+# listings, look over the differences and then rewrite the golden
+# files with:
+#
+#   python tests/test_listing.py --update
+
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Lib"))
+
+from exectrace.msdos import MSDOS_Trace
+from exectrace.msx import MSX_Trace
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def z80_image():
+    ''' 4000: call 4010; jr z, 4008; jp 8000 (not mapped)
+        4008: ld hl, 4030; ld a, (hl); call 403E; ret
+        4010: ld b, 4; djnz 4012; ret
+        4030: "HELLO"
+        403E: nop; ld a, (operand past the end of the image)
+    '''
+    image = bytearray(0x40)
+    image[0x00:0x08] = bytes([0xCD, 0x10, 0x40, 0x28, 0x03, 0xC3, 0x00, 0x80])
+    image[0x08:0x10] = bytes([0x21, 0x30, 0x40, 0x7E, 0xCD, 0x3E, 0x40, 0xC9])
+    image[0x10:0x15] = bytes([0x06, 0x04, 0x10, 0xFE, 0xC9])
+    image[0x30:0x35] = b"HELLO"
+    image[0x3E:0x40] = bytes([0x00, 0x3E])
+    return bytes(image)
+
+
+def i8086_image():
+    ''' 0000: call 0010; jz 0008; jmp 9000 (not mapped)
+        0008: mov si, 0030; lodsb; call 003E; ret
+        0010: mov cx, 4; loop 0013; ret
+        0030: "HELLO"
+        003E: nop; mov al, (operand past the end of the image)
+    '''
+    image = bytearray(0x40)
+    image[0x00:0x08] = bytes([0xE8, 0x0D, 0x00, 0x74, 0x03, 0xE9, 0xF8, 0x8F])
+    image[0x08:0x10] = bytes([0xBE, 0x30, 0x00, 0xAC, 0xE8, 0x2F, 0x00, 0xC3])
+    image[0x10:0x16] = bytes([0xB9, 0x04, 0x00, 0xE2, 0xFE, 0xC3])
+    image[0x30:0x35] = b"HELLO"
+    image[0x3E:0x40] = bytes([0x90, 0xB0])
+    return bytes(image)
+
+
+def listing(trace_class, image, base):
+    trace = trace_class(image,
+                        relocation_blocks=((0, base, len(image)),),
+                        variables={base + 0x30: ("MESSAGE", "str", 5)},
+                        subroutines={base + 0x10: ("DELAY", "waits a bit")})
+    output = io.StringIO()
+    with contextlib.redirect_stdout(io.StringIO()):
+        trace.run(entry_points=[base])
+        trace.save_disassembly_listing(output)
+    return output.getvalue()
+
+
+LISTINGS = {
+    "z80.asm": lambda: listing(MSX_Trace, z80_image(), 0x4000),
+    "8086.asm": lambda: listing(MSDOS_Trace, i8086_image(), 0x0000),
+}
+
+
+class GoldenListingTest(unittest.TestCase):
+
+    def check(self, filename):
+        with open(os.path.join(DATA_DIR, filename)) as golden:
+            self.assertEqual(LISTINGS[filename](), golden.read())
+
+    def test_z80(self):
+        self.check("z80.asm")
+
+    def test_8086(self):
+        self.check("8086.asm")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--update"]:
+        for filename, make_listing in LISTINGS.items():
+            with open(os.path.join(DATA_DIR, filename), "w") as golden:
+                golden.write(make_listing())
+    else:
+        unittest.main()
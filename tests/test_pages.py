@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Lib"))
+
+from exectrace.msdos import MSDOS_Trace
+from exectrace.msx import MSX_Trace
+
+
+class PageTableTest(unittest.TestCase):
+
+    def test_block_of_any_length_keeps_whole_pages(self):
+        image = bytes(range(256)) * 0x1000
+        trace = MSDOS_Trace(image, relocation_blocks=((0, 0, 0xFFFFF),))
+        self.assertEqual(trace.page_shift, 8)
+        self.assertEqual(len(trace.page_table), 0x1000)
+        self.assertEqual(trace.read_byte(0xFFFFE), 0xFE)
+        self.assertIsNone(trace.read_byte(0xFFFFF))
+        self.assertEqual(trace.read_bytes(0xFFF00, 0x200), bytes(range(255)))
+
+    def test_image_ending_within_a_page(self):
+        image = bytes(range(0x50)) * 4 + bytes(0x10)
+        trace = MSX_Trace(image, relocation_blocks=((0, 0x4000, 0x4000),))
+        self.assertEqual(trace.read_byte(0x414F), 0)
+        self.assertIsNone(trace.read_byte(0x4150))
+        self.assertIsNone(trace.read_word(0x414F))
+        self.assertIsNone(trace.rom_address(0x41FF))
+        self.assertEqual(len(trace.read_bytes(0x4000, 0x4000)), 0x150)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Lib"))
+
+from exectrace.msdos import MSDOS_Trace
+from exectrace.msx import MSX_Trace
+
+
+def put_words(image, offset, words):
+    for i, word in enumerate(words):
+        image[offset + 2 * i:offset + 2 * i + 2] = bytes((word & 0xFF, word >> 8))
+
+
+def z80_image():
+    ''' 4000: cp 3; ret nc; add a, a; ld e, a; ld d, 0; ld hl, 4100
+              add hl, de; ld e, (hl); inc hl; ld d, (hl); ex de, hl; jp (hl)
+        4020: ld l, a; ld h, 0; add hl, hl; ld de, 4110; add hl, de
+              ld a, (hl); inc hl; ld h, (hl); ld l, a; jp (hl)
+        4040: ld ix, 4060; jp (ix)
+        4100: a table of 4 pointers, of which "cp 3" only lets 3 be used
+        4110: a table of 3 pointers, then one out of the image
+        and "ret"s at 4060 and every 0x10 bytes from 4200 to 4260.
+    '''
+    image = bytearray(0x400)
+    image[0x00:0x10] = bytes([0xFE, 0x03, 0xD0, 0x87, 0x5F, 0x16, 0x00, 0x21, 0x00, 0x41,
+                              0x19, 0x5E, 0x23, 0x56, 0xEB, 0xE9])
+    image[0x20:0x2D] = bytes([0x6F, 0x26, 0x00, 0x29, 0x11, 0x10, 0x41, 0x19, 0x7E,
+                              0x23, 0x66, 0x6F, 0xE9])
+    image[0x40:0x46] = bytes([0xDD, 0x21, 0x60, 0x40, 0xDD, 0xE9])
+    put_words(image, 0x100, (0x4200, 0x4210, 0x4220, 0x4230))
+    put_words(image, 0x110, (0x4240, 0x4250, 0x4260, 0x00FF))
+    image[0x60] = 0xC9
+    for target in range(0x200, 0x270, 0x10):
+        image[target] = 0xC9
+    return bytes(image)
+
+
+def i8086_image():
+    ''' 0000: cmp bx, 3; ja 000A; jmp [bx + 0100]; nop; (000A) ret
+        0100: a table of 5 pointers, of which "cmp bx, 3" lets 4 be used
+        and "ret"s every 0x10 bytes from 0200 to 0240.
+    '''
+    image = bytearray(0x300)
+    image[0x00:0x0B] = bytes([0x83, 0xFB, 0x03, 0x77, 0x05, 0xFF, 0xA7, 0x00, 0x01, 0x90, 0xC3])
+    put_words(image, 0x100, (0x200, 0x210, 0x220, 0x230, 0x240))
+    for target in range(0x200, 0x250, 0x10):
+        image[target] = 0xC3
+    return bytes(image)
+
+
+def resolved(trace, entry_points):
+    with contextlib.redirect_stdout(io.StringIO()):
+        trace.run(entry_points=entry_points, resolve_jumps=True)
+    return trace.jump_resolver.resolved
+
+
+class Z80JumpTest(unittest.TestCase):
+
+    def setUp(self):
+        image = z80_image()
+        self.trace = MSX_Trace(image, relocation_blocks=((0, 0x4000, len(image)),))
+        self.resolved = resolved(self.trace, [0x4000, 0x4020, 0x4040])
+
+    def assertTable(self, address, length):
+        symbol = self.trace.symbols.get(address)
+        self.assertEqual((symbol.name, symbol.kind, symbol.length),
+                         ("JUMP_TABLE_%04X" % address, "jump_table", length))
+
+    def test_table_bounded_by_compare_and_return(self):
+        self.assertEqual(self.resolved[0x400F], [0x4200, 0x4210, 0x4220])
+        self.assertTable(0x4100, 3)
+
+    def test_unbounded_table_ends_at_implausible_entry(self):
+        self.assertEqual(self.resolved[0x402C], [0x4240, 0x4250, 0x4260])
+        self.assertTable(0x4110, 3)
+
+    def test_index_register_loaded_with_a_constant(self):
+        self.assertEqual(self.resolved[0x4044], [0x4060])
+
+    def test_targets_get_crawled(self):
+        for target in (0x4060, 0x4200, 0x4210, 0x4220, 0x4240, 0x4250, 0x4260):
+            self.assertIsNotNone(self.trace.visited_ranges.find(target))
+        self.assertIsNone(self.trace.visited_ranges.find(0x4230))
+
+
+class I8086JumpTest(unittest.TestCase):
+
+    def test_table_bounded_by_compare_and_branch(self):
+        image = i8086_image()
+        trace = MSDOS_Trace(image, relocation_blocks=((0, 0, len(image)),))
+        self.assertEqual(resolved(trace, [0x0000])[0x0005], [0x200, 0x210, 0x220, 0x230])
+        for target in (0x200, 0x210, 0x220, 0x230):
+            self.assertIsNotNone(trace.visited_ranges.find(target))
+        self.assertIsNone(trace.visited_ranges.find(0x240))
+
+
+if __name__ == "__main__":
+    unittest.main()
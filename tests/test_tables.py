@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# (c) 2022 Felipe Correa da Silva Sanches <juca@members.fsf.org>
+# Licensed under GPL version 3 or later
+
+import contextlib
+import io
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Lib"))
+
+import exectrace.tables
+from exectrace.msx import MSX_Trace
+
+TABLE = 0x4013
+TARGETS = (0x4020, 0x4024, 0x4028, 0x402C)
+
+
+def traced(image):
+    trace = MSX_Trace(image, relocation_blocks=((0, 0x4000, len(image)),))
+    with contextlib.redirect_stdout(io.StringIO()):
+        trace.run(entry_points=[0x4000])
+    return trace
+
+
+def dispatch_image():
+    ''' ld l, a; ld h, 0; add hl, hl; ld de, TABLE; add hl, de
+        ld e, (hl); inc hl; ld d, (hl); ex de, hl; jp (hl)
+        and a table of 4 pointers to "ret"s never traced.
+    '''
+    image = bytearray(0x30)
+    image[0:13] = bytes([0x6F, 0x26, 0x00, 0x29, 0x11, TABLE & 0xFF, TABLE >> 8,
+                         0x19, 0x5E, 0x23, 0x56, 0xEB, 0xE9])
+    for i, target in enumerate(TARGETS):
+        offset = TABLE - 0x4000 + 2 * i
+        image[offset:offset + 2] = bytes((target & 0xFF, target >> 8))
+        image[target - 0x4000] = 0xC9
+    return bytes(image)
+
+
+class DispatchTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = exectrace.tables.numpy
+
+    def tearDown(self):
+        exectrace.tables.numpy = self.numpy
+
+    def check(self):
+        trace = traced(dispatch_image())
+        self.assertIsNone(trace.visited_ranges.find(TARGETS[0]))
+        candidates = trace.find_pointer_tables(schedule=True)
+        self.assertEqual([candidate.variable() for candidate in candidates],
+                         [("JUMP_TABLE_4013", "jump_table", 4)])
+        trace.crawl()
+        for target in TARGETS:
+            self.assertIsNotNone(trace.visited_ranges.find(target))
+
+    @unittest.skipIf(exectrace.tables.numpy is None, "NumPy is not installed")
+    def test_with_numpy(self):
+        self.check()
+
+    def test_without_numpy(self):
+        exectrace.tables.numpy = None
+        self.check()
+
+
+def random_data_image(seed):
+    ''' 0x800 "nop"s and a "ret", then 0x800 bytes of words that all
+        point somewhere into that code.
+    '''
+    rng = random.Random(seed)
+    image = bytearray(0x1000)
+    image[0x7FF] = 0xC9
+    for offset in range(0x800, 0x1000, 2):
+        image[offset] = rng.randrange(0x100)
+        image[offset + 1] = rng.randrange(0x40, 0x48)
+    return bytes(image)
+
+
+class RandomDataTest(unittest.TestCase):
+
+    def test_random_data_is_no_table(self):
+        for seed in range(3):
+            trace = traced(random_data_image(seed))
+            self.assertEqual(trace.find_pointer_tables(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()